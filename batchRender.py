@@ -0,0 +1,241 @@
+import cv2 as cv
+import numpy as np
+import colorLib as clib
+import shadeCatalog as scat
+import concurrent.futures as cf
+import collections as col
+import argparse as ap
+import json as json
+import time as time
+import os as os
+import re as re
+
+""" Renders every shade on every face of a manifest into image files, headless, on a pool of
+    processes.  The work is split into tasks of a few shades of one face, given out face by face,
+    and each worker keeps the faces it has decomposed, so a face is decomposed once per worker and
+    used for all of its shades.  Only a few tasks are waiting at a time and workers write their
+    images themselves, so memory stays bounded however big the job is.  Each finished image is
+    recorded in a journal, and a job that is run again carries on from where it stopped.  A task
+    that fails is journaled as failed and the job goes on, it is tried again on the next run.
+
+    The manifest is a json file:
+    {"output": "grid",                      directory for the images (grid/<face id>/<shade>.jpg)
+     "format": ".jpg",
+     "faces": [{"id": "model1", "image": "crop4.jpg",
+                "mask": "skin.bmp",         optional, nonzero where the average skin reflectance is taken
+                "thickness": "feathered.bmp",  optional thickness map (255 is a border line and is ignored),
+                                            the cosmetic only goes there (eye shadow), otherwise the whole
+                                            face is covered (foundation)
+                "Yskin": 0.5}],
+     "shades": [{"name": "fair01", "bgr": [0.2, 0.3, 0.5]}],  or
+     "catalog": "shades.npy" (made by shadeCatalog.py), or "rgbTxt": "rgb.txt",
+     "thickness": 8.0,                      cosmetic thickness for whole face shades
+     "opacity": 0.5}                        thickness map multiplier (like eyeShadowDriver.py)
+    Relative paths are relative to the manifest.  Face ids and shade names are made safe for file
+    names, and ones that are then the same as another (ignoring case) get their row number added,
+    like grid/model1/a_b-3.jpg, so they stay the same as long as the rows are not reordered. """
+
+def safeName(name) :
+    """ name with the characters that are not safe in file names replaced by _ """
+    return re.sub(r'[^\w\-. ]', '_', str(name)).strip() or '_'
+
+def fileNames(names) :
+    """ returns a file safe name (see safeName) for each of names, different from all the others
+        ignoring case, names that would be the same get their row number added """
+    safe = [safeName(name) for name in names]
+    counts = col.Counter(name.lower() for name in safe)
+    used = set(name.lower() for name in safe if counts[name.lower()] == 1)
+    unique = []
+    for row, name in enumerate(safe) :
+        if counts[name.lower()] > 1 :
+            name = '%s-%d' % (name, row)
+            while name.lower() in used :
+                name = name + '_'
+        used.add(name.lower())
+        unique.append(name)
+    return unique
+
+def loadManifest(fname) :
+    """ reads a manifest, returns it with absolute paths, each face with its directory name (dir)
+        and the shades as a list of (name, [B G R], file name) """
+    with open(fname) as fi :
+        manifest = json.load(fi)
+    base = os.path.dirname(os.path.abspath(fname))
+    path = lambda name : None if name is None else os.path.join(base, name)
+    manifest['output'] = path(manifest.get('output', 'batch'))
+    fmt = manifest.get('format', '.jpg')
+    if not isinstance(fmt, str) or not fmt.startswith('.') or not cv.haveImageWriter('x' + fmt) :
+        raise ValueError('cannot write images of format ' + str(fmt))
+    for face, faceDir in zip(manifest['faces'], fileNames(face['id'] for face in manifest['faces'])) :
+        for key in ('image', 'mask', 'thickness') :
+            face[key] = path(face.get(key))
+        face['dir'] = faceDir
+    if 'shades' in manifest :
+        shades = [(shade['name'], shade['bgr']) for shade in manifest['shades']]
+    else :
+        if 'catalog' in manifest :
+            cat = scat.load(path(manifest['catalog']))
+        else :
+            cat = scat.readRgbTxt(path(manifest['rgbTxt']))
+        shades = [(cat.name(row), [float(val) for val in cat.bgr[row]]) for row in range(len(cat))]
+    manifest['shades'] = [(name, bgr, shadeFile) for (name, bgr), shadeFile
+                          in zip(shades, fileNames(name for name, bgr in shades))]
+    return manifest
+
+def outputName(outdir, faceDir, shadeFile, fmt) :
+    """ the image file for a face and shade, from the names loadManifest made for them """
+    return os.path.join(outdir, faceDir, shadeFile + fmt)
+
+def _loadFace(face) :
+    """ reads and decomposes a face, returns (flatFace, thickness map or None), what is kept for it in a worker """
+    img = cv.imread(face['image'], 1)
+    if img is None :
+        raise IOError('cannot read face image ' + face['image'])
+    mask = None if face.get('mask') is None else cv.imread(face['mask'], 0)
+    flat = clib.decomposeFlat(img, mask, face.get('Yskin', 0.5), np.float32, cache=False)
+    thickness = None
+    if face.get('thickness') is not None :
+        thickness = cv.imread(face['thickness'], 0)
+        if thickness is None :
+            raise IOError('cannot read thickness map ' + face['thickness'])
+        thickness = (thickness * (thickness < 255)).astype(np.float32) / 255.0  # 255 is the border line
+    return flat, thickness
+
+_faces = clib.lruCache(maxItems=4, maxBytes=2**30)  # faces decomposed by this worker process
+
+def _regionShades(flat, thickness, csms) :
+    """ yields (shade number, sRGB image) for the csms put on a flatFace where thickness is not 0 """
+    skin = np.empty(flat.shading.shape + (3,), np.float32)
+    skin[:] = flat.refAve
+    for idx, csm in enumerate(csms) :
+        lin = clib.renderRegion(flat.shading, skin, thickness, csm, dtype=np.float32)
+        lin /= clib.rollOverScale(lin)
+        yield idx, clib.fromReflectanceImg(lin)
+
+def renderTask(task) :
+    """ renders the shades of one task (a face and some shades) and writes the images, this runs in the workers
+        returns the list of image files written """
+    face = task['face']
+    flat, thickness = _faces.getOrMake((face['id'], face['image'], face.get('mask'), face.get('thickness')),
+                                       lambda : _loadFace(face))
+    files = [shadeFile for name, bgr, shadeFile in task['shades']]
+    csms = np.clip(np.array([bgr for name, bgr, shadeFile in task['shades']], np.float64), 0.01, 0.99)  # 0 < csm < 1
+    if thickness is None :  # foundation, the face with each shade is shading * color
+        images = clib.iterFlatShades(flat.shading, flat.refAve, csms, task['thickness'], 'auto', flat.shadingMax)
+    else :
+        images = _regionShades(flat, thickness * task['opacity'], csms)
+    written = []
+    for idx, img in images :
+        fname = outputName(task['output'], face['dir'], files[idx], task['format'])
+        # written whole then renamed, so no file is ever half written, a worker does one task at a
+        # time so the process id makes the temporary file its own
+        tmp = '%s.%d.tmp%s' % (fname, os.getpid(), task['format'])
+        try :
+            if not cv.imwrite(tmp, img) :
+                raise IOError('cannot write ' + tmp)
+            os.replace(tmp, fname)
+        finally :
+            if os.path.exists(tmp) :
+                os.remove(tmp)
+        written.append(fname)
+    return written
+
+def makeTasks(manifest, done, chunk=16) :
+    """ yields the tasks of a manifest, face by face, leaving out the images in done (a set of file names) """
+    fmt = manifest.get('format', '.jpg')
+    for face in manifest['faces'] :
+        todo = [shade for shade in manifest['shades']
+                if journalName(manifest['output'], face['dir'], shade[2], fmt) not in done]
+        if len(todo) > 0 :
+            os.makedirs(os.path.join(manifest['output'], face['dir']), exist_ok=True)
+        for first in range(0, len(todo), chunk) :
+            yield {'face': face, 'shades': todo[first:first + chunk], 'output': manifest['output'], 'format': fmt,
+                   'thickness': manifest.get('thickness', 8.0), 'opacity': manifest.get('opacity', 0.5)}
+
+def journalName(outdir, faceDir, shadeFile, fmt) :
+    """ the name an image is recorded under in the journal, relative to the output directory so it can be moved """
+    return os.path.relpath(outputName(outdir, faceDir, shadeFile, fmt), outdir)
+
+def readJournal(fname) :
+    """ returns the set of images (see journalName) recorded as finished in a journal
+        lines starting with # record failures (see _record) and are not finished images """
+    done = set()
+    if os.path.exists(fname) :
+        with open(fname) as fi :
+            for line in fi :
+                if line.endswith('\n') and not line.startswith('#') :  # a line cut short by an interruption is not trusted
+                    done.add(line[0:-1])
+    return done
+
+def runBatch(manifest, workers=None, chunk=16, inFlight=None, journal=None, restart=False, log=print) :
+    """
+    renders all the faces x shades of a manifest (see loadManifest) on workers processes
+    chunk is the number of shades in a task, inFlight the most tasks given out at once (default 2 per worker)
+    journal is the file finished and failed images are recorded in (default output/.journal), restart ignores it
+    returns (images written, images already done)
+    """
+    if workers is None :
+        workers = os.cpu_count() or 1
+    if inFlight is None :
+        inFlight = 2 * workers
+    os.makedirs(manifest['output'], exist_ok=True)
+    if journal is None :
+        journal = os.path.join(manifest['output'], '.journal')
+    done = set() if restart else readJournal(journal)
+    with open(journal + '.tmp', 'w') as fo :  # rewritten without any line cut short, then added to
+        fo.writelines(name + '\n' for name in sorted(done))
+    os.replace(journal + '.tmp', journal)
+    total = len(manifest['faces']) * len(manifest['shades'])
+    nwritten = 0
+    start = time.perf_counter()
+    tasks = makeTasks(manifest, done, chunk)
+    with open(journal, 'a') as jo, cf.ProcessPoolExecutor(workers) as pool :
+        pending = {}
+        for task in tasks :
+            pending[pool.submit(renderTask, task)] = task
+            while len(pending) >= inFlight :
+                finished = cf.wait(pending, return_when=cf.FIRST_COMPLETED)[0]
+                nwritten = nwritten + _record([(job, pending.pop(job)) for job in finished], jo, manifest['output'], log)
+                if log is not None :
+                    secs = time.perf_counter() - start
+                    log('%d of %d images, %.1f images/s' % (len(done) + nwritten, total, nwritten / secs))
+        cf.wait(pending)
+        nwritten = nwritten + _record(list(pending.items()), jo, manifest['output'], log)
+    return nwritten, len(done)
+
+def _record(finished, jo, outdir, log) :
+    """ writes the images of finished tasks (a list of (future, task)) to the journal, returns how many there were
+        a task that failed is reported and journaled as # lines for its images, which readJournal
+        leaves out, so they are tried again when the job is run again and the other tasks go on """
+    count = 0
+    for job, task in finished :
+        try :
+            written = job.result()
+        except Exception as err :  # whatever one task does wrong, the job goes on
+            message = ' '.join(('%s: %s' % (type(err).__name__, err)).split())  # on one line
+            if log is not None :
+                log('task failed: ' + message)
+            for name, bgr, shadeFile in task['shades'] :
+                jo.write('# failed %s %s\n' % (journalName(outdir, task['face']['dir'], shadeFile, task['format']),
+                                                message))
+            continue
+        for fname in written :
+            jo.write(os.path.relpath(fname, outdir) + '\n')
+            count = count + 1
+    jo.flush()
+    os.fsync(jo.fileno())
+    return count
+
+if __name__ == '__main__' :
+    parser = ap.ArgumentParser(description='render every shade on every face of a manifest')
+    parser.add_argument('manifest', help='json manifest of faces and shades')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default one per cpu)')
+    parser.add_argument('--chunk', type=int, default=16, help='shades in one task')
+    parser.add_argument('--inflight', type=int, default=None, help='tasks given out at once (default 2 per worker)')
+    parser.add_argument('--journal', default=None, help='journal of finished images (default output/.journal)')
+    parser.add_argument('--restart', action='store_true', help='ignore the journal and render everything again')
+    args = parser.parse_args()
+    manifest = loadManifest(args.manifest)
+    start = time.perf_counter()
+    nwritten, nskipped = runBatch(manifest, args.workers, args.chunk, args.inflight, args.journal, args.restart)
+    print('images written', nwritten, 'already done', nskipped, 'in', round(time.perf_counter() - start, 1), 's')
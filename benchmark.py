@@ -0,0 +1,239 @@
+import cv2 as cv
+import numpy as np
+import colorLib as clib
+import collections as col
+import argparse as ap
+import tracemalloc as tracemalloc
+import platform as platform
+import json as json
+import threading as threading
+import time as time
+import sys as sys
+import os as os
+
+""" Headless benchmarks of the colorLib stages on made up faces, patches, eyelid boundary lines
+    and textures at several image sizes.  Each stage is timed on its own and reported in pixels
+    per second (of the image size) with the peak memory it allocates.  Results can be saved as
+    JSON and compared with a saved baseline, and a stage that is slower (or uses more memory)
+    than the baseline by more than its tolerance is a regression.
+
+    Peak memory is measured two ways, see memoryNotes. """
+
+sizes = col.OrderedDict([('vga', (480, 640)), ('hd', (720, 1280)), ('2mp', (1080, 1920)),
+                         ('5mp', (1944, 2592)), ('12mp', (3000, 4000)), ('24mp', (4000, 6000))])
+
+def syntheticInputs(rows, cols, dtype=np.float64, seed=0) :
+    """ returns a dict of made up inputs for an image of rows x columns:
+        face (sRGB uint8), lin (its linear BGR), shading, skin (refAve everywhere), patch (sRGB uint8 cosmetic
+        patch), boundary (eyelid boundary line image, 255 on the line), featherLine (the top of the boundary),
+        seed (row, col) inside the eyelid, thickness (map that is 0.5 on the eyelid) and texture (BGR reflectance) """
+    rand = np.random.RandomState(seed)
+    yy = ((np.arange(rows, dtype=np.float32) - rows / 2.0) / (rows * 0.42))[:, np.newaxis]
+    xx = ((np.arange(cols, dtype=np.float32) - cols / 2.0) / (rows * 0.32))[np.newaxis, :]
+    oval = (xx * xx + yy * yy) < 1.0
+    light = (0.85 + 0.3 * np.cos(xx - 0.3)) * np.ones((rows, 1), np.float32)  # shading across the face
+    lin = np.empty((rows, cols, 3), np.float32)
+    lin[:] = [0.25, 0.25, 0.25]
+    lin[oval] = [0.28, 0.36, 0.55]  # skin, B G R
+    lin *= (light * rand.normal(1.0, 0.03, (rows, cols)).astype(np.float32))[:, :, np.newaxis]
+    face = clib.fromReflectanceImg(lin)
+    patch = clib.fromReflectanceImg(np.float32([0.2, 0.3, 0.5]) * rand.uniform(0.6, 1.0, (rows, cols, 1)).astype(np.float32))
+    mask = np.zeros((rows, cols), np.uint8)
+    center = (int(cols * 0.40), int(rows * 0.38))
+    cv.ellipse(mask, center, (max(2, int(rows * 0.09)), max(2, int(rows * 0.035))), 0, 180, 360, 255, -1)
+    boundary = ((cv.dilate(mask, np.ones((3, 3), np.uint8)) > 0) & (mask == 0)).astype(np.uint8) * 255
+    featherLine = np.array(boundary)
+    featherLine[center[1]:] = 0  # the line at the top of the eyelid
+    inside = np.argwhere(mask)
+    swatch = rand.randint(0, 256, (64, 64, 3)).astype(np.uint8)
+    texture = clib.mirrorTexture(cv.GaussianBlur(swatch, (5, 5), 0), 1.0, (rows, cols), cache=False)
+    face64 = clib.decomposeFace(face, mask, dtype=dtype, cache=False)
+    skin = np.empty((rows, cols, 3), dtype)
+    skin[:] = clib.limitSkin(face64.shading, face64.refAve)[0]
+    return {'face': face, 'lin': lin.astype(dtype), 'shading': np.array(face64.shading), 'skin': skin,
+            'patch': patch, 'boundary': boundary, 'featherLine': featherLine,
+            'seed': tuple(inside[len(inside) // 2]), 'thickness': (mask != 0).astype(dtype) * 0.5,
+            'texture': (texture * (0.8 / 255.0) + 0.1).astype(dtype)}
+
+def _feathered(inp, img) :
+    val = clib.featheredVal()
+    val.setLine(inp['featherLine'])
+    clib.floodfillFunc(img, inp['seed'], val)
+    val.renorm(img)
+
+""" stage name -> (setup(inputs) returning the arguments that are changed by the stage, run(inputs, args)) """
+stages = col.OrderedDict([
+    ('toReflectance', (None, lambda inp, arg : clib.toReflectanceImg(inp['face'], dtype=inp['lin'].dtype))),
+    ('fromReflectance', (None, lambda inp, arg : clib.fromReflectanceImg(inp['lin']))),
+    ('getPatchColor', (None, lambda inp, arg : clib.getPatchColor(inp['patch']))),
+    ('floodfill', (lambda inp : np.array(inp['boundary']), lambda inp, img : clib.floodfill(img, inp['seed'], 200))),
+    ('floodfillFeathered', (lambda inp : np.array(inp['boundary']), _feathered)),
+    ('showFace', (None, lambda inp, arg : clib.showFace(inp['shading'], inp['skin'], 8.0, [0.4, 0.5, 0.6]))),
+    ('showFaceGen', (None, lambda inp, arg : clib.showFaceGen(inp['shading'], inp['skin'], inp['thickness'], inp['texture']))),
+    ('RGBtoLAB', (None, lambda inp, arg : clib.RGBtoLABImg(inp['lin']))),
+    ('difLAB', (None, lambda inp, arg : clib.difLABImg(inp['lin'], inp['skin']))),
+])
+
+memoryNotes = {
+    'peakBytes': 'peak of the numpy and Python allocations (tracemalloc), buffers OpenCV allocates '
+                 'itself (floodFill, distanceTransform, pyrDown ...) are not seen',
+    'peakRssBytes': 'peak rise of the resident memory of the process, sampled on a thread every 0.2 ms after '
+                    'the free heap is given back to the system (glibc malloc_trim), this sees the OpenCV buffers '
+                    'but can miss memory used for less than a sample, and memory used again from the heap where '
+                    'malloc_trim is not available, null where /proc/self/statm is not available'}
+
+try :
+    _pageSize = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError) :
+    _pageSize = 4096
+
+try :
+    import ctypes as ctypes
+    _libc = ctypes.CDLL('libc.so.6')
+    _libc.malloc_trim
+except (ImportError, OSError, AttributeError) :  # not glibc
+    _libc = None
+
+def trimHeap() :
+    """ gives the free heap memory back to the system (glibc only), so the resident memory rises
+        again when a stage allocates """
+    if _libc is not None :
+        _libc.malloc_trim(0)
+
+def residentBytes() :
+    """ the resident memory of this process in bytes, or None where /proc/self/statm is not available """
+    try :
+        with open('/proc/self/statm') as fi :
+            return int(fi.read().split()[1]) * _pageSize
+    except (IOError, OSError) :
+        return None
+
+class rssSampler() :
+    """ context manager that samples residentBytes on a thread while it is open,
+        peak is then the most it rose above where it started, or None if it cannot be read """
+    def __init__(self, interval=0.0002):
+        self.interval = interval
+        self.peak = None
+    def _sample(self):
+        while not self._stop.is_set() :
+            self.peak = max(self.peak, residentBytes() - self.start)
+            time.sleep(self.interval)
+    def __enter__(self):
+        self.start = residentBytes()
+        if self.start is not None :
+            self.peak = 0
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+    def __exit__(self, *exc):
+        if self.start is not None :
+            self.peak = max(self.peak, residentBytes() - self.start)
+            self._stop.set()
+            self._thread.join()
+        return False
+
+def timeStage(inp, setup, run, repeat=3) :
+    """ returns (median seconds, best seconds, peak bytes allocated, peak resident bytes) for repeat
+        runs of a stage (see memoryNotes), the memory is measured in two more runs so tracemalloc and
+        the sampling thread do not slow the timed ones """
+    times = []
+    for idx in range(repeat) :
+        arg = None if setup is None else setup(inp)
+        start = time.perf_counter()
+        run(inp, arg)
+        times.append(time.perf_counter() - start)
+    arg = None if setup is None else setup(inp)
+    tracemalloc.start()
+    try :
+        base = tracemalloc.get_traced_memory()[0]
+        run(inp, arg)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally :
+        tracemalloc.stop()
+    arg = None if setup is None else setup(inp)
+    trimHeap()
+    with rssSampler() as rss :
+        run(inp, arg)
+    return float(np.median(times)), min(times), peak, rss.peak
+
+def runBenchmarks(sizeNames=('vga', '2mp'), stageNames=None, repeat=3, dtype=np.float64, log=None) :
+    """ returns the results {size name: {stage name: {seconds, best, pixels, pxPerSec, peakBytes, peakRssBytes}}}
+        log(size name, stage name, result) is called as each stage finishes """
+    results = col.OrderedDict()
+    for sizeName in sizeNames :
+        rows, cols = sizes[sizeName]
+        inp = syntheticInputs(rows, cols, dtype)
+        results[sizeName] = col.OrderedDict()
+        for name in (stages if stageNames is None else stageNames) :
+            setup, run = stages[name]
+            secs, best, peak, rss = timeStage(inp, setup, run, repeat)
+            result = {'seconds': secs, 'best': best, 'pixels': rows * cols,
+                      'pxPerSec': rows * cols / secs, 'peakBytes': peak, 'peakRssBytes': rss}
+            results[sizeName][name] = result
+            if log is not None :
+                log(sizeName, name, result)
+        del inp
+    return results
+
+def compare(results, baseline, tolerance=0.1, memTolerance=0.25, stageTolerance=None) :
+    """ returns a list of (size, stage, what, baseline value, value) for the regressions in results:
+        pixels per second more than tolerance (a fraction) below the baseline, or peak memory (either
+        measure) more than memTolerance above it.  stageTolerance is a dict of stage name -> tolerance
+        overrides.  Sizes and stages missing from either are not compared. """
+    regressions = []
+    for sizeName, stageResults in results.items() :
+        for name, result in stageResults.items() :
+            base = baseline.get(sizeName, {}).get(name)
+            if base is None :
+                continue
+            tol = tolerance if stageTolerance is None else stageTolerance.get(name, tolerance)
+            if result['pxPerSec'] < base['pxPerSec'] * (1.0 - tol) :
+                regressions.append((sizeName, name, 'pxPerSec', base['pxPerSec'], result['pxPerSec']))
+            if result['peakBytes'] > base['peakBytes'] * (1.0 + memTolerance) + 2**16 :
+                regressions.append((sizeName, name, 'peakBytes', base['peakBytes'], result['peakBytes']))
+            old, new = base.get('peakRssBytes'), result.get('peakRssBytes')
+            if old is not None and new is not None and new > old * (1.0 + memTolerance) + 2**20 :  # sampling is noisier
+                regressions.append((sizeName, name, 'peakRssBytes', old, new))
+    return regressions
+
+def _printResult(sizeName, name, result) :
+    rss = '%9.1f MB' % (result['peakRssBytes'] / 2.0**20) if result['peakRssBytes'] is not None else '        -   '
+    print('%-5s %-19s %9.2f Mpx/s %9.1f ms %9.1f MB %s' % (sizeName, name, result['pxPerSec'] / 1e6,
+                                                       result['seconds'] * 1000.0, result['peakBytes'] / 2.0**20, rss))
+    sys.stdout.flush()
+
+if __name__ == '__main__' :
+    parser = ap.ArgumentParser(description='benchmark the colorLib stages on made up images')
+    parser.add_argument('--sizes', nargs='+', default=['vga', '2mp'], choices=list(sizes), help='image sizes')
+    parser.add_argument('--stages', nargs='+', default=None, choices=list(stages), help='stages to run (default all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each stage, the median is used')
+    parser.add_argument('--float32', action='store_true', help='use float32 images (less memory for 24mp)')
+    parser.add_argument('--json', default=None, help='save the results here')
+    parser.add_argument('--baseline', default=None, help='compare with the results saved in this file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed fractional drop in pixels per second')
+    parser.add_argument('--mem-tolerance', type=float, default=0.25, help='allowed fractional rise in peak memory')
+    parser.add_argument('--stage-tolerance', nargs='*', default=[], metavar='STAGE=TOL',
+                        help='tolerance for particular stages, like floodfill=0.3')
+    args = parser.parse_args()
+    print('memory: traced is %s' % memoryNotes['peakBytes'])
+    print('        resident is %s' % memoryNotes['peakRssBytes'])
+    print('%-5s %-19s %15s %12s %12s %12s' % ('size', 'stage', 'speed', 'time', 'traced', 'resident'))
+    results = runBenchmarks(args.sizes, args.stages, args.repeat, np.float32 if args.float32 else np.float64,
+                            _printResult)
+    if args.json is not None :
+        meta = {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv.__version__,
+                'machine': platform.machine(), 'float32': args.float32, 'repeat': args.repeat, 'time': time.time()}
+        with open(args.json, 'w') as fo :
+            json.dump({'meta': meta, 'memoryNotes': memoryNotes, 'results': results}, fo, indent=2)
+    if args.baseline is not None :
+        with open(args.baseline) as fi :
+            baseline = json.load(fi)['results']
+        stageTolerance = dict((item.split('=')[0], float(item.split('=')[1])) for item in args.stage_tolerance)
+        regressions = compare(results, baseline, args.tolerance, args.mem_tolerance, stageTolerance)
+        for sizeName, name, what, old, new in regressions :
+            print('REGRESSION %s %s %s baseline %.4g now %.4g' % (sizeName, name, what, old, new))
+        if len(regressions) > 0 :
+            sys.exit(1)
+        print('no regressions')
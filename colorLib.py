@@ -1,10 +1,16 @@
 import cv2 as cv
 import numpy as np
 import collections as col
+import concurrent.futures as cf
+import threading as threading
+import os as os
+import hashlib as hl
+import profiler as prof
 
 """ Note linear RGB is defined in terms of the sRGB phosphors """
 
-def getPatchColor(patch) :
+@prof.stage('getPatchColor')
+def getPatchColor(patch, percentile=None) :
 
     """
     patch should be an sRGB image with the correct white point.  In general, it will be
@@ -16,21 +22,43 @@ def getPatchColor(patch) :
     applied in a very thick layer, which is the parameter that is needed for a Kubelka-Munk
     calculation of the appearance of skin with the cosmetic applied in any thickness.
     The normalization will be 0.0 to 1.0.
+
+    percentile (0 to 100) picks the pixel at that luminance percentile instead of the
+    darkest pixel, so a single noisy JPEG pixel does not set the color.  1 works well.
     """
+    return list(getPatchColors([patch], percentile)[0])
 
-    dark = 1000.0
-    darkest = [-1.0, -1.0, -1.0]
-    for row in patch:
-        for col in row :
-            bR = toReflectance(col[0])
-            gR = toReflectance(col[1])
-            rR = toReflectance(col[2])
-            dd = 0.33 * rR + 0.66 * gR + 0.07 * bR
-            if dd < dark :
-                dark = dd
-                darkest = [bR, gR, rR]
+@prof.stage('getPatchColors')
+def getPatchColors(patches, percentile=None, dtype=np.float64) :
+    """
+    patches is a list of sRGB patch images (they can be different sizes) or a numpy stack
+    of equal sized patches (number of patches x rows x columns x 3)
+    returns a number of patches x 3 numpy array of the BGR reflectances getPatchColor
+    would give for each patch
+    dtype is the reflectance type, np.float32 or np.float64
+    """
+    if isinstance(patches, np.ndarray) and patches.ndim == 4 :
+        refl = toReflectanceImg(patches[:, :, :, 0:3], dtype=dtype)
+        return _darkestColor(refl.reshape(len(patches), -1, 3), percentile)
+    patches = list(patches)
+    darkest = np.empty((len(patches), 3), dtype)
+    for idx, patch in enumerate(patches) :
+        refl = toReflectanceImg(patch[:, :, 0:3], dtype=dtype)
+        darkest[idx] = _darkestColor(refl.reshape(1, -1, 3), percentile)[0]
     return darkest
 
+def _darkestColor(refl, percentile) :
+    """ refl is a number of patches x pixels x 3 BGR reflectance array
+        returns the color of the darkest pixel (or the pixel at the luminance percentile)
+        of each patch as a number of patches x 3 array """
+    lum = np.dot(refl, np.array([0.07, 0.66, 0.33], refl.dtype))  # luminance of every pixel
+    if percentile is None :
+        pick = np.argmin(lum, axis=1)
+    else :
+        kth = int(round(percentile / 100.0 * (lum.shape[1] - 1)))
+        pick = np.argpartition(lum, kth, axis=1)[:, kth]
+    return refl[np.arange(len(refl)), pick]
+
 def fromReflectance(ref) :
     """
     ref is a 0 to 1.0 reflectance value
@@ -57,6 +85,137 @@ def toReflectance(col) :
         ref = ((ref + fac) / (1+fac)) ** 2.4
     return ref
 
+""" The whole image functions below work on bands of rows (the first axis of the image).
+    The bands can be done on a pool of threads, since numpy lets other threads run while it
+    does arithmetic on arrays.  Bands also keep the work arrays small, and the images can be
+    numpy memory maps (np.memmap or np.load with mmap_mode) that are larger than memory. """
+
+_pools = {}  # thread pools by number of workers, kept between calls
+_poolLock = threading.Lock()
+_local = threading.local()  # work arrays of each thread, kept between calls
+
+def runBands(nrows, func, bandRows=32, workers=1) :
+    """ calls func(row0, row1) for bands of bandRows rows covering rows 0 to nrows
+        workers is the number of threads to use (None for one per cpu)
+        returns the list of func results in band order """
+    bands = [(row0, min(row0 + bandRows, nrows)) for row0 in range(0, nrows, bandRows)]
+    if workers is None :
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(bands) <= 1 :
+        return [func(row0, row1) for row0, row1 in bands]
+    with _poolLock :
+        pool = _pools.get(workers)
+        if pool is None :
+            pool = cf.ThreadPoolExecutor(workers)
+            _pools[workers] = pool
+    return list(pool.map(lambda band : func(band[0], band[1]), bands))
+
+def _workArrays(key, shape, dtype, count) :
+    """ returns count work arrays of shape and dtype for the calling thread
+        they are kept under key and used again by the next call with the same key """
+    size = int(np.prod(shape))
+    work = getattr(_local, key, None)
+    if work is None or len(work) < count or work[0].dtype != dtype or work[0].size < size :
+        work = [np.empty(size, dtype) for idx in range(count)]
+        setattr(_local, key, work)
+    return [arr[0:size].reshape(shape) for arr in work[0:count]]
+
+def _rowViews(arrs) :
+    """ numpy arrays of 0 dimensions are given a row axis so they can be split into bands """
+    return [arr.reshape(1) if arr.ndim == 0 else arr for arr in arrs]
+
+""" Whole image versions of toReflectance and fromReflectance.
+    toReflectance and fromReflectance above are the reference for these. """
+
+_toRefTable = np.array([toReflectance(val) for val in range(256)])  # uint8 sRGB to reflectance
+# reflectances half way between successive uint8 sRGB values, for rounding
+_fromRefEdges = np.array([toReflectance(val + 0.5) for val in range(255)])
+# uint8 sRGB value at the start of each of 65536 reflectance steps.  A step is narrower than the
+# distance between two edges, so comparing with the edges above and below the table value
+# gives the rounded value exactly (to float32 precision for float32 images)
+_fromRefSteps = 65536
+_fromRefTable = np.searchsorted(_fromRefEdges, np.arange(_fromRefSteps + 1.0) / _fromRefSteps,
+                                side='right').astype(np.uint8)
+_fromRefAbove = np.append(_fromRefEdges, np.inf)
+_fromRefBelow = np.insert(_fromRefEdges, 0, -np.inf)
+_fromRefEdges32 = (_fromRefAbove.astype(np.float32), _fromRefBelow.astype(np.float32))  # for float32 images
+
+@prof.stage('toReflectanceImg')
+def toReflectanceImg(img, out=None, dtype=np.float64, bandRows=32, workers=1) :
+    """
+    img is an sRGB numpy array (any shape) with 0 to 255 normalization
+    returns a numpy array of reflectances with 0.0 to 1.0 normalization
+    uint8 images are converted with a 256 entry look up table, anything else is calculated
+    out is an optional array of the same shape to put the result in (its dtype is then used)
+    dtype is the result type when out is not given (np.float32 or np.float64)
+    bandRows rows are done at a time on workers threads (see runBands)
+    """
+    img = np.asarray(img)
+    if out is None :
+        out = np.empty(img.shape, dtype)
+    img1, out1 = _rowViews([img, out])
+    runBands(len(out1), lambda row0, row1 : _toReflectanceBand(img1[row0:row1], out1[row0:row1]),
+             bandRows, workers)
+    return out
+
+def _toReflectanceBand(img, out) :
+    if img.dtype == np.uint8 :
+        np.take(_toRefTable.astype(out.dtype, copy=False), img, out=out)
+        return
+    np.divide(img, 255.0, out=out)
+    low = out < 0.04045
+    lin = out / 12.92
+    fac = 0.055
+    np.add(out, fac, out=out)
+    np.divide(out, 1+fac, out=out)
+    np.power(out, 2.4, out=out)
+    np.copyto(out, lin, where=low)
+
+@prof.stage('fromReflectanceImg')
+def fromReflectanceImg(ref, out=None, dtype=np.uint8, bandRows=32, workers=1) :
+    """
+    ref is a numpy array (any shape) of reflectances with 0.0 to 1.0 normalization
+    returns an sRGB numpy array with 0 to 255 normalization
+    assumes a reflectance of 1.0  corresponds to an sRGB of 255
+    dtype np.uint8 rounds to the nearest sRGB value with a 65536 entry look up table and
+    the reflectances half way between sRGB values,
+    dtype np.uint16 uses 0 to 65535 normalization instead (like 16 bit png files),
+    and np.float32 or np.float64 give the unrounded values fromReflectance would return
+    integer results are clipped to the range of the type
+    out is an optional array of the same shape to put the result in (its dtype is then used)
+    bandRows rows are done at a time on workers threads (see runBands)
+    """
+    ref = np.asarray(ref)
+    if out is None :
+        out = np.empty(ref.shape, dtype)
+    ref1, out1 = _rowViews([ref, out])
+    runBands(len(out1), lambda row0, row1 : _fromReflectanceBand(ref1[row0:row1], out1[row0:row1]),
+             bandRows, workers)
+    return out
+
+def _fromReflectanceBand(ref, out) :
+    if out.dtype == np.uint8 :
+        above, below = _fromRefEdges32 if ref.dtype == np.float32 else (_fromRefAbove, _fromRefBelow)
+        ref = np.clip(ref, 0.0, 1.0)
+        val = _fromRefTable[(ref * _fromRefSteps).astype(np.intp)]
+        val += ref >= above[val]
+        val -= ref < below[val]
+        out[...] = val
+        return
+    val = np.maximum(ref, 0.0031308)  # keeps the power away from negative values
+    np.power(val, 1/2.4, out=val)
+    fac = 0.055
+    val = val * (1+fac) - fac
+    np.copyto(val, 12.92 * ref, where=ref < 0.0031308)
+    if out.dtype == np.uint16 :
+        val *= 65535
+        np.clip(val, 0, 65535, out=val)
+        np.rint(val, out=val)
+    else :
+        val *= 255
+    out[...] = val
+
+@prof.stage('showFace')
 def showFace(shading, skin, thickness, csm) :
     """
     shading is a numpy array capturing the variation in light intensity on the face.
@@ -66,19 +225,9 @@ def showFace(shading, skin, thickness, csm) :
     csm is the [B G R] tuple with the reflectance of a very thick layer of cosmetic
     It returns a linear BGR numpy image of the face with cosmetic applied normalized 0.0 to 1.0
     """
-    opF = [1.0, 1.0, 1.0]
-    for idx in [0, 1, 2] :
-        opF[idx] = thickness * (1 - csm[idx]*csm[idx]) / csm[idx]
-        opF[idx] = np.exp(-opF[idx])   # F in notes
-    var = np.copy(skin)
-    G = np.copy(skin)
-    for idx in [0,1,2] :
-        var[:,:,idx] = var[:,:,idx] - csm[idx]  # delta in notes
-        G[:,:,idx] = var[:,:,idx] * csm[idx] + csm[idx] * csm[idx] - 1  # G in notes
-        G[:,:,idx] =(var[:,:,idx] * opF[idx] - G[:,:,idx] * csm[idx])/(var[:,:,idx] * opF[idx] * csm[idx] - G[:,:,idx])  # R in notes
-        G[:,:,idx] = G[:,:,idx] * shading  # skin color = reflectance * shading
-    return  G
+    return renderKM(shading, skin, thickness, csm, dtype=_floatType(skin))
 
+@prof.stage('showFaceGen')
 def showFaceGen(shading, skin, thickness, csm) :
     """
     shading is a numpy array capturing the variation in light intensity on the face.
@@ -90,32 +239,823 @@ def showFaceGen(shading, skin, thickness, csm) :
     This captures possible cosmetic texture
     It returns a linear BGR numpy image of the face with cosmetic applied normalized 0.0 to 1.0
     """
-    opF = np.copy(skin)
-    npthick = np.copy(thickness)
-    for idx in [0, 1, 2]:
-        opF[:, :, idx] = npthick * (1 - csm[:, :, idx] * csm[:, :, idx]) / csm[:, :, idx]
-        opF[:, :, idx] = np.exp(-opF[:, :, idx])  # F in notes
-    var = np.copy(skin)
-    G = np.copy(skin)
-    tmp = np.copy(skin)
-    for idx in [0,1,2] :
-        var[:,:,idx] = var[:,:,idx] - csm[:,:,idx]  # delta in notes
-        G[:,:,idx] = var[:,:,idx] * csm[:,:,idx] + csm[:,:,idx] * csm[:,:,idx] - 1  # G in notes
-        tmp[:,:,idx] = var[:,:,idx] * opF[:,:,idx] * csm[:,:,idx] - G[:,:,idx]
-        G[:,:,idx] =(var[:,:,idx] * opF[:,:,idx] - G[:,:,idx] * csm[:,:,idx])/(var[:,:,idx] * opF[:,:,idx] * csm[:,:,idx] - G[:,:,idx])  # R in notes
-        G[:,:,idx] = G[:,:,idx] * shading  # skin color = reflectance * shading
-    return  G
+    return renderKM(shading, skin, thickness, csm, dtype=_floatType(skin))
+
+def _floatType(arr) :
+    """ the dtype of arr if it is a float array, otherwise np.float64 """
+    arr = np.asarray(arr)
+    return arr.dtype if arr.dtype.kind == 'f' else np.dtype(np.float64)
+
+class kmCosmetic() :
+    """ The parts of the Kubelka-Munk calculation in showFace and showFaceGen that only depend on
+        the cosmetic.  Make one of these once per cosmetic and pass it to renderKM instead of csm.
+        With c the reflectance of a very thick layer (csm), d = skin - c (delta in notes) and
+        F = exp(-thickness * (1 - c*c) / c) the notes give
+        R = (d*F - G*c) / (d*F*c - G) with G = d*c + c*c - 1, which is the same as
+        R = (d * (F - c*c) + c * (1 - c*c)) / (d * c * (F - 1) + (1 - c*c))
+        For a cosmetic with one color the constants are kept.  For a textured cosmetic only csm
+        is kept and the constants of each band are worked out in the thread's work arrays when
+        the band is rendered, so the cosmetic costs no image sized arrays of its own.
+    """
+    def __init__(self, csm, dtype=np.float64):
+        """ csm is a [B G R] tuple or a BGR numpy array (textured cosmetic) with the reflectance
+            of a very thick layer of cosmetic, 0 < csm < 1.  A textured csm that already has
+            type dtype is used as it is, not copied. """
+        c = np.asarray(csm, dtype)
+        self.dtype = c.dtype
+        self.csm = c
+        if c.ndim < 3 :   # one color for the whole image
+            self.c2, self.a, self.b, self.negk = _kmConstants(c, np.empty((4,) + c.shape, c.dtype))
+    def rows(self, row0, row1, cols=slice(None)):
+        """ returns the constants (csm, c2, a, b, negk) for image rows row0 to row1 (and columns cols)
+            the constants of a textured cosmetic are in work arrays of the calling thread that
+            are used again by its next call """
+        if self.csm.ndim < 3 :
+            return (self.csm, self.c2, self.a, self.b, self.negk)
+        c = self.csm[row0:row1, cols]
+        return (c,) + _kmConstants(c, _workArrays('kmConsts', c.shape, self.dtype, 4))
+    def crop(self, window):
+        """ returns a kmCosmetic for the part of the image in window (a tuple of row and column slices) """
+        if self.csm.ndim < 3 :
+            return self
+        return kmCosmetic(self.csm[window], self.dtype)
+
+def _kmConstants(c, work) :
+    """ puts c2, a, b and negk for the cosmetic reflectance c in the 4 arrays of work and returns them """
+    c2, a, b, negk = work
+    np.multiply(c, c, out=c2)
+    np.subtract(1, c2, out=a)        # 1 - c*c
+    np.multiply(c, a, out=b)         # c * (1 - c*c)
+    np.divide(a, c, out=negk)
+    np.negative(negk, out=negk)      # F = exp(thickness * negk)
+    return c2, a, b, negk
+
+@prof.stage('renderKM')
+def renderKM(shading, skin, thickness, csm, out=None, dtype=None, bandRows=32, workers=1) :
+    """
+    The fused version of showFace and showFaceGen
+    shading is a rows x columns numpy array capturing the variation in light intensity on the face
+    skin is a rows x columns x 3 BGR numpy array showing linear skin reflectance normalized 0.0 to 1.0
+    thickness is the thickness of the cosmetic layer, a number or a rows x columns numpy array
+    csm is a kmCosmetic or anything kmCosmetic accepts ([B G R] tuple or textured BGR numpy array)
+    out is an optional rows x columns x 3 array to put the result in (its dtype is then used)
+    dtype is the result type when out is not given (np.float32 or np.float64, default is
+    the kmCosmetic type)
+    It returns a linear BGR numpy image of the face with cosmetic applied normalized 0.0 to 1.0
+    The image is done bandRows rows at a time on workers threads (see runBands).  Each thread
+    uses two band sized work arrays (four more for the constants of a textured cosmetic), and
+    all three colors are done together, so nothing image sized is made except out.
+    """
+    if not isinstance(csm, kmCosmetic) :
+        csm = kmCosmetic(csm, np.float64 if dtype is None else dtype)
+    if out is None :
+        out = np.empty(np.shape(skin), csm.dtype if dtype is None else dtype)
+    thickness = np.asarray(thickness)
+    def band(row0, row1) :
+        F, d = _workArrays('km', out[row0:row1].shape, out.dtype, 2)
+        _renderBand(shading[row0:row1], skin[row0:row1],
+                    thickness if thickness.ndim == 0 else thickness[row0:row1],
+                    csm.rows(row0, row1), out[row0:row1], F, d)
+    runBands(len(out), band, bandRows, workers)
+    return out
+
+@prof.stage('renderSRGB')
+def renderSRGB(shading, skin, thickness, csm, out=None, scale=None, dtype=np.uint8, bandRows=32, workers=1) :
+    """
+    renderKM followed by fromReflectanceImg, done band by band so the linear image is never made
+    shading, skin, thickness and csm are as for renderKM (a kmCosmetic sets the calculation type)
+    out is an optional rows x columns x 3 array for the sRGB result (its dtype is then used)
+    dtype is the sRGB type when out is not given (see fromReflectanceImg)
+    scale is the [B G R] divisor that prevents roll overs, or None for no scaling, or 'auto'
+    to use the maximum of each color limited to be at least 1.0, which takes an extra pass
+    the rows are done on workers threads (see runBands)
+    It returns the sRGB image of the face with the cosmetic applied
+    """
+    if not isinstance(csm, kmCosmetic) :
+        csm = kmCosmetic(csm)
+    if out is None :
+        out = np.empty(np.shape(skin), dtype)
+    thickness = np.asarray(thickness)
+    def kmBand(row0, row1) :
+        lin, F, d = _workArrays('srgb', out[row0:row1].shape, csm.dtype, 3)
+        _renderBand(shading[row0:row1], skin[row0:row1],
+                    thickness if thickness.ndim == 0 else thickness[row0:row1],
+                    csm.rows(row0, row1), lin, F, d)
+        return lin
+    if isinstance(scale, str) and scale == 'auto' :
+        maxima = runBands(len(out), lambda row0, row1 : kmBand(row0, row1).max(axis=(0, 1)), bandRows, workers)
+        scale = np.maximum(np.max(maxima, axis=0), 1.0)
+    def band(row0, row1) :
+        lin = kmBand(row0, row1)
+        if scale is not None :
+            lin /= scale
+        _fromReflectanceBand(lin, out[row0:row1])
+    runBands(len(out), band, bandRows, workers)
+    return out
+
+def _renderBand(shading, skin, thickness, consts, out, F, d) :
+    """ one band of renderKM, F and d are work arrays the size of out
+        shading None leaves out the shading, and out can be skin to put a layer on it in place
+        skin None uses d as it is, for a d = skin - c that was worked out before (see preparedRender) """
+    c, c2, a, b, negk = consts
+    uniform = np.ndim(c) < 3  # one cosmetic color for the whole band
+    shaded = out
+    if thickness.ndim == 0 and uniform :
+        Fc = np.exp(thickness * negk)  # F is the same for every pixel
+    else :
+        np.multiply(thickness if thickness.ndim == 0 else thickness[:, :, np.newaxis], negk, out=F)
+        np.exp(F, out=F)           # F in notes
+    if uniform and out.ndim == 3 and out.flags.c_contiguous :
+        # numpy is much faster along long rows than along the 3 colors of a pixel, so look at
+        # the band as rows x (columns * 3) with the cosmetic constants repeated along a row
+        ncol = out.shape[1]
+        out, F, d = [arr.reshape(len(arr), -1) for arr in (out, F, d)]
+        c, c2, a, b = [np.tile(const, ncol) for const in (c, c2, a, b)]
+        if thickness.ndim == 0 :
+            Fc = np.tile(Fc, ncol)
+    if skin is not None :
+        np.subtract(skin.reshape(d.shape), c, out=d)   # delta in notes
+    if thickness.ndim == 0 and uniform :
+        np.multiply(d, (Fc - 1) * c, out=out)
+        out += a               # denominator
+        np.multiply(d, Fc - c2, out=F)
+        F += b                 # numerator
+    else :
+        np.subtract(F, 1, out=out)
+        out *= c
+        out *= d
+        out += a               # denominator
+        F -= c2
+        F *= d
+        F += b                 # numerator
+    np.divide(F, out, out=out)    # R in notes
+    if shading is not None :
+        shaded *= shading[:, :, np.newaxis]  # skin color = reflectance * shading
+
+""" Several layers of cosmetic on top of each other, like foundation, then eye shadow, then blush """
+
+@prof.stage('renderLayers')
+def renderLayers(shading, skin, layers, out=None, dtype=np.float64, bandRows=32, workers=1) :
+    """
+    renderKM for a look made of several layers of cosmetic, done in one pass
+    shading and skin are as for renderKM
+    layers is a list of (csm, thickness) pairs from the layer next to the skin to the top layer,
+    csm and thickness are as for renderKM (thickness 0 is no cosmetic there)
+    out is an optional rows x columns x 3 array to put the result in (its dtype is then used)
+    The Kubelka-Munk layer combination R = RL + TL*TL*Rg / (1 - RL*Rg), with RL and TL the
+    reflectance and transmittance of a layer over black and Rg the reflectance under it, gives the
+    same R as the kmCosmetic formula with skin replaced by Rg.  So each band starts as skin and
+    each layer is put on it in turn, and shading is applied once at the end.  A layer that is
+    a thickness map is only done inside the bounding box of its nonzero thickness, so small
+    layers like eye shadow cost little.  Nothing image sized is made except out.
+    """
+    prepared = []
+    for csm, thickness in layers :
+        if not isinstance(csm, kmCosmetic) :
+            csm = kmCosmetic(csm, dtype if out is None else out.dtype)
+        thickness = np.asarray(thickness)
+        if thickness.ndim == 0 :
+            box = (0, 0, len(skin), np.shape(skin)[1])
+        else :
+            box = maskBox(thickness)
+        if box[2] > box[0] :
+            prepared.append((csm, thickness, box))
+    if out is None :
+        out = np.empty(np.shape(skin), dtype)
+    def band(row0, row1) :
+        R = out[row0:row1]
+        R[:] = skin[row0:row1]
+        for csm, thickness, box in prepared :
+            rows = slice(max(row0, box[0]), min(row1, box[2]))
+            if rows.start >= rows.stop :
+                continue
+            cols = slice(box[1], box[3])
+            part = R[rows.start - row0:rows.stop - row0, cols]
+            F, d = _workArrays('layers', part.shape, out.dtype, 2)
+            consts = csm.rows(rows.start, rows.stop, cols)
+            _renderBand(None, part, thickness if thickness.ndim == 0 else thickness[rows, cols],
+                        consts, part, F, d)
+        R *= shading[row0:row1, :, np.newaxis]  # skin color = reflectance * shading
+    runBands(len(out), band, bandRows, workers)
+    return out
+
+""" Caching of results that are used again, like the decomposition of a face that is
+    rendered with many cosmetics """
+
+def _nbytes(val) :
+    """ bytes held by the numpy arrays in val (an array, a tuple or list of them, or an object with them as attributes) """
+    if isinstance(val, np.ndarray) :
+        return val.nbytes
+    if isinstance(val, (tuple, list)) :
+        return sum(_nbytes(item) for item in val)
+    if hasattr(val, 'nbytes') :
+        return val.nbytes
+    if hasattr(val, '__dict__') :
+        return sum(_nbytes(item) for item in vars(val).values())
+    return 0
+
+class lruCache() :
+    """ a thread safe dictionary that holds at most maxItems entries and maxBytes bytes of numpy arrays
+        (None for no limit), the least recently used entries are dropped to make room """
+    def __init__(self, maxItems=16, maxBytes=None):
+        self.maxItems = maxItems
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = col.OrderedDict()  # key -> (value, nbytes), most recently used last
+        self._lock = threading.Lock()
+    def __len__(self):
+        return len(self._items)
+    def __contains__(self, key):
+        return key in self._items
+    def get(self, key, default=None):
+        with self._lock :
+            item = self._items.get(key)
+            if item is None :
+                self.misses = self.misses + 1
+                return default
+            self._items.move_to_end(key)
+            self.hits = self.hits + 1
+            return item[0]
+    def put(self, key, val, nbytes=None):
+        """ adds val under key, nbytes is its size (default is the size of its numpy arrays) """
+        if nbytes is None :
+            nbytes = _nbytes(val)
+        with self._lock :
+            old = self._items.pop(key, None)
+            if old is not None :
+                self.nbytes = self.nbytes - old[1]
+            self._items[key] = (val, nbytes)
+            self.nbytes = self.nbytes + nbytes
+            while len(self._items) > 1 and (len(self._items) > self.maxItems or
+                                            (self.maxBytes is not None and self.nbytes > self.maxBytes)) :
+                key, old = self._items.popitem(last=False)
+                self.nbytes = self.nbytes - old[1]
+    def getOrMake(self, key, make):
+        """ returns the value for key, calling make() and adding its result if there is none """
+        val = self.get(key)
+        if val is None :
+            val = make()
+            self.put(key, val)
+        return val
+    def clear(self):
+        with self._lock :
+            self._items.clear()
+            self.nbytes = 0
+
+def arrayKey(*arrs) :
+    """ a key for caching made from the contents, shapes and types of numpy arrays (None is allowed) """
+    digest = hl.sha1()
+    for arr in arrs :
+        if arr is None :
+            digest.update(b'none')
+            continue
+        arr = np.ascontiguousarray(arr)
+        digest.update(str((arr.shape, arr.dtype.str)).encode('ascii'))
+        digest.update(arr.data)
+    return digest.hexdigest()
+
+def arrayIdent(arr) :
+    """ a key for caching an array: read only arrays (like the ones decomposeFace returns) by identity,
+        which takes no time, others by their contents (see arrayKey).  The cache entry must keep arr so
+        its id is not used again by another array. """
+    arr = np.asarray(arr)
+    if arr.ndim == 0 or arr.size <= 64 :  # numbers and colors
+        return (arr.shape, arr.dtype.str, arr.tobytes())
+    if not arr.flags.writeable :
+        return ('id', id(arr), arr.shape, arr.dtype.str)
+    return arrayKey(arr)
+
+""" Decomposition of a face image into shading and skin reflectance """
+
+decomposedFace = col.namedtuple('decomposedFace', ['shading', 'skin', 'refAve'])
+decomposedFace.__doc__ = """ shading is a rows x columns array capturing the variation in light intensity on the face
+    (Yshad in notes), skin is a rows x columns x 3 array of linear BGR reflectance (RGBface in notes)
+    and refAve is the [B G R] Y weighted average skin reflectance.  The arrays are read only. """
+
+faceCache = lruCache(maxItems=8, maxBytes=2**30)  # decomposeFace results by image contents
+
+@prof.stage('decomposeFace')
+def decomposeFace(img, mask=None, Yskin=0.5, dtype=np.float64, cache=True) :
+    """
+    Simplified extraction of luminance variation and skin reflectance from an image
+    img is an sRGB BGR image (uint8 as read by cv.imread)
+    mask is an optional rows x columns array that is nonzero in the skin region refAve is taken from
+    (the whole image is used without it)
+    Yskin is a guess at the average skin neutral reflection, shading is 1.0 where the luminance is Yskin
+    dtype is the type of the arrays (np.float32 or np.float64)
+    cache is True to keep the results in faceCache, False not to cache, or an lruCache to use
+    so the same image is only decomposed once
+    returns a decomposedFace
+    """
+    if cache is True :
+        cache = faceCache
+    elif cache is False :
+        cache = None
+    if cache is not None :
+        key = ('face', arrayKey(img, mask), Yskin, np.dtype(dtype).str)
+        face = cache.get(key)
+        if face is not None :
+            return face
+    skin = toReflectanceImg(img[:, :, 0:3], dtype=dtype)  # sRGB(0 to 255) to RGB (0.0 to 1.0)
+    shading = np.dot(skin, np.array([0.07, 0.66, 0.33], dtype) / Yskin)  # conforms to Yshad definition in notes
+    if mask is None :
+        refAve = skin.reshape(-1, 3).sum(axis=0, dtype=np.float64) / shading.sum(dtype=np.float64)
+    else :
+        mask = np.asarray(mask) != 0
+        refAve = skin[mask].sum(axis=0, dtype=np.float64) / shading[mask].sum(dtype=np.float64)
+    skin.setflags(write=False)
+    shading.setflags(write=False)
+    refAve.setflags(write=False)
+    face = decomposedFace(shading, skin, refAve)
+    if cache is not None :
+        cache.put(key, face)
+    return face
+
+""" Rendering cosmetics that only cover a small part of the face (eye shadow, blush, lipstick) """
 
+def maskWindows(mask, tile=None) :
+    """ returns a list of windows (tuples of row and column slices) that cover the nonzero pixels of mask
+        tile None gives the bounding box of the pixels, a number gives the tile x tile blocks
+        inside the bounding box that have nonzero pixels """
+    box = maskBox(mask)
+    if box[2] == box[0] :
+        return []
+    if tile is None :
+        return [(slice(box[0], box[2]), slice(box[1], box[3]))]
+    windows = []
+    for row0 in range(box[0], box[2], tile) :
+        for col0 in range(box[1], box[3], tile) :
+            window = (slice(row0, min(row0 + tile, box[2])), slice(col0, min(col0 + tile, box[3])))
+            if np.any(mask[window]) :
+                windows.append(window)
+    return windows
+
+@prof.stage('renderRegion')
+def renderRegion(shading, skin, thickness, csm, base=None, mask=None, tile=None, scale=None,
+                 out=None, dtype=np.float64, bandRows=32, workers=1) :
+    """
+    renderKM for the part of the face the cosmetic is on, composited into a copy of base
+    shading, skin, thickness (a rows x columns array here) and csm are as for renderKM
+    base is the image the cosmetic is put on, by default the bare face shading * skin (which
+    is what renderKM gives where the thickness is 0).  If base is uint8 (like the original photo)
+    the rendered pixels are converted to sRGB after dividing them by scale (the [B G R] roll
+    over divisor, None for no scaling).
+    mask is nonzero where the cosmetic is, by default where thickness is not 0
+    tile None renders the bounding box of mask, a number renders only the tile x tile blocks
+    with mask pixels in them, which is better for scattered regions
+    out is an image to composite into in place instead of a copy of base, so nothing
+    image sized is made and the time taken goes with the size of the region instead of
+    the size of the image
+    returns the composited image
+    """
+    if not isinstance(csm, kmCosmetic) :
+        csm = kmCosmetic(csm, dtype)
+    thickness = np.asarray(thickness)
+    if mask is None :
+        mask = thickness
+    if out is None and base is None :
+        out = np.multiply(skin, np.asarray(shading)[:, :, np.newaxis], dtype=csm.dtype)
+    elif out is None :
+        out = np.array(base)
+    for window in maskWindows(mask, tile) :
+        rendered = renderKM(shading[window], skin[window], thickness[window], csm.crop(window),
+                            bandRows=bandRows, workers=workers)
+        if out.dtype == np.uint8 :
+            if scale is not None :
+                rendered /= scale
+            rendered = fromReflectanceImg(rendered)
+        inside = np.asarray(mask[window]) != 0
+        out[window][inside] = rendered[inside]
+    return out
+
+""" Rendering again when only the cosmetic thickness changes, like an opacity slider """
+
+class preparedRender() :
+    """ The part of renderKM for one face and one cosmetic that does not depend on the thickness,
+        d = skin - c (delta in notes, var in showFaceGen).  The cosmetic constants are kept in a
+        kmCosmetic, so a new thickness only needs F = exp(-thickness * (1 - c*c) / c), the two
+        multiply-adds of the numerator and denominator and the division.  Only d is made here,
+        shading, the thickness map and the cosmetic are kept as they are given. """
+    def __init__(self, shading, skin, csm, thickness=1.0, dtype=np.float32):
+        """ shading, skin and csm are as for renderKM
+            thickness is the thickness map (a number or rows x columns array) that render
+            multiplies by the opacity
+            dtype is the type of d and the result """
+        self.given = (skin, csm)  # not used, kept so prepareRender can look them up by identity
+        if not isinstance(csm, kmCosmetic) :
+            csm = kmCosmetic(csm, dtype)
+        self.shading = shading
+        self.csm = csm
+        self.thickness = np.asarray(thickness)
+        self.dtype = np.dtype(dtype)
+        self.d = np.empty(np.shape(skin), dtype)
+        def band(row0, row1) :
+            c = csm.csm if csm.csm.ndim < 3 else csm.csm[row0:row1]
+            np.subtract(skin[row0:row1], c, out=self.d[row0:row1])  # delta in notes
+        runBands(len(self.d), band)
+        self.d.setflags(write=False)
+        self.nbytes = self.d.nbytes  # the other arrays belong to the caller
+    @prof.stage('preparedRender.render')
+    def render(self, opacity=1.0, thickness=None, out=None, bandRows=32, workers=1):
+        """ returns the linear BGR image of the face with the cosmetic at thickness * opacity
+            (thickness defaults to the thickness map given when this was made)
+            out is an optional rows x columns x 3 array to put the result in """
+        thickness = self.thickness if thickness is None else np.asarray(thickness)
+        if out is None :
+            out = np.empty(self.d.shape, self.dtype)
+        def band(row0, row1) :
+            F, = _workArrays('prepared', out[row0:row1].shape, out.dtype, 1)
+            c, c2, a, b, negk = self.csm.rows(row0, row1)
+            _renderBand(self.shading[row0:row1], None, thickness if thickness.ndim == 0 else thickness[row0:row1],
+                        (c, c2, a, b, negk * opacity), out[row0:row1], F, self.d[row0:row1])
+        runBands(len(out), band, bandRows, workers)
+        return out
+
+renderCache = lruCache(maxItems=32, maxBytes=2**30)  # preparedRender objects of recent face and cosmetic pairs
+
+@prof.stage('prepareRender')
+def prepareRender(shading, skin, csm, thickness=1.0, dtype=np.float32, key=None, cache=True) :
+    """ returns a preparedRender for a face and cosmetic, the same one as last time if it is still in the cache
+        key identifies the (face, cosmetic, thickness map) combination, for example (face id, shade name).
+        By default it is made from the arrays with arrayIdent, so read only arrays (like the ones decomposeFace
+        returns) cost nothing to look up and others are hashed each call.
+        cache is True to use renderCache, False not to cache, or an lruCache to use """
+    if cache is True :
+        cache = renderCache
+    elif cache is False :
+        cache = None
+    make = lambda : preparedRender(shading, skin, csm, thickness, dtype)
+    if cache is None :
+        return make()
+    if key is None :
+        cosm = csm.csm if isinstance(csm, kmCosmetic) else np.asarray(csm, np.float64)
+        key = tuple(arrayIdent(arr) for arr in (shading, skin, cosm, thickness))  # the entry keeps them
+    return cache.getOrMake(('prepared', key, np.dtype(dtype).str), make)
+
+""" Rendering from look up tables.  Thickness maps from floodfillFunc and renorm hold 8 bit values
+    and skin reflectance comes from 8 bit sRGB, so for a cosmetic with one color each color of the
+    result before shading is one of 256 x 256 values that can be made once. """
+
+class kmLUT() :
+    """ Kubelka-Munk look up table for a cosmetic with one color.  For each color the table
+        holds R in notes for every 8 bit thickness value times thicknessScale and every
+        sRGB skin value. """
+    def __init__(self, csm, thicknessScale=1.0/255, dtype=np.float32):
+        """ csm is the [B G R] tuple with the reflectance of a very thick layer of cosmetic
+            thicknessScale is the thickness of a thickness map value of 1
+            (1.0/255 * opacity for the 0 to 254 maps from renorm) """
+        cosm = kmCosmetic(np.asarray(csm, np.float64).reshape(3))
+        self.csm = cosm.csm
+        self.thicknessScale = thicknessScale  # maxError is the largest error before shading
+        thick = np.arange(256.0)[:, np.newaxis, np.newaxis] * thicknessScale
+        skin = _toRefTable[np.newaxis, :, np.newaxis]
+        self.table = self._exact(cosm, thick, skin).astype(dtype)  # thickness x skin x color
+        # one flat (thickness * 256 + skin) table for each color
+        self._flat = np.ascontiguousarray(self.table.transpose(2, 0, 1)).reshape(3, -1)
+        self.nbytes = self.table.nbytes
+        # the largest error for linear skin values that are rounded to the nearest sRGB value,
+        # from the skin values half way between sRGB values
+        halfway = np.array([toReflectance(val) for val in np.clip(np.arange(256) + 0.5, 0, 255)])
+        low = np.array([toReflectance(val) for val in np.clip(np.arange(256) - 0.5, 0, 255)])
+        self.maxError = 0.0
+        for edge in (halfway, low) :
+            exact = self._exact(cosm, thick, edge[np.newaxis, :, np.newaxis])
+            self.maxError = max(self.maxError, float(np.abs(exact - self.table).max()))
+    @staticmethod
+    def _exact(cosm, thick, skin):
+        """ R in notes for thickness and skin arrays that broadcast to thickness x skin x 3 """
+        d = skin - cosm.csm
+        F = np.exp(thick * cosm.negk)
+        return (d * (F - cosm.c2) + cosm.b) / (d * cosm.csm * (F - 1) + cosm.a)
+    @prof.stage('kmLUT.render')
+    def render(self, shading, skin, thickness, out=None, bandRows=32, workers=1):
+        """ shading is as for renderKM
+            skin is an sRGB uint8 BGR image, or a linear BGR image that is rounded to sRGB values
+            thickness is an 8 bit thickness map (rows x columns integers 0 to 255) or one integer
+            out is an optional rows x columns x 3 array to put the result in
+            returns the linear BGR image of the face with the cosmetic, like renderKM with a
+            thickness of thickness * thicknessScale """
+        thickness = np.asarray(thickness)
+        if thickness.dtype.kind not in 'ui' :
+            raise ValueError('look up table rendering needs an integer thickness map')
+        if out is None :
+            out = np.empty(np.shape(skin), self.table.dtype)
+        def band(row0, row1) :
+            skinb = np.asarray(skin[row0:row1])
+            if skinb.dtype != np.uint8 :
+                skinb = fromReflectanceImg(skinb)
+            thick = thickness if thickness.ndim == 0 else thickness[row0:row1]
+            base = np.asarray(thick, np.int32) * 256
+            for idx in [0, 1, 2] :
+                out[row0:row1, :, idx] = self._flat[idx][base + skinb[:, :, idx]]
+            out[row0:row1] *= shading[row0:row1, :, np.newaxis]
+        runBands(len(out), band, bandRows, workers)
+        return out
+    def error(self, shading, skin, thickness):
+        """ returns the largest difference between render and the exact renderKM for these inputs """
+        exact = renderKM(shading, skin if np.asarray(skin).dtype != np.uint8 else toReflectanceImg(skin),
+                         np.asarray(thickness) * self.thicknessScale, self.csm)
+        return float(np.abs(self.render(shading, skin, thickness) - exact).max())
+
+lutCache = lruCache(maxItems=64, maxBytes=2**28)  # kmLUT tables by cosmetic and thickness scale
+
+@prof.stage('getKMTable')
+def getKMTable(csm, thicknessScale=1.0/255, dtype=np.float32, cache=True) :
+    """ returns the kmLUT for a cosmetic, made once and then kept in lutCache (or an lruCache given
+        as cache) so it is used again by later requests """
+    if cache is True :
+        cache = lutCache
+    elif cache is False :
+        return kmLUT(csm, thicknessScale, dtype)
+    key = ('lut', tuple(np.asarray(csm, np.float64).reshape(3)), float(thicknessScale), np.dtype(dtype).str)
+    return cache.getOrMake(key, lambda : kmLUT(csm, thicknessScale, dtype))
+
+""" Textured cosmetics made by tiling a swatch image with mirrored copies, so there are no seams """
+
+textureCache = lruCache(maxItems=16, maxBytes=2**28)  # mirrorTile blocks by swatch and scale
+
+def mirrorTile(swatch, scale, key=None, cache=True) :
+    """ returns the block that repeats in a mirror tiled texture: the swatch resized by scale
+        (pixels/inch in the selfie divided by pixels/inch in the swatch image) next to its left-right
+        flipped copy, above its up-down flipped copy and the copy flipped both ways
+        key identifies the swatch (by default its contents) and the blocks are kept in textureCache
+        (cache can be False or another lruCache) """
+    if cache is True :
+        cache = textureCache
+    elif cache is False :
+        cache = None
+    def make() :
+        nrow = max(1, int(scale * swatch.shape[0]))
+        ncol = max(1, int(scale * swatch.shape[1]))
+        patch = cv.resize(swatch, (ncol, nrow))  # cv.resize takes (width, height)
+        upper = np.concatenate([patch, cv.flip(patch, 1)], axis=1)
+        lower = np.concatenate([cv.flip(patch, 0), cv.flip(patch, -1)], axis=1)
+        block = np.concatenate([upper, lower], axis=0)
+        block.setflags(write=False)
+        return block
+    if cache is None :
+        return make()
+    if key is None :
+        key = arrayKey(swatch)
+    return cache.getOrMake(('mirror', key, float(scale)), make)
+
+@prof.stage('mirrorTexture')
+def mirrorTexture(swatch, scale, shape, window=None, key=None, cache=True) :
+    """ returns the texture made by tiling the resized swatch, flipping every other tile
+        up-down and left-right (like knitted.py), for an image with shape (rows, columns, ...)
+        window is an optional (row slice, column slice) of the image, and then only that part of
+        the texture is made, which is all that is needed to render a region of the face
+        scale, key and cache are as for mirrorTile """
+    block = mirrorTile(swatch, scale, key, cache)
+    if window is None :
+        window = (slice(0, shape[0]), slice(0, shape[1]))
+    rows = np.arange(shape[0])[window[0]] % block.shape[0]
+    cols = np.arange(shape[1])[window[1]] % block.shape[1]
+    return block[rows[:, np.newaxis], cols[np.newaxis, :]]
+
+""" Progressive rendering: a small preview first, then the full resolution image """
+
+pyramidCache = lruCache(maxItems=32, maxBytes=2**30)  # imagePyramid levels of recent faces, thickness maps and textures
+
+def pyramidLevels(shape, previewPixels=2**16) :
+    """ the number of pyramid levels needed for the smallest to have at most previewPixels pixels """
+    rows, cols = shape[0:2]
+    nlevels = 1
+    while rows * cols > previewPixels and min(rows, cols) >= 32 :
+        rows = (rows + 1) // 2
+        cols = (cols + 1) // 2
+        nlevels = nlevels + 1
+    return nlevels
+
+def imagePyramid(img, nlevels, cache=True) :
+    """ returns the list [img, img at half size, at a quarter size ...] nlevels long made with cv.pyrDown
+        cache is True to keep the smaller levels in pyramidCache, False not to cache, or an lruCache to use.
+        Read only arrays (like the ones decomposeFace returns) are looked up by identity, which takes
+        no time, other arrays by their contents (see arrayKey). """
+    if cache is True :
+        cache = pyramidCache
+    elif cache is False :
+        cache = None
+    img = np.asarray(img)
+    def make() :
+        levels = [img]
+        down = img if img.dtype in (np.uint8, np.float32, np.float64) else img.astype(np.float32)
+        for idx in range(1, nlevels) :
+            down = cv.pyrDown(down)
+            down.setflags(write=False)
+            levels.append(down)
+        return levels
+    if cache is None :
+        return make()
+    levels = cache.getOrMake(('pyramid', arrayIdent(img), img.shape, img.dtype.str, nlevels), make)  # keeps img
+    return [img] + levels[1:]
+
+def progressiveRender(shading, skin, thickness, csm, srgb=True, scale=None, previewPixels=2**16, step=2,
+                      cache=True, bandRows=32, workers=1) :
+    """
+    Renders the face with the cosmetic at increasing resolutions and yields (level, image) for each,
+    level 0 is the full resolution image and level n is 2**n times smaller each way.
+    The first image has at most previewPixels pixels, then every step levels are done up to level 0.
+    shading, skin, thickness (a number or rows x columns map) and csm (a [B G R] tuple, a textured
+    BGR array or a kmCosmetic of either) are as for renderKM.  The pyramids of the images are made with
+    imagePyramid and kept in cache (see imagePyramid), so the next shade on the same face starts
+    straight away.  Make thickness maps and textures read only to look them up in the cache by identity.
+    srgb gives sRGB images (see renderSRGB, scale is as for renderSRGB), otherwise linear BGR images
+    """
+    nlevels = pyramidLevels(np.shape(shading), previewPixels)
+    shadings = imagePyramid(shading, nlevels, cache)
+    skins = imagePyramid(skin, nlevels, cache)
+    thickness = np.asarray(thickness)
+    thicks = [thickness] * nlevels if thickness.ndim == 0 else imagePyramid(thickness, nlevels, cache)
+    cosm = csm.csm if isinstance(csm, kmCosmetic) else np.asarray(csm)
+    dtype = csm.dtype if isinstance(csm, kmCosmetic) else _floatType(skin)
+    if cosm.ndim < 3 :
+        cosmetics = [csm if isinstance(csm, kmCosmetic) else kmCosmetic(cosm, dtype)] * nlevels
+    else :
+        cosmetics = imagePyramid(cosm, nlevels, cache)
+    for level in list(range(nlevels - 1, 0, -step)) + [0] :
+        cos = cosmetics[level]
+        if not isinstance(cos, kmCosmetic) :
+            cos = kmCosmetic(cos, dtype)
+        if srgb :
+            img = renderSRGB(shadings[level], skins[level], thicks[level], cos, scale=scale,
+                             bandRows=bandRows, workers=workers)
+        else :
+            img = renderKM(shadings[level], skins[level], thicks[level], cos, dtype=dtype,
+                           bandRows=bandRows, workers=workers)
+        yield level, img
+
+def renderProgressive(shading, skin, thickness, csm, callback, **kwargs) :
+    """ progressiveRender that calls callback(level, image) for each image instead of yielding them
+        callback returning False stops the rendering (for example when another shade is picked)
+        the other arguments are as for progressiveRender, returns the last image made """
+    img = None
+    for level, img in progressiveRender(shading, skin, thickness, csm, **kwargs) :
+        if callback(level, img) is False :
+            break
+    return img
+
+""" Rendering many cosmetic shades on one face """
+
+def limitSkin(shading, refAve) :
+    """ prevents roll overs (shading * refAve > 1.0) in the simulated bare face
+        refAve is the [B G R] average skin reflectance
+        returns (refAve / maxRgb, maxRgb) where maxRgb is shading.max() * refAve limited to be at least 1.0 """
+    maxRgb = np.maximum(np.max(shading) * np.asarray(refAve, np.float64), 1.0)
+    return np.asarray(refAve) / maxRgb, maxRgb
+
+def rollOverScale(img) :
+    """ returns the maximum of each color of a linear BGR image limited to be at least 1.0,
+        dividing the image by it prevents roll overs when it is converted to sRGB """
+    return np.maximum(np.asarray(img).reshape(-1, 3).max(axis=0), 1.0)
+
+def iterShades(shading, skin, csms, thickness=1.0, thicknessMap=None, srgb=False, scale=None,
+               dtype=np.float64, chunk=4, bandRows=32, workers=1) :
+    """
+    Renders a number of cosmetic shades on one face, like calling renderKM for each, and yields
+    (shade number, image) for the shades in order
+    shading and skin are the decomposed face, as for renderKM
+    csms is a number of shades x 3 array of [B G R] reflectances of a very thick layer of each cosmetic
+    thickness is the thickness of the cosmetic layer, one number for all the shades or one for each shade
+    thicknessMap is an optional rows x columns numpy array the thickness is multiplied by
+    srgb gives sRGB uint8 images (see fromReflectanceImg) instead of linear BGR images of type dtype
+    scale is the roll over divisor for sRGB images, a [B G R] divisor, None for none, or 'auto'
+    for rollOverScale of each shade
+    chunk shades are rendered together, band by band on workers threads (see runBands),
+    so each band of the face is read once for all of them and at most chunk images are held
+    """
+    csms = np.asarray(csms, np.float64).reshape(-1, 3)
+    nshade = len(csms)
+    cosm = kmCosmetic(csms, dtype)  # constants of all the shades, computed once
+    consts = cosm.rows(0, 0)
+    thickness = np.broadcast_to(np.asarray(thickness, dtype), (nshade,))
+    for first in range(0, nshade, chunk) :
+        last = min(first + chunk, nshade)
+        imgs = np.empty((last - first,) + np.shape(skin), dtype)
+        def band(row0, row1) :
+            F, d = _workArrays('km', imgs[0, row0:row1].shape, imgs.dtype, 2)
+            for shade in range(first, last) :
+                thick = thickness[shade]
+                if thicknessMap is not None :
+                    thick = thicknessMap[row0:row1] * thick
+                _renderBand(shading[row0:row1], skin[row0:row1], np.asarray(thick),
+                            tuple(const[shade] for const in consts), imgs[shade - first, row0:row1], F, d)
+        runBands(len(skin), band, bandRows, workers)
+        for shade in range(first, last) :
+            img = imgs[shade - first]
+            if srgb :
+                div = rollOverScale(img) if isinstance(scale, str) and scale == 'auto' else scale
+                if div is not None :
+                    img /= div
+                img = fromReflectanceImg(img, bandRows=bandRows, workers=workers)
+            yield shade, img
+        del imgs
+
+@prof.stage('renderShades')
+def renderShades(shading, skin, csms, thickness=1.0, thicknessMap=None, srgb=False, scale=None,
+                 dtype=np.float64, chunk=4, bandRows=32, workers=1) :
+    """ the same as iterShades, but returns all the images as a number of shades x rows x columns x 3 array """
+    nshade = len(np.asarray(csms).reshape(-1, 3))
+    out = np.empty((nshade,) + np.shape(skin), np.uint8 if srgb else dtype)
+    for shade, img in iterShades(shading, skin, csms, thickness, thicknessMap, srgb, scale,
+                                 dtype, chunk, bandRows, workers) :
+        out[shade] = img
+    return out
+
+@prof.stage('cosmeticColors')
+def cosmeticColors(skin, csms, thickness=1.0, dtype=np.float64) :
+    """ returns the number of shades x 3 array of the linear BGR reflectance of each cosmetic shade
+        on skin of one [B G R] reflectance (like refAve when faceR is set to it in the drivers)
+        csms is a number of shades x 3 array of [B G R] reflectances of a very thick layer of each cosmetic
+        thickness is one number for all the shades or one for each shade
+        The face with shade n is then shading * colors[n], so many shades can be done at once. """
+    csms = np.asarray(csms, np.float64).reshape(1, -1, 3)
+    nshade = csms.shape[1]
+    skins = np.empty((1, nshade, 3), dtype)
+    skins[:] = skin
+    thick = np.empty((1, nshade), dtype)
+    thick[:] = thickness
+    return renderKM(np.ones((1, nshade), dtype), skins, thick, kmCosmetic(csms, dtype))[0]
+
+flatFace = col.namedtuple('flatFace', ['shading', 'refAve', 'maxRgb', 'shadingMax'])
+flatFace.__doc__ = """ a face for rendering with its skin set to one color, like the simulated bare face of
+    colorDriver.py: shading as decomposeFace returns it, refAve and maxRgb as limitSkin returns them
+    and shadingMax = shading.max() """
+
+def decomposeFlat(img, mask=None, Yskin=0.5, dtype=np.float64, cache=True) :
+    """ decomposeFace followed by limitSkin, returns a flatFace
+        img, mask, Yskin, dtype and cache are as for decomposeFace """
+    face = decomposeFace(img, mask, Yskin, dtype, cache)
+    refAve, maxRgb = limitSkin(face.shading, face.refAve)
+    return flatFace(face.shading, refAve, maxRgb, float(face.shading.max()))
+
+@prof.stage('flatShade')
+def flatShade(shading, color, scale=None, shadingMax=None, out=None, bandRows=32, workers=1) :
+    """ returns the sRGB image shading * color of a face whose skin has one color (see cosmeticColors),
+        done band by band so the linear image is never made
+        color is the [B G R] linear reflectance of the skin with the cosmetic on it
+        scale is the [B G R] roll over divisor, None for none, or 'auto' for rollOverScale of
+        shading * color, which is shadingMax * color limited to be at least 1.0 (shadingMax is
+        shading.max(), found here when it is not given)
+        out is an optional rows x columns x 3 array for the result (its dtype is used, see
+        fromReflectanceImg), by default a new uint8 image
+        the rows are done on workers threads (see runBands) """
+    color = np.asarray(color, _floatType(shading))
+    if isinstance(scale, str) and scale == 'auto' :
+        scale = np.maximum((np.max(shading) if shadingMax is None else shadingMax) * color, 1.0)
+    if scale is not None :
+        color = (color / scale).astype(color.dtype)
+    if out is None :
+        out = np.empty(np.shape(shading) + (3,), np.uint8)
+    def band(row0, row1) :
+        lin, = _workArrays('flat', out[row0:row1].shape, color.dtype, 1)
+        np.multiply(shading[row0:row1, :, np.newaxis], color, out=lin)
+        _fromReflectanceBand(lin, out[row0:row1])
+    runBands(len(out), band, bandRows, workers)
+    return out
+
+def iterFlatShades(shading, skin, csms, thickness=1.0, scale=None, shadingMax=None, dtype=np.float32,
+                   bandRows=32, workers=1) :
+    """ renders a number of cosmetic shades on a face whose skin has one color and yields
+        (shade number, sRGB uint8 image) for the shades in order
+        skin is the [B G R] skin reflectance (refAve of a flatFace), csms and thickness are as for
+        cosmeticColors, whose colors are found once in dtype for all the shades
+        scale and shadingMax are as for flatShade, 'auto' scales each shade by its own divisor """
+    if isinstance(scale, str) and scale == 'auto' and shadingMax is None :
+        shadingMax = np.max(shading)
+    for shade, color in enumerate(cosmeticColors(skin, csms, thickness, dtype)) :
+        yield shade, flatShade(shading, color, scale, shadingMax, bandRows=bandRows, workers=workers)
+
+@prof.stage('floodfill')
 def floodfill(img, pt, val) :
     """ img is a 0-255 monochrome image, 0 everywhere except at the boundary of the area to be filled with
         the constant alue val.  pt (row, column) is the starting point for the flood fill process.
-        img is modified. """
-    qq = col.deque()
-    img[pt[0], pt[1]] = val
-    addAdj(img, qq, val, pt)
-    while len(qq)> 0 :
-        center = qq.popleft()
-        addAdj(img, qq, val, center)
+        img is modified.  Returns the filled region and its bounding box (see fillRegion). """
+    region, box = fillRegion(img, pt)
+    img[region] = val
+    return region, box
+
+@prof.stage('fillRegion')
+def fillRegion(img, pt, connectivity=8) :
+    """ finds the area floodfill would fill without changing img
+        img is a monochrome image, 0 everywhere except at the boundary of the area.
+        pt (row, column) is the starting point, connectivity is 8 (diagonal neighbours are
+        connected, as in floodfill) or 4.
+        The fill is done a scanline run at a time by cv.floodFill, which stops at the image edges.
+        Returns (region, box) where region is a boolean image that is True in the area and
+        box is its bounding box (top row, left column, bottom row + 1, right column + 1) """
+    img = np.asarray(img)
+    if not (0 <= pt[0] < img.shape[0] and 0 <= pt[1] < img.shape[1]) :
+        raise ValueError('flood fill starting point %s is outside the image' % (tuple(pt),))
+    src = (img != 0).view(np.uint8)  # 1 at the boundary
+    src[pt[0], pt[1]] = 0  # the starting point is filled even if it is on the boundary
+    mask = np.zeros((img.shape[0] + 2, img.shape[1] + 2), np.uint8)
+    flags = connectivity | cv.FLOODFILL_MASK_ONLY | (1 << 8)  # mark the area with 1 in mask
+    nfill, src, mask, rect = cv.floodFill(src, mask, (int(pt[1]), int(pt[0])), 0, 0, 0, flags)
+    region = mask[1:-1, 1:-1].view(bool)
+    return region, (rect[1], rect[0], rect[1] + rect[3], rect[0] + rect[2])
 
 """ floodfillFunc calls the getVal method of the two classes below
     to fill an area with constant or non-constant values """
@@ -126,85 +1066,275 @@ class constVal() :
         self.val = val
     def getVal(self, pt):  # pt is (row, col)
         return self.val   # this class returns a constant value
+    def getVals(self, pts):  # pts is a number of points x 2 (row, col) array
+        return np.full(len(pts), self.val)   # getVal for all the points at once
 
 class featheredVal(constVal) :   # an extension of constVal that produces a feathered eye shadow thickness function
+    pwr = 0.3  # adjusts sharpness of drop to zero at top of eyelid - this value seems to work pretty well
+    falloff = 'power'  # how the thickness goes up with distance from the line (see featherThickness)
     def getLine(self, imfile):
         """ finds the pixels in the line above the eyelid and puts them in self.line
             imfile contains only the line at the top of the eyelid (value = 255) and 0 everywhere else
-            call this function before calling floodfillFunc
+            call this function (or setLine) before calling floodfillFunc
         """
-        srch = [(1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1)]
-        img = cv.imread(imfile, 0)
-        self.line = []
-        self.val = []
-        nrow = 0
-        for rows in img :
-            ncol = 0
-            for cols in rows :
-                if cols == 255 :
-                    self.line.append((nrow, ncol))
-                    for adj in srch :
-                        img[adj[0]+nrow, adj[1]+ncol] = 0   # cuts number of points in line
-                                                        # which speeds up minval calculation in getVal
-                    # does not check for out of image pixels which normally won't be a problem
-                ncol = ncol + 1
-            nrow = nrow + 1
+        self.setLine(cv.imread(imfile, 0))
         print(len(self.line))  # a diagnostic
+    def setLine(self, img):
+        """ getLine for an image that is already read """
+        self.lineImg = np.asarray(img) == 255
+        self.line = np.argwhere(self.lineImg)  # (row, col) of every line pixel
+        self.val = []
+        self.vals = []
+        self._dist = None
+    def distance(self):
+        """ the distance from every pixel to the nearest line pixel, found once by a distance transform """
+        if self._dist is None :
+            self._dist = lineDistance(self.lineImg)
+        return self._dist
     def getVal(self, pt):
         """ calculate an image value for each pixel during floodfillFunc execution
             The value is high at the bottom of the eyelid and goes to zero at the top
         """
-        pwr = 0.3  # adjusts sharpness of drop to zero at top of eyelid - this value seems to work pretty well
-        minval = (self.line[0][0]-pt[0])**2 + (self.line[0][1]-pt[1])**2
-        for ptl in self.line :  # gets the minimum distance between pt and line
-            dist = (ptl[0] - pt[0])**2 + (ptl[1] - pt[1])**2
-            if dist < minval :
-                minval = dist
-        minval = minval ** pwr
+        minval = featherFalloff(self.distance()[pt[0], pt[1]], self.falloff, self.pwr)
         self.val.append((pt, minval))  # ((y,x),minval)  # val contains the non-normalized eye shadow thickness values
         return 100  # this sets the pixels in the flood filled image area - any number > 0 will do
+    def getVals(self, pts):
+        """ getVal for a number of points x 2 (row, col) array of points, the points and their
+            values are kept as arrays in self.vals """
+        minval = featherFalloff(self.distance()[pts[:, 0], pts[:, 1]], self.falloff, self.pwr)
+        self.vals.append((pts, minval))
+        return np.full(len(pts), 100)
+    @prof.stage('featheredVal.renorm')
     def renorm(self, img):
         """ re-normalize values in eyelid thickness image to go from 0 to 254
             put them in img which could start off = 0 everywhere
             call this after calling floodfillFunc """
-        maxval = 0
-        for val in self.val :
-            if maxval < val[1] :
-                maxval = val[1]
-        for val in self.val :
-            pt = val[0]
-            val1 = val[1]
-            img[pt[0], pt[1]] = 254 * val1/maxval
+        pts = [np.array([val[0] for val in self.val]).reshape(-1, 2)] + [vals[0] for vals in self.vals]
+        vals = [np.array([val[1] for val in self.val])] + [vals[1] for vals in self.vals]
+        pts = np.concatenate(pts).astype(np.intp)
+        vals = np.concatenate(vals)
+        if len(vals) == 0 :
+            return
+        img[pts[:, 0], pts[:, 1]] = 254 * vals / vals.max()
+
+""" Feathering: thickness that goes up with distance from a line, like the eye shadow that is
+    thickest at the bottom of the eyelid and goes to zero at the line at the top """
 
+def maskBox(mask) :
+    """ returns the bounding box (top row, left column, bottom row + 1, right column + 1) of
+        the nonzero pixels of a monochrome image, (0, 0, 0, 0) if there are none """
+    mask = np.asarray(mask)
+    if mask.dtype != np.uint8 :
+        mask = (mask != 0).view(np.uint8)
+    col0, row0, ncol, nrow = cv.boundingRect(mask)
+    return (row0, col0, row0 + nrow, col0 + ncol)
+
+@prof.stage('lineDistance')
+def lineDistance(line) :
+    """ line is a monochrome image that is nonzero on a line
+        returns a float32 image of the exact Euclidean distance from each pixel to the nearest line pixel
+        (to float32 precision, so feathered values are within 1e-5 of scale of a search of every
+        line pixel for every pixel) """
+    far = (np.asarray(line) == 0).view(np.uint8)
+    return cv.distanceTransform(far, cv.DIST_L2, cv.DIST_MASK_PRECISE)
+
+def featherFalloff(dist, falloff='power', pwr=0.3) :
+    """ the non-normalized thickness at a distance dist (a number or numpy array) from the line
+        falloff is 'power' for dist ** (2 * pwr), which is featheredVal's
+        (squared distance) ** pwr, 'linear' for dist, 'smoothstep' for a curve that is
+        flat at the line and at the farthest distance, or a function of dist """
+    if callable(falloff) :
+        return falloff(dist)
+    dist = np.asarray(dist, np.float64)
+    if falloff == 'power' :
+        return dist ** (2 * pwr)
+    if falloff == 'linear' :
+        return dist
+    if falloff == 'smoothstep' :
+        frac = dist / max(dist.max(), 1e-12)
+        return frac * frac * (3 - 2 * frac)
+    raise ValueError('unknown feather falloff ' + str(falloff))
+
+@prof.stage('featherThickness')
+def featherThickness(region, line, out=None, falloff='power', pwr=0.3, scale=254) :
+    """ feathers a region in one pass
+        region is a monochrome image that is nonzero in the area to feather, like the region
+        returned by floodfill or fillRegion
+        line is a monochrome image that is nonzero on the line the thickness goes to zero at
+        (the line at the top of the eyelid)
+        out is the image the thickness is written into inside the region, by default a
+        new uint8 image that is 0 elsewhere, and floodfill images can be used
+        falloff and pwr are as for featherFalloff, the values are normalized to go from 0 to scale
+        The distances are only found inside the bounding box of the region and the line.
+        returns out """
+    region = np.asarray(region) != 0
+    line = np.asarray(line) != 0
+    if out is None :
+        out = np.zeros(region.shape, np.uint8)
+    rbox = maskBox(region)
+    lbox = maskBox(line)
+    if rbox[2] == rbox[0] :
+        return out
+    if lbox[2] == lbox[0] :
+        raise ValueError('there is no line to feather from')
+    box = (min(rbox[0], lbox[0]), min(rbox[1], lbox[1]), max(rbox[2], lbox[2]), max(rbox[3], lbox[3]))
+    window = (slice(box[0], box[2]), slice(box[1], box[3]))
+    inside = region[window]
+    vals = featherFalloff(lineDistance(line[window])[inside], falloff, pwr)
+    maxval = vals.max()
+    if maxval > 0 :
+        vals = vals * (scale / maxval)
+    out[window][inside] = vals
+    return out
+
+@prof.stage('floodfillFunc')
 def floodfillFunc(img, pt, func) :
     """ img is a 0-255 monochrome image, 0 everywhere except at the boundary of the area to be filled.
         This boundary is set to a value of 255.  It will be filled with values between 0 and 254 generated
         by the getVal(pt) method of func, which is either constVal or featheredVal.
         pt (row, column) is the starting point for the flood fill process.
-        img is modified. """
-    qq = col.deque()  # this is a more sophisticated list
-    val = func.getVal(pt)
-    img[pt[0], pt[1]] = val
-    addAdj(img, qq, val, pt)
-    while len(qq)> 0 :
-        center = qq.popleft()
-        addAdj(img, qq, func.getVal(center), center)
+        img is modified.  Returns the filled region and its bounding box (see fillRegion).
+        The area is found first, then if func has a getVals method it is called once with all
+        the points, otherwise getVal is called for each point. """
+    region, box = fillRegion(img, pt)
+    pts = np.argwhere(region[box[0]:box[2], box[1]:box[3]]) + [box[0], box[1]]
+    if hasattr(func, 'getVals') :
+        img[pts[:, 0], pts[:, 1]] = func.getVals(pts)
+    else :
+        for ptf in pts :
+            img[ptf[0], ptf[1]] = func.getVal((ptf[0], ptf[1]))
+    return region, box
 
 def addAdj(img, qq, val, center) :
     """ add img[:,:] == 0 points adjacent to center to qq,
         and set corresponding image points to val.
-        Does not check for points out of image
-        which normally will not be a problem.
+        Points out of the image are skipped.
     """
     srch = [(1,1),(1,0),(1,-1),(0,-1),(-1,-1),(-1,0),(-1,1),(0,1)]
     shifted = (0,0)
     for shift in srch :
         shifted = (center[0]+shift[0], center[1]+shift[1])
+        if not (0 <= shifted[0] < img.shape[0] and 0 <= shifted[1] < img.shape[1]) :
+            continue
         if img[shifted[0], shifted[1]] > 0 :
             continue
         img[shifted[0], shifted[1]] = val
         qq.append(shifted)    # strange things happen if you append [] to ()
 
+""" Masks from annotated images: outlines drawn in a few colors (eyelid, feather line, lips, cheeks)
+    are found with a color tolerance, the areas they enclose are filled without seed points, and the
+    masks are kept run length encoded or bit packed so masks for many photos take little space """
+
+class maskCode() :
+    """ a compact monochrome mask: the bounding box of its pixels and the mask inside the box,
+        either run length encoded ('rle', alternate runs of 0 and 1 along the rows starting with 0)
+        or bit packed ('bits', np.packbits).  Rle is best for filled areas and lines. """
+    def __init__(self, mask, box=None, method='rle'):
+        """ mask is a monochrome image that is nonzero in the mask (or just its box part if box is given),
+            box is (top row, left column, bottom row + 1, right column + 1), by default that of mask """
+        mask = np.asarray(mask) != 0
+        self.shape = mask.shape
+        if box is None :
+            box = maskBox(mask)
+            mask = mask[box[0]:box[2], box[1]:box[3]]
+        self.box = tuple(int(val) for val in box)
+        self.method = method
+        flat = mask.ravel()
+        self.area = int(np.count_nonzero(flat))
+        if method == 'bits' :
+            self.data = np.packbits(flat)
+        elif method == 'rle' :
+            edges = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+            edges = np.concatenate(([0], edges, [len(flat)]))
+            runs = np.diff(edges)
+            if len(flat) > 0 and flat[0] :
+                runs = np.concatenate(([0], runs))
+            self.data = runs.astype(np.uint16 if len(runs) == 0 or runs.max() < 2**16 else np.uint32)
+        else :
+            raise ValueError('unknown mask code method ' + str(method))
+        self.nbytes = self.data.nbytes
+    def crop(self):
+        """ returns the boolean mask inside the box """
+        rows = self.box[2] - self.box[0]
+        cols = self.box[3] - self.box[1]
+        if self.method == 'bits' :
+            flat = np.unpackbits(self.data, count=rows * cols).view(bool)
+        else :
+            flat = np.repeat(np.arange(len(self.data)) % 2 == 1, self.data)
+        return flat.reshape(rows, cols)
+    def decode(self, shape=None):
+        """ returns the boolean mask as a full image (shape defaults to that of the original image) """
+        mask = np.zeros(self.shape if shape is None else shape[0:2], bool)
+        mask[self.box[0]:self.box[2], self.box[1]:self.box[3]] = self.crop()
+        return mask
+    def point(self):
+        """ returns a (row, col) in the mask, like a floodfill seed point, or None if it is empty """
+        inside = np.flatnonzero(self.crop())
+        if len(inside) == 0 :
+            return None
+        cols = self.box[3] - self.box[1]
+        mid = inside[len(inside) // 2]
+        return (int(self.box[0] + mid // cols), int(self.box[1] + mid % cols))
+
+def lineRegions(line, minArea=1, method='rle') :
+    """ finds the areas enclosed by a line, without seed points
+        line is a monochrome image that is nonzero on the line (like eyelid.bmp)
+        Everything that can be reached from the image border without crossing the line (4 connected,
+        so diagonal steps through the line are not allowed) is outside, and each connected part of what
+        is left is a region (the line is not part of it, as with floodfill).
+        Only the bounding box of the line is searched, since nothing outside it can be enclosed.
+        returns a list of maskCode for the regions with at least minArea pixels, biggest first """
+    line = np.asarray(line)
+    lbox = maskBox(line)
+    if lbox[2] == lbox[0] :
+        return []
+    free = (line[lbox[0]:lbox[2], lbox[1]:lbox[3]] == 0).view(np.uint8)
+    padded = np.ones((free.shape[0] + 2, free.shape[1] + 2), np.uint8)  # a free border joins all the edges
+    padded[1:-1, 1:-1] = free
+    reach = np.zeros((padded.shape[0] + 2, padded.shape[1] + 2), np.uint8)
+    cv.floodFill(padded, reach, (0, 0), 0, 0, 0, 4 | cv.FLOODFILL_MASK_ONLY | (1 << 8))
+    enclosed = free & (reach[2:-2, 2:-2] == 0)
+    nlabel, labels, stats, centers = cv.connectedComponentsWithStats(enclosed.view(np.uint8), connectivity=8)
+    regions = []
+    for label in np.argsort(-stats[1:, cv.CC_STAT_AREA]) + 1 :
+        if stats[label, cv.CC_STAT_AREA] < minArea :
+            break
+        col0, row0, ncol, nrow = stats[label, 0:4]
+        code = maskCode(labels[row0:row0 + nrow, col0:col0 + ncol] == label,
+                        (lbox[0] + row0, lbox[1] + col0, lbox[0] + row0 + nrow, lbox[1] + col0 + ncol), method)
+        code.shape = line.shape[0:2]
+        regions.append(code)
+    return regions
+
+def colorLines(img, colors, tol=0) :
+    """ returns a dict of name -> boolean image of the pixels of img (a BGR image) within tol of each
+        [B G R] color in colors (a dict of name -> color), tol is the largest difference allowed in
+        any one of B, G and R, one number or a dict of name -> tol """
+    lines = col.OrderedDict()
+    for name, color in colors.items() :
+        ctol = tol[name] if isinstance(tol, dict) else tol
+        color = np.asarray(color, np.int32)
+        lines[name] = cv.inRange(img[:, :, 0:3], np.clip(color - ctol, 0, 255).astype(np.float64),
+                                 np.clip(color + ctol, 0, 255).astype(np.float64)) != 0
+    return lines
+
+def annotationMasks(img, colors, tol=0, minArea=1, method='rle') :
+    """
+    finds several color coded outlines in one annotated image and the areas they enclose
+    img is the annotated BGR image, colors is a dict of name -> [B G R] color of each outline
+    (for example {'eyelid': [0, 0, 255], 'lips': [255, 0, 0]}) and tol is as for colorLines
+    Lines that do not enclose anything (like the feather line at the top of the eyelid) only give a line.
+    returns (lines, regions) where lines is a dict of name -> maskCode of the line pixels and regions is
+    a dict of name -> list of maskCode of the areas the line encloses (see lineRegions), their box
+    attributes are the bounding boxes and decode() gives the masks
+    """
+    lines = col.OrderedDict()
+    regions = col.OrderedDict()
+    for name, line in colorLines(img, colors, tol).items() :
+        lines[name] = maskCode(line, method=method)
+        regions[name] = lineRegions(line, minArea, method)
+    return lines, regions
+
 """ get CIELAB difference """
 
 def fLAB(t) :
@@ -248,15 +1378,123 @@ def difLAB(BGR1, BGR2) :
     dLAB = dLAB ** 0.5
     return dLAB
 
+""" Whole image versions of fLAB, RGBtoLAB and difLAB.
+    The images are processed in chunks of rows so the temporary arrays stay small. """
 
+def _labMatrix() :
+    """ linear BGR to XYZ divided by the D65 white point, with the output in Y, X, Z order
+        so L* can be calculated last in place """
+    M = np.array([[0.4124, 0.3576, 0.1805],
+                  [0.2126, 0.7152, 0.0722],
+                  [0.0193, 0.1192, 0.9505]]) # RGB to XYZ, as in RGBtoLAB
+    M = M / np.array([[0.95047], [1.000], [1.08883]])  # Xn, Yn, Zn
+    return M[[1, 0, 2], ::-1].T  # Y X Z rows, B G R columns, transposed for img x M
 
+_labM = _labMatrix()
 
+def fLABImg(t, out=None) :
+    """ this defines the CIELAB nonlinearity for a numpy array t, out can be t """
+    delta = 6.0/29
+    delta2 = delta*delta
+    delta3 = delta*delta2
+    low = t <= delta3
+    lin = t[low] / (3 * delta2) + 4.0/29
+    out = np.cbrt(t, out=out)
+    out[low] = lin
+    return out
 
+@prof.stage('RGBtoLABImg')
+def RGBtoLABImg(img, out=None, dtype=np.float64, bandRows=32, workers=1) :
+    """ Converts a linear BGR numpy image (0-1 normalization, sRGB phosphors, colors along the
+    last axis, so a rows x columns x 3 image or a number of colors x 3 list)
+    to CIELAB with a D65 illuminant and 0-100 normalization, like RGBtoLAB does for one color
+    out is an optional array of the same shape to put the result in (its dtype is then used)
+    dtype is the result type when out is not given (np.float32 or np.float64)
+    bandRows rows (the first axis) are converted at a time on workers threads (see runBands) """
+    img = np.asarray(img)
+    if out is None :
+        out = np.empty(img.shape, dtype)
+    M = _labM.astype(out.dtype)
+    img1, out1 = _rowViews([img, out])
+    runBands(len(out1), lambda row0, row1 : _labBand(img1[row0:row1], out1[row0:row1], M), bandRows, workers)
+    return out
 
+def _labBand(img, out, M) :
+    np.matmul(img.astype(out.dtype, copy=False), M, out=out)
+    fLABImg(out, out=out)  # Y X Z
+    out[..., 1] -= out[..., 0]
+    out[..., 1] *= 500  # a*
+    np.subtract(out[..., 0], out[..., 2], out=out[..., 2])
+    out[..., 2] *= 200  # b*
+    out[..., 0] *= 116
+    out[..., 0] -= 16   # L*
 
+@prof.stage('difLABImg')
+def difLABImg(img1, img2, out=None, dtype=np.float64, bandRows=32, workers=1) :
+    """ calculates the CIELAB distance, 0-100 normalization, between each pair of colors in two
+    linear BGR numpy images of the same shape (0-1 normalization), like difLAB does for two colors
+    returns an image of differences with the shape of the images less the last (color) axis
+    out, dtype, bandRows and workers are as for RGBtoLABImg """
+    img1 = np.asarray(img1)
+    img2 = np.asarray(img2)
+    if out is None :
+        out = np.empty(img1.shape[0:-1], dtype)
+    M = _labM.astype(out.dtype)
+    out1 = out
+    if img1.ndim == 1 :  # two colors
+        img1, img2, out1 = img1[np.newaxis], img2[np.newaxis], out.reshape(1)
+    def band(row0, row1) :
+        lab1, lab2 = _workArrays('lab', img1[row0:row1].shape, out.dtype, 2)
+        _labBand(img1[row0:row1], lab1, M)
+        _labBand(img2[row0:row1], lab2, M)
+        lab1 -= lab2
+        lab1 *= lab1
+        np.sqrt(lab1.sum(axis=-1), out=out1[row0:row1])
+    runBands(len(out1), band, bandRows, workers)
+    return out
 
-
-
-
-
-
+@prof.stage('difLAB2000')
+def difLAB2000(LAB1, LAB2) :
+    """ calculates the CIEDE2000 color difference between CIELAB colors (0-100 normalization)
+    LAB1 and LAB2 are numpy arrays (or lists) with L*, a*, b* along the last axis, and
+    they are broadcast against each other, so one color can be compared with many
+    returns an array of differences with the shape of the broadcast colors less the last axis """
+    LAB1 = np.asarray(LAB1, np.float64)
+    LAB2 = np.asarray(LAB2, np.float64)
+    L1, a1, b1 = LAB1[..., 0], LAB1[..., 1], LAB1[..., 2]
+    L2, a2, b2 = LAB2[..., 0], LAB2[..., 1], LAB2[..., 2]
+    pow25 = 25.0 ** 7
+    Cbar7 = ((np.hypot(a1, b1) + np.hypot(a2, b2)) / 2) ** 7
+    G = 0.5 * (1 - np.sqrt(Cbar7 / (Cbar7 + pow25)))
+    a1p = (1 + G) * a1
+    a2p = (1 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+    gray = C1p * C2p == 0  # hue is undefined for a neutral color
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, np.where(dhp < -180, dhp + 360, dhp))
+    dhp = np.where(gray, 0.0, dhp)
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    dHp = 2 * np.sqrt(C1p * C2p) * np.sin(np.radians(dhp / 2))
+    Lbp = (L1 + L2) / 2
+    Cbp = (C1p + C2p) / 2
+    hsum = h1p + h2p
+    hbp = np.where(np.abs(h1p - h2p) <= 180, hsum / 2, np.where(hsum < 360, (hsum + 360) / 2, (hsum - 360) / 2))
+    hbp = np.where(gray, hsum, hbp)
+    T = (1 - 0.17 * np.cos(np.radians(hbp - 30)) + 0.24 * np.cos(np.radians(2 * hbp))
+         + 0.32 * np.cos(np.radians(3 * hbp + 6)) - 0.20 * np.cos(np.radians(4 * hbp - 63)))
+    dtheta = 30 * np.exp(-((hbp - 275) / 25) ** 2)
+    Cbp7 = Cbp ** 7
+    Rc = 2 * np.sqrt(Cbp7 / (Cbp7 + pow25))
+    Lb50 = (Lbp - 50) ** 2
+    Sl = 1 + 0.015 * Lb50 / np.sqrt(20 + Lb50)
+    Sc = 1 + 0.045 * Cbp
+    Sh = 1 + 0.015 * Cbp * T
+    Rt = -np.sin(np.radians(2 * dtheta)) * Rc
+    dL = dLp / Sl
+    dC = dCp / Sc
+    dH = dHp / Sh
+    return np.sqrt(dL * dL + dC * dC + dH * dH + Rt * dC * dH)
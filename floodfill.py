@@ -7,8 +7,8 @@ import colorLib as clib
 fname = 'eyelid.bmp'  # this image has upper and lower boundary lines that surround the entire eyelid
 fupper = 'eye1featherLine.bmp' # this image only contains the upper boundary line
 # both are single separation images.  The pixels in the line are 255; all the others are zero
-pt = (144,269)   # seed within the eyelid
 img = cv.imread(fname, 0)
+pt = clib.lineRegions(img)[0].point()   # seed within the eyelid, the biggest area the lines enclose
 img2 = np.copy(img)
 img3 = np.copy(img)
 
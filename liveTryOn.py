@@ -0,0 +1,344 @@
+import cv2 as cv
+import numpy as np
+import colorLib as clib
+import collections as col
+import threading as threading
+import queue as queue
+import argparse as ap
+import time as time
+
+""" Live try on for a webcam or a video.  Each frame goes through four stages, each in its own
+    thread: capture, decompose (shading and skin reflectance), render (Kubelka-Munk with the
+    cosmetic) and encode (jpeg or png bytes).  The stages are joined by short queues, so they
+    all work at once on different frames.  When a stage falls behind, the oldest frame waiting
+    for it is dropped, so the output stays close to live instead of lagging further and further.
+    The kmCosmetic constants are made once, and the average skin reflectance and the region
+    mask change slowly, so they are only found again every few frames. """
+
+def videoFrames(source=0, loop=False) :
+    """ yields the frames of a video file, or of a camera when source is a camera number
+        loop starts a video file again at the end, for testing """
+    cap = cv.VideoCapture(source)
+    if not cap.isOpened() :
+        raise IOError('cannot open video source ' + str(source))
+    try :
+        while True :
+            ok, frame = cap.read()
+            if not ok :
+                if not loop or isinstance(source, int) :
+                    return
+                cap.set(cv.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = cap.read()
+                if not ok :
+                    return
+            yield frame
+    finally :
+        cap.release()
+
+def syntheticFace(rows=480, cols=640) :
+    """ returns (linear BGR reflectance image, eyelid mask) of a made up face: an oval of skin
+        on a gray background with an eyelid shaped region, for testing without a camera """
+    yy, xx = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    yy = (yy - rows / 2.0) / (rows * 0.42)
+    xx = (xx - cols / 2.0) / (rows * 0.32)
+    oval = (xx * xx + yy * yy) < 1.0
+    refl = np.empty((rows, cols, 3), np.float32)
+    refl[:] = [0.25, 0.25, 0.25]
+    refl[oval] = [0.28, 0.36, 0.55]  # skin, B G R
+    texture = np.random.RandomState(0).normal(1.0, 0.03, (rows, cols)).astype(np.float32)
+    refl *= texture[:, :, np.newaxis]
+    mask = np.zeros((rows, cols), np.uint8)
+    center = (int(cols * 0.40), int(rows * 0.38))
+    axes = (max(1, int(rows * 0.09)), max(1, int(rows * 0.035)))
+    cv.ellipse(mask, center, axes, 0, 180, 360, 255, -1)  # upper half of an eye shaped ellipse
+    return refl, mask
+
+def syntheticFrames(rows=480, cols=640, count=300) :
+    """ yields count sRGB frames of syntheticFace lit by a light that moves from side to side
+        (count None for no end) """
+    refl, mask = syntheticFace(rows, cols)
+    xx = np.linspace(-1.0, 1.0, cols, dtype=np.float32)
+    lit = np.empty(refl.shape, np.float32)
+    frameNo = 0
+    while count is None or frameNo < count :
+        light = 0.85 + 0.3 * np.cos(xx - np.sin(frameNo * 0.05))  # shading across the face
+        np.multiply(refl, light[np.newaxis, :, np.newaxis], out=lit)
+        yield clib.fromReflectanceImg(lit)
+        frameNo = frameNo + 1
+
+def pacedFrames(frames, fps) :
+    """ yields the frames no faster than fps a second, like a camera """
+    period = 1.0 / fps
+    due = time.perf_counter()
+    for frame in frames :
+        wait = due - time.perf_counter()
+        if wait > 0 :
+            time.sleep(wait)
+        due = max(due + period, time.perf_counter() - period)
+        yield frame
+
+class stageTimer() :
+    """ the times taken by one stage for its last keep frames, and how many frames it did and dropped """
+    def __init__(self, name, keep=300):
+        self.name = name
+        self.times = col.deque(maxlen=keep)
+        self.count = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+    def add(self, secs):
+        with self._lock :
+            self.times.append(secs)
+            self.count = self.count + 1
+    def drop(self):
+        with self._lock :
+            self.dropped = self.dropped + 1
+    def summary(self):
+        """ returns a dict of the frame counts and the mean, median, 95th percentile and maximum times in ms """
+        with self._lock :
+            times = np.array(self.times) * 1000.0
+            result = {'count': self.count, 'dropped': self.dropped}
+        if len(times) > 0 :
+            result.update({'meanMs': float(times.mean()), 'p50Ms': float(np.percentile(times, 50)),
+                           'p95Ms': float(np.percentile(times, 95)), 'maxMs': float(times.max())})
+        return result
+
+class liveFrame() :
+    """ a frame going through the pipeline, with what the stages have found for it """
+    def __init__(self, frameNo, img):
+        self.frameNo = frameNo
+        self.img = img           # sRGB uint8 BGR frame, replaced by the rendered frame
+        self.start = time.perf_counter()
+        self.shading = None
+        self.skin = None         # rows x columns x 3 image of the average skin reflectance
+        self.color = None        # [B G R] of the cosmetic on the average skin, when that is the same everywhere
+        self.mask = None
+        self.thickness = None
+        self.encoded = None      # jpeg or png bytes
+
+_done = object()  # put on the queues after the last frame
+
+class _stageError() :
+    """ put on the queues in place of _done when a stage raises, run() raises the error again """
+    def __init__(self, error):
+        self.error = error
+
+class tryOnPipeline() :
+    """ renders a cosmetic on each frame of a video with capture, decompose, render and encode threads """
+    def __init__(self, csm, thickness=1.0, mask=None, maskFunc=None, maskEvery=30, refEvery=15,
+                 Yskin=0.5, scale=None, encode='.jpg', queueSize=2, dropFrames=True, workers=1):
+        """
+        csm is the [B G R] reflectance of a very thick layer of the cosmetic or a textured BGR array
+        the size of the frames (anything kmCosmetic accepts)
+        thickness is a number or a rows x columns thickness map
+        mask is a rows x columns array that is nonzero where the cosmetic goes (eye shadow, lipstick),
+        or None to cover the whole frame.  The cosmetic is then put on the camera frame itself.
+        maskFunc(frame) returns the mask for a frame, it is called every maskEvery frames and the
+        mask is used for the frames in between (the face does not move much in a few frames)
+        refEvery is how often the average skin reflectance refAve is found again, it is taken from
+        the mask region when there is one
+        Yskin is as for decomposeFace
+        scale is the [B G R] roll over divisor (see rollOverScale) or None for none
+        encode is the cv.imencode extension ('.jpg', '.png') or None to leave the frames unencoded
+        queueSize is the number of frames that can wait for each stage
+        dropFrames drops the oldest waiting frame when a stage falls behind, without it the
+        earlier stages wait instead, which is what is wanted when every frame of a file is needed
+        workers is the number of threads used for the bands of the decompose and render stages
+        """
+        self.cosmetic = csm if isinstance(csm, clib.kmCosmetic) else clib.kmCosmetic(csm, np.float32)
+        self.thickness = np.asarray(thickness, np.float32)
+        self.mask = mask
+        self.maskFunc = maskFunc
+        self.maskEvery = maskEvery
+        self.refEvery = refEvery
+        self.Yskin = Yskin
+        self.scale = scale
+        self.encode = encode
+        self.queueSize = queueSize
+        self.dropFrames = dropFrames
+        self.workers = workers
+        self.refAve = None
+        self.timers = col.OrderedDict((name, stageTimer(name))
+                                      for name in ('capture', 'decompose', 'render', 'encode', 'total'))
+        self._weights = (np.array([0.07, 0.66, 0.33], np.float32) / Yskin).reshape(1, 3)  # shading from linear BGR
+        self._uniform = self.thickness.ndim == 0 and self.cosmetic.csm.ndim < 3
+        self._skin = None
+        self._color = None
+        self._thickMap = None
+        self._stop = threading.Event()
+    def stop(self):
+        """ stops the capture, the frames already captured are still finished """
+        self._stop.set()
+    def _put(self, q, item, timer):
+        """ puts item on q, dropping the oldest waiting frame if q is full and frames are being dropped """
+        if item is _done or not self.dropFrames :
+            q.put(item)
+            return
+        while True :
+            try :
+                q.put_nowait(item)
+                return
+            except queue.Full :
+                try :
+                    q.get_nowait()
+                    timer.drop()
+                except queue.Empty :
+                    pass
+    def _capture(self, frames, out):
+        frameNo = 0
+        try :
+            it = iter(frames)
+            while not self._stop.is_set() :
+                start = time.perf_counter()
+                img = next(it, None)
+                if img is None :
+                    break
+                frame = liveFrame(frameNo, img)
+                self.timers['capture'].add(time.perf_counter() - start)
+                self._put(out, frame, self.timers['decompose'])
+                frameNo = frameNo + 1
+        except Exception as err :  # a camera or file that fails, run() raises it
+            out.put(_stageError(err))
+            return
+        out.put(_done)
+    def _stage(self, name, func, inq, out, nextName):
+        timer = self.timers[name]
+        while True :
+            frame = inq.get()
+            if frame is _done or isinstance(frame, _stageError) :
+                out.put(frame)
+                return
+            start = time.perf_counter()
+            try :
+                func(frame)
+            except Exception as err :  # passed on so run() raises it instead of waiting for frames
+                out.put(_stageError(err))
+                return
+            timer.add(time.perf_counter() - start)
+            self._put(out, frame, self.timers[nextName])
+    def _decompose(self, frame):
+        """ finds the shading of the frame, and the mask and skin reflectance when they are due """
+        rows, cols = frame.img.shape[0:2]
+        lin = clib.toReflectanceImg(frame.img[:, :, 0:3], dtype=np.float32, workers=self.workers)
+        frame.shading = cv.transform(lin, self._weights)  # Yshad in notes, much faster than np.dot for float32
+        if self.maskFunc is not None and frame.frameNo % self.maskEvery == 0 :
+            self.mask = self.maskFunc(frame.img)
+            self._thickMap = None
+            self.refAve = None
+        if self.mask is not None and self._thickMap is None :
+            if self.thickness.ndim == 0 :
+                self._thickMap = (np.asarray(self.mask) != 0) * self.thickness
+            else :
+                self._thickMap = self.thickness
+        if self.refAve is None or frame.frameNo % self.refEvery == 0 :
+            if self.mask is None :
+                refAve = lin.reshape(-1, 3).sum(axis=0, dtype=np.float64) / frame.shading.sum(dtype=np.float64)
+            else :
+                inside = np.asarray(self.mask) != 0
+                refAve = lin[inside].sum(axis=0, dtype=np.float64) / frame.shading[inside].sum(dtype=np.float64)
+            refAve, maxRgb = clib.limitSkin(frame.shading, refAve)
+            skin = np.empty((rows, cols, 3), np.float32)  # a new array, frames being rendered keep the old one
+            skin[:] = refAve
+            if self._uniform :  # the cosmetic covered skin has one color, only the shading changes
+                self._color = clib.cosmeticColors(refAve, self.cosmetic.csm, self.thickness, np.float32)[0]
+            self.refAve = refAve
+            self._skin = skin
+        frame.skin = self._skin
+        frame.color = self._color
+        frame.mask = self.mask
+        frame.thickness = self.thickness if self.mask is None else self._thickMap
+    def _render(self, frame):
+        if frame.mask is None and frame.color is not None :
+            frame.img = clib.flatShade(frame.shading, frame.color, self.scale, workers=self.workers)
+        elif frame.mask is None :
+            frame.img = clib.renderSRGB(frame.shading, frame.skin, frame.thickness, self.cosmetic,
+                                        scale=self.scale, workers=self.workers)
+        else :
+            frame.img = clib.renderRegion(frame.shading, frame.skin, frame.thickness, self.cosmetic,
+                                          mask=frame.mask, scale=self.scale, out=np.array(frame.img),
+                                          workers=self.workers)
+        frame.shading = frame.skin = frame.thickness = None  # not needed any more
+    def _encode(self, frame):
+        if self.encode is not None :
+            ok, buf = cv.imencode(self.encode, frame.img)
+            if not ok :  # passed on to run() as a stage error
+                raise ValueError('cannot encode frame %d as %s' % (frame.frameNo, self.encode))
+            frame.encoded = buf.tobytes()
+    def run(self, frames):
+        """ yields the finished liveFrame objects (frameNo, img, encoded) for frames, an iterable of
+            sRGB BGR uint8 images like videoFrames or syntheticFrames.  Frames that were dropped are skipped.
+            An exception raised by a stage (or by frames) stops the pipeline and is raised here. """
+        self._stop.clear()
+        queues = [queue.Queue(self.queueSize) for idx in range(4)]
+        threads = [threading.Thread(target=self._capture, args=(frames, queues[0])),
+                   threading.Thread(target=self._stage, args=('decompose', self._decompose, queues[0], queues[1], 'render')),
+                   threading.Thread(target=self._stage, args=('render', self._render, queues[1], queues[2], 'encode')),
+                   threading.Thread(target=self._stage, args=('encode', self._encode, queues[2], queues[3], 'total'))]
+        for thread in threads :
+            thread.daemon = True
+            thread.start()
+        try :
+            while True :
+                frame = queues[3].get()
+                if frame is _done :
+                    break
+                if isinstance(frame, _stageError) :
+                    raise frame.error
+                self.timers['total'].add(time.perf_counter() - frame.start)
+                yield frame
+        finally :
+            self.stop()
+            while any(thread.is_alive() for thread in threads) :
+                for q in queues :  # let stages waiting to put finish
+                    try :
+                        while True :
+                            q.get_nowait()
+                    except queue.Empty :
+                        pass
+                    try :
+                        q.put_nowait(_done)  # and stages waiting for a frame, their _done may have been taken
+                    except queue.Full :
+                        pass
+                time.sleep(0.001)
+    def stats(self):
+        """ returns a dict of stageTimer summaries by stage, total is capture to the end of encode """
+        return col.OrderedDict((name, timer.summary()) for name, timer in self.timers.items())
+
+if __name__ == '__main__' :
+    parser = ap.ArgumentParser(description='live try on of a cosmetic with a camera, a video or made up frames')
+    parser.add_argument('--camera', type=int, default=None, help='camera number')
+    parser.add_argument('--video', default=None, help='video file')
+    parser.add_argument('--frames', type=int, default=300, help='number of made up frames when there is no camera or video')
+    parser.add_argument('--size', type=int, nargs=2, default=[480, 640], help='rows and columns of made up frames')
+    parser.add_argument('--fps', type=float, default=30.0, help='frame rate of made up frames (0 for as fast as possible)')
+    parser.add_argument('--shade', type=float, nargs=3, default=[0.5, 0.3, 0.3], help='B G R reflectance of the cosmetic')
+    parser.add_argument('--thickness', type=float, default=0.5, help='thickness of the cosmetic')
+    parser.add_argument('--eyelid', action='store_true', help='put the cosmetic on the eyelid of the made up face only')
+    parser.add_argument('--keep', action='store_true', help='keep every frame instead of dropping frames')
+    parser.add_argument('--workers', type=int, default=1, help='threads for each of the decompose and render stages')
+    parser.add_argument('--show', action='store_true', help='show the frames')
+    args = parser.parse_args()
+    mask = None
+    if args.camera is not None :
+        frames = videoFrames(args.camera)
+    elif args.video is not None :
+        frames = videoFrames(args.video)
+    else :
+        frames = syntheticFrames(args.size[0], args.size[1], args.frames)
+        if args.fps > 0 :
+            frames = pacedFrames(frames, args.fps)
+        if args.eyelid :
+            mask = syntheticFace(args.size[0], args.size[1])[1]
+    pipeline = tryOnPipeline(args.shade, args.thickness, mask=mask, dropFrames=not args.keep, workers=args.workers)
+    start = time.perf_counter()
+    nframe = 0
+    for frame in pipeline.run(frames) :
+        nframe = nframe + 1
+        if args.show :
+            cv.imshow('try on', frame.img)
+            if cv.waitKey(1) & 0xff == ord('q') :
+                pipeline.stop()
+    secs = time.perf_counter() - start
+    print('frames shown', nframe, 'in', round(secs, 2), 's,', round(nframe / max(secs, 1e-9), 1), 'frames/s')
+    for name, summary in pipeline.stats().items() :
+        print(name, ', '.join('%s %s' % (key, round(val, 2) if isinstance(val, float) else val)
+                              for key, val in summary.items()))
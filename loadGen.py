@@ -0,0 +1,142 @@
+import cv2 as cv
+import numpy as np
+import argparse as ap
+import asyncio as asyncio
+import json as json
+import time as time
+
+""" Load generator for renderService.py.  It uploads a face, then keeps a number of connections
+    busy with render requests for random shades and reports the throughput and the latency
+    percentiles, so a change to the service or to colorLib can be measured on one machine.
+    Requests for a shade already asked for are usually answered from the image cache, so the
+    latencies of first requests (misses) and repeats (hits) are reported apart; --unique makes
+    every request a new shade to measure rendering alone. """
+
+async def request(reader, writer, method, path, body=b'', ctype='application/json') :
+    """ sends one HTTP request on an open connection, returns (status, body) """
+    head = '%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n' % (
+        method, path, ctype, len(body))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True :
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b'') :
+            break
+        name, val = line.decode('latin-1').split(':', 1)
+        if name.strip().lower() == 'content-length' :
+            length = int(val)
+    return status, await reader.readexactly(length)
+
+async def connect(host, port, unix) :
+    if unix is not None :
+        return await asyncio.open_unix_connection(unix)
+    return await asyncio.open_connection(host, port)
+
+async def client(host, port, unix, faceId, shades, count, thickness, fmt, seed, latencies, errors,
+                 seen, unique=False) :
+    """ one connection sending count render requests one after another.  latencies gets
+        (seconds, repeat) pairs, repeat is True when the shade was asked for before, seen holds
+        the shades asked for by all the connections.  With unique each request is a new color. """
+    reader, writer = await connect(host, port, unix)
+    rand = np.random.RandomState(seed)
+    try :
+        for idx in range(count) :
+            req = {'face': faceId, 'thickness': thickness, 'format': fmt}
+            if unique :  # off the 0.001 grid of the shade list so it is never cached
+                shade = [round(val, 6) for val in rand.uniform(0.05, 0.9, 3)]
+            else :
+                shade = shades[rand.randint(len(shades))]
+            key = str(shade)
+            repeat = key in seen
+            seen.add(key)
+            if isinstance(shade, str) :
+                req['shade'] = shade
+            else :
+                req['bgr'] = shade
+            start = time.perf_counter()
+            status, body = await request(reader, writer, 'POST', '/render', json.dumps(req).encode('utf-8'))
+            latencies.append((time.perf_counter() - start, repeat))
+            if status != 200 :
+                errors.append(body.decode('utf-8', 'replace'))
+    finally :
+        writer.close()
+
+def percentiles(ms, name='') :
+    """ latency percentiles in ms keyed p50Ms ... maxMs, or missP50Ms ... when name is 'miss' """
+    keys = [name + key[0].upper() + key[1:] if name else key for key in ('p50Ms', 'p95Ms', 'p99Ms', 'maxMs')]
+    if len(ms) == 0 :
+        return {}
+    return dict(zip(keys, [float(val) for val in np.percentile(ms, [50, 95, 99, 100])]))
+
+async def run(args) :
+    if args.face is not None :
+        with open(args.face, 'rb') as fi :
+            data = fi.read()
+    else :
+        import liveTryOn as live  # made up face
+        ok, buf = cv.imencode('.png', next(live.syntheticFrames(args.size[0], args.size[1], 1)))
+        data = buf.tobytes()
+    reader, writer = await connect(args.host, args.port, args.unix)
+    status, body = await request(reader, writer, 'POST', '/faces', data, 'application/octet-stream')
+    if status != 200 :
+        raise IOError('face upload failed: ' + body.decode('utf-8', 'replace'))
+    faceId = json.loads(body.decode('utf-8'))['face']
+    if args.names is not None :
+        with open(args.names) as fi :
+            shades = [line.strip() for line in fi if line.strip()]
+    else :
+        rand = np.random.RandomState(1)
+        shades = [[round(val, 3) for val in rand.uniform(0.05, 0.9, 3)] for idx in range(args.shades)]
+    latencies = []
+    errors = []
+    seen = set()
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args.host, args.port, args.unix, faceId, shades, args.requests,
+                                  args.thickness, args.format, seed, latencies, errors, seen, args.unique)
+                           for seed in range(args.connections)])
+    secs = time.perf_counter() - start
+    status, body = await request(reader, writer, 'GET', '/stats')
+    writer.close()
+    ms = np.array([lat for lat, repeat in latencies]) * 1000.0
+    repeats = np.array([repeat for lat, repeat in latencies], bool)
+    result = {'requests': len(latencies), 'errors': len(errors), 'seconds': secs,
+              'perSecond': len(latencies) / secs, 'misses': int((~repeats).sum()), 'hits': int(repeats.sum()),
+              'service': json.loads(body.decode('utf-8'))}
+    for name, sel in (('', slice(None)), ('miss', ~repeats), ('hit', repeats)) :
+        result.update(percentiles(ms[sel], name))
+    if len(errors) > 0 :
+        result['firstError'] = errors[0]
+    return result
+
+if __name__ == '__main__' :
+    parser = ap.ArgumentParser(description='load generator for renderService.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8350)
+    parser.add_argument('--unix', default=None, help='Unix socket path of the service')
+    parser.add_argument('--face', default=None, help='selfie to upload (default is a made up face)')
+    parser.add_argument('--size', type=int, nargs=2, default=[480, 640], help='rows and columns of the made up face')
+    parser.add_argument('--names', default=None, help='file of catalog shade names, one a line (default is random colors)')
+    parser.add_argument('--shades', type=int, default=200, help='number of random shades')
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=50, help='requests on each connection')
+    parser.add_argument('--thickness', type=float, default=8.0)
+    parser.add_argument('--format', default='.jpg')
+    parser.add_argument('--unique', action='store_true', help='a new random color for every request, so none is cached')
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+    result = asyncio.run(run(args))
+    for key in ('requests', 'errors', 'seconds', 'perSecond', 'misses', 'hits') :
+        print(key, round(result[key], 2) if isinstance(result[key], float) else result[key])
+    for name in ('', 'miss', 'hit') :
+        for key in ('p50Ms', 'p95Ms', 'p99Ms', 'maxMs') :
+            key = name + key[0].upper() + key[1:] if name else key
+            if key in result :
+                print(key, round(result[key], 2))
+    print('service', json.dumps(result['service']))
+    if 'firstError' in result :
+        print('first error', result['firstError'])
+    if args.json is not None :
+        with open(args.json, 'w') as fo :
+            json.dump(result, fo, indent=2)
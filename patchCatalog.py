@@ -0,0 +1,217 @@
+import cv2 as cv
+import numpy as np
+import colorLib as clib
+import shadeCatalog as scat
+import concurrent.futures as cf
+import argparse as ap
+import hashlib as hl
+import json as json
+import os as os
+import tarfile as tarfile
+import zipfile as zipfile
+import zlib as zlib
+
+""" This makes the rgb.txt file of cosmetic names and reflectances for a directory of cosmetic
+    patch images without a file browser.  The patches are read by a pool of processes and the
+    results are written out as each one finishes.  What was found is kept in a state file in the
+    same directory so that patches that have not changed are not read again on the next run.
+    The patches can also be read straight out of a zip or tar archive (like Sephora.zip) without
+    extracting it.  Archive members are decoded in memory, and members whose name and CRC are the
+    same as last time are not read again. """
+
+stateName = '.rgbstate.json'  # kept in the patch directory next to rgb.txt, or next to the archive
+
+def isArchive(path) :
+    """ True if path is a zip or tar file (tar files can be compressed) """
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+def statePath(imdir) :
+    """ the state file for a patch directory or archive """
+    if os.path.isdir(imdir) :
+        return os.path.join(imdir, stateName)
+    return imdir + stateName
+
+def outputPath(imdir, outName='rgb.txt') :
+    """ the rgb.txt file for a patch directory (inside it) or archive (next to it, Sephora-rgb.txt) """
+    if os.path.isdir(imdir) :
+        return os.path.join(imdir, outName)
+    base = os.path.splitext(imdir)[0]
+    if base.endswith('.tar') :  # .tar.gz, .tar.bz2 and .tar.xz
+        base = base[0:-4]
+    return base + '-' + outName
+
+def loadState(imdir, percentile=None) :
+    """ returns the patch records saved by the last run in imdir (a directory or archive)
+        (file name -> {'mtime', 'size', 'hash', 'bgr'}, or member name -> {'crc', 'size', 'bgr'}
+        for archives), or an empty dict if there are none or they were made with a different percentile """
+    try :
+        with open(statePath(imdir)) as fi :
+            state = json.load(fi)
+    except (IOError, ValueError) :
+        return {}
+    if state.get('percentile') != percentile :
+        return {}
+    return state.get('patches', {})
+
+def saveState(imdir, patches, percentile=None) :
+    """ writes the patch records for the next run.  The file is replaced in one step
+        so an interrupted run leaves the previous state intact """
+    name = statePath(imdir)
+    with open(name + '.tmp', 'w') as fo :
+        json.dump({'percentile': percentile, 'patches': patches}, fo)
+    os.replace(name + '.tmp', name)
+
+def patchColor(path, oldHash=None, percentile=None) :
+    """ reads the patch image file at path and returns (content hash, [B G R] reflectance)
+        the reflectance is None when the content hash equals oldHash,
+        which means the earlier result can be used.  This runs in the worker processes """
+    with open(path, 'rb') as fi :
+        data = fi.read()
+    digest = hl.sha1(data).hexdigest()
+    if digest == oldHash :
+        return digest, None
+    return digest, decodePatchColor(data, path, percentile)
+
+def decodePatchColor(data, name, percentile=None) :
+    """ decodes the bytes of a patch image file and returns its [B G R] reflectance
+        name is only used in the error message.  This runs in the worker processes """
+    img = cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_COLOR)
+    if img is None :
+        raise ValueError('cannot decode patch image ' + name)
+    return [float(val) for val in clib.getPatchColor(img, percentile)]
+
+def iterPatchColors(imdir, state, ext='.jpg', workers=None, percentile=None) :
+    """ yields (name, [B G R] reflectance, read) for every patch image in imdir as soon as it is known.
+        name is the file name without the extension and read is False when the earlier result was used.
+        state holds the records from the last run (see loadState) and is brought up to date,
+        records for files that are gone are removed.
+        Patches with the same modification time and size as last time are not opened,
+        the others are read by a pool of workers processes (None uses all the cpus) and
+        only decoded when their content hash has changed. """
+    files = sorted(fname for fname in os.listdir(imdir) if fname.endswith(ext))
+    for fname in set(state) - set(files) :
+        del state[fname]
+    todo = []
+    for fname in files :
+        info = os.stat(os.path.join(imdir, fname))
+        rec = state.get(fname)
+        if rec is not None and rec['mtime'] == info.st_mtime and rec['size'] == info.st_size :
+            yield fname[0:-len(ext)], rec['bgr'], False
+        else :
+            todo.append((fname, info, rec))
+    if len(todo) == 0 :
+        return
+    with cf.ProcessPoolExecutor(workers) as pool :
+        jobs = {}
+        for fname, info, rec in todo :
+            oldHash = None if rec is None else rec['hash']
+            job = pool.submit(patchColor, os.path.join(imdir, fname), oldHash, percentile)
+            jobs[job] = (fname, info, rec)
+        for job in cf.as_completed(jobs) :
+            fname, info, rec = jobs[job]
+            try :
+                digest, bgr = job.result()
+            except (IOError, ValueError) as err :
+                print(err)
+                state.pop(fname, None)
+                continue
+            read = bgr is not None
+            if not read :
+                bgr = rec['bgr']
+            state[fname] = {'mtime': info.st_mtime, 'size': info.st_size, 'hash': digest, 'bgr': bgr}
+            yield fname[0:-len(ext)], bgr, read
+
+def archiveMembers(path, ext='.jpg') :
+    """ yields (member name, CRC, size, read) for the patch images in a zip or tar archive, where
+        read() returns the bytes of the member.  Zip files hold the CRC of each member, for tar files
+        it is worked out from the bytes, which are then kept for read() """
+    if zipfile.is_zipfile(path) :
+        with zipfile.ZipFile(path) as zf :
+            for info in zf.infolist() :
+                if not info.is_dir() and info.filename.endswith(ext) :
+                    yield info.filename, info.CRC, info.file_size, lambda info=info : zf.read(info)
+        return
+    with tarfile.open(path) as tf :
+        for info in tf :
+            if info.isfile() and info.name.endswith(ext) :
+                data = tf.extractfile(info).read()
+                yield info.name, zlib.crc32(data) & 0xffffffff, info.size, lambda data=data : data
+
+def iterArchiveColors(path, state, ext='.jpg', workers=None, percentile=None, maxPending=None) :
+    """ yields (name, [B G R] reflectance, read) for every patch image in a zip or tar archive as soon
+        as it is known, like iterPatchColors for a directory.  name is the member name without the extension.
+        Members with the same name, CRC and size as in state are not read, the others are read from
+        the archive and decoded in memory by a pool of workers processes.  At most maxPending members
+        (default 4 per worker) are held in memory waiting for a worker. """
+    if workers is None :
+        workers = os.cpu_count() or 1
+    if maxPending is None :
+        maxPending = 4 * workers
+    seen = set()
+    with cf.ProcessPoolExecutor(workers) as pool :
+        jobs = {}
+        def finished(wait) :
+            done, notDone = cf.wait(jobs, return_when=cf.FIRST_COMPLETED if wait else cf.ALL_COMPLETED)
+            for job in done :
+                name, crc, size = jobs.pop(job)
+                try :
+                    bgr = job.result()
+                except ValueError as err :
+                    print(err)
+                    state.pop(name, None)
+                    continue
+                state[name] = {'crc': crc, 'size': size, 'bgr': bgr}
+                yield name[0:-len(ext)], bgr, True
+        for name, crc, size, read in archiveMembers(path, ext) :
+            seen.add(name)
+            rec = state.get(name)
+            if rec is not None and rec.get('crc') == crc and rec.get('size') == size :
+                yield name[0:-len(ext)], rec['bgr'], False
+                continue
+            jobs[pool.submit(decodePatchColor, read(), path + '/' + name, percentile)] = (name, crc, size)
+            if len(jobs) >= maxPending :
+                for result in finished(True) :
+                    yield result
+        while len(jobs) > 0 :
+            for result in finished(False) :
+                yield result
+    for name in set(state) - seen :
+        del state[name]
+
+def buildCatalog(imdir, ext='.jpg', workers=None, percentile=None, outName='rgb.txt') :
+    """ makes outName (rgb.txt) in imdir, or next to it if imdir is a zip or tar archive (see outputPath).
+        The first line is the directory (or archive) path, the rest of the lines hold cosmetic names
+        and RGB reflectances for all the cosmetic patches sorted by name, so the lines (and the
+        shade numbers taken from them) stay the same however the workers finish.
+        Returns the number of patches that had to be read. """
+    state = loadState(imdir, percentile)
+    nread = 0
+    if isArchive(imdir) :
+        colors = iterArchiveColors(imdir, state, ext, workers, percentile)
+    else :
+        colors = iterPatchColors(imdir, state, ext, workers, percentile)
+    found = {}
+    for name, bgr, read in colors :
+        found[name] = bgr
+        nread = nread + read
+    with open(outputPath(imdir, outName), 'w') as fo :
+        fo.write((imdir if isArchive(imdir) else os.path.join(imdir, '')) + '\n')
+        for name in sorted(found) :
+            bgr = found[name]
+            fo.write(name + '  R ' + str(bgr[2]) + '  G ' + str(bgr[1]) + '  B ' + str(bgr[0]) + '\n')
+    saveState(imdir, state, percentile)
+    return nread
+
+if __name__ == '__main__' :
+    parser = ap.ArgumentParser(description='make rgb.txt for a directory or archive of cosmetic patch images')
+    parser.add_argument('imdir', help='directory, zip or tar file with the cosmetic patch images')
+    parser.add_argument('--ext', default='.jpg', help='patch image file extension')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--percentile', type=float, default=None,
+                        help='use this luminance percentile instead of the darkest pixel')
+    parser.add_argument('--catalog', default=None, help='also save a binary shade catalog (.npy) here')
+    args = parser.parse_args()
+    nread = buildCatalog(args.imdir, args.ext, args.workers, args.percentile)
+    print('patches read', nread)
+    if args.catalog is not None :
+        scat.readRgbTxt(outputPath(args.imdir)).save(args.catalog)
@@ -1,28 +1,20 @@
-import cv2 as cv
-import colorLib as clib
-import os as os
-import tkFileDialog as tkd
+import patchCatalog as pcat
+try :
+    import tkFileDialog as tkd
+except ImportError :  # python 3
+    import tkinter.filedialog as tkd
 
 print('\nUse the file browser go to the directory with the cosmetic patch images of interest.')
 print('Choose any patch and the program will make a file called rgb.txt in this directory.')
 print('The first line of this file will contain the directory path.')
 print('The rest of this file will contain cosmetic names and RGB reflectances for all the cosmetic patches')
+print('Choose a zip or tar file of patches to read them without extracting them (the file made is then next to it).')
+print('Use patchCatalog.py to do this without the file browser.')
 
 fname = tkd.askopenfilename()  # directoy path and filename
 idx = fname.rfind('/')
 imdir = fname[0:idx+1]  # directory path
-fo = open(imdir+'rgb.txt', 'w')  # open output file
-val = imdir + '\n'
-fo.write(val)
-lst = os.listdir(imdir)
-for line in lst :
-    idx = line.rfind('.jpg')
-    if idx < 0 :
-        continue  # skip non-image files
-    img = cv.imread(imdir+line)
-    bgr = clib.getPatchColor(img)
-    line = line[0:idx]
-    val = line + '  R ' + str(bgr[2]) + '  G ' + str(bgr[1]) + '  B ' + str(bgr[0]) + '\n'
-    fo.write (val)
-
-
+if pcat.isArchive(fname) :  # a zip or tar file of patches was chosen, read the patches straight out of it
+    imdir = fname
+nread = pcat.buildCatalog(imdir)  # only patches that changed since the last run are read
+print('patches read', nread)
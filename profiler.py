@@ -0,0 +1,258 @@
+import functools as ft
+import threading as threading
+import tracemalloc as tracemalloc
+import collections as col
+import json as json
+import time as time
+import os as os
+
+""" Opt in timing of the colorLib stages.  The colorLib entry points (decomposeFace, renderKM,
+    fillRegion, featherThickness, fromReflectanceImg ...) are wrapped with stage(), and while a
+    profile is open or a callback is added each call is recorded with its wall time, pixel count,
+    the bytes of the arrays it returns (resultBytes), its thread and the request it was made for.
+    With memory=True the bytes allocated by each call are measured too (allocBytes, the peak of the
+    numpy and Python allocations above what was allocated when the call started, from tracemalloc).
+    tracemalloc slows allocation down, so this is for finding where memory goes, not for production.
+    It does not see buffers OpenCV allocates itself, and calls running at the same time on several
+    threads share one peak, so each of them may be given the others' allocations.
+    Other steps, like decoding an uploaded image, can be timed with timed().  When nothing is
+    recording the wrapper only checks one list, so it can stay in production code.
+
+        with profiler.profile(memory=True) as prof :
+            with profiler.request('selfie 17') :
+                ... colorLib calls ...
+        print(prof.summary())
+        prof.saveChromeTrace('trace.json')   # open in chrome://tracing or ui.perfetto.dev
+"""
+
+_recorders = ()  # open profiles and callbacks, each is called with every event
+_lock = threading.Lock()
+_local = threading.local()  # request id and nesting depth of each thread
+
+def _pixels(args, result) :
+    """ rows * columns of the first image argument, or of the result if no argument is an image """
+    for arg in args :
+        shape = getattr(arg, 'shape', None)
+        if shape is not None and len(shape) >= 2 :
+            return int(shape[0]) * int(shape[1])
+    shape = getattr(result, 'shape', None)
+    if shape is not None and len(shape) >= 2 :
+        return int(shape[0]) * int(shape[1])
+    return 0
+
+def _resultBytes(result) :
+    """ bytes of the numpy arrays returned by a stage (not what it allocated, see _memStart) """
+    if isinstance(result, (tuple, list)) :
+        return sum(_resultBytes(item) for item in result)
+    return int(getattr(result, 'nbytes', 0) or 0)
+
+_memoryUsers = 0  # recorders that asked for allocations, tracemalloc is on while there are any
+_memoryStarted = False  # tracemalloc was started here (not by the program)
+
+def _memStart() :
+    """ starts measuring the allocations of a call, returns [allocated at the start, peak so far]
+        or None when tracemalloc is off.  tracemalloc has one peak, so the peak of each call that
+        is open on this thread is kept on a stack and the peak is reset for the new call. """
+    if _memoryUsers == 0 or not tracemalloc.is_tracing() :
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    stack = _local.__dict__.setdefault('memory', [])
+    if len(stack) > 0 :
+        stack[-1][1] = max(stack[-1][1], peak)
+    tracemalloc.reset_peak()
+    mem = [current, current]
+    stack.append(mem)
+    return mem
+
+def _memEnd(mem) :
+    """ returns the peak bytes allocated since _memStart gave mem, or None """
+    if mem is None :
+        return None
+    stack = _local.memory
+    stack.pop()
+    if not tracemalloc.is_tracing() :  # stopped while the call ran
+        return None
+    peak = max(mem[1], tracemalloc.get_traced_memory()[1])
+    if len(stack) > 0 :
+        stack[-1][1] = max(stack[-1][1], peak)
+    tracemalloc.reset_peak()
+    return peak - mem[0]
+
+def _traceMemory(on) :
+    """ counts the recorders that want allocations, tracemalloc is started for the first and stopped after the last """
+    global _memoryUsers, _memoryStarted
+    with _lock :
+        _memoryUsers = _memoryUsers + (1 if on else -1)
+        if on and _memoryUsers == 1 and not tracemalloc.is_tracing() :
+            tracemalloc.start()
+            _memoryStarted = True
+        elif not on and _memoryUsers == 0 and _memoryStarted :
+            tracemalloc.stop()
+            _memoryStarted = False
+
+def _emit(name, start, end, pixels, resultBytes, allocBytes, depth, error=None) :
+    event = {'name': name, 'start': start, 'seconds': end - start, 'pixels': pixels, 'resultBytes': resultBytes,
+             'thread': threading.get_ident(), 'request': getattr(_local, 'request', None), 'depth': depth}
+    if allocBytes is not None :
+        event['allocBytes'] = allocBytes
+    if error is not None :
+        event['error'] = error
+    for recorder in _recorders :
+        recorder(event)
+
+def stage(name) :
+    """ decorator that records each call of a function as the stage name while recording is on """
+    def wrap(func) :
+        @ft.wraps(func)
+        def timedFunc(*args, **kwargs) :
+            if not _recorders :
+                return func(*args, **kwargs)
+            depth = getattr(_local, 'depth', 0)
+            _local.depth = depth + 1
+            mem = _memStart()
+            start = time.perf_counter()
+            try :
+                result = func(*args, **kwargs)
+            except Exception as err :
+                end = time.perf_counter()
+                _emit(name, start, end, _pixels(args, None), 0, _memEnd(mem), depth, type(err).__name__)
+                raise
+            finally :
+                _local.depth = depth
+            end = time.perf_counter()
+            _emit(name, start, end, _pixels(args, result), _resultBytes(result), _memEnd(mem), depth)
+            return result
+        return timedFunc
+    return wrap
+
+class _noTimer() :
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_off = _noTimer()
+
+class _timer() :
+    def __init__(self, name, pixels):
+        self.name = name
+        self.pixels = pixels
+    def __enter__(self):
+        self.depth = getattr(_local, 'depth', 0)
+        _local.depth = self.depth + 1
+        self.mem = _memStart()
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, excType, exc, tb):
+        end = time.perf_counter()
+        _local.depth = self.depth
+        _emit(self.name, self.start, end, self.pixels, 0, _memEnd(self.mem), self.depth,
+              None if excType is None else excType.__name__)
+        return False
+
+def timed(name, pixels=0) :
+    """ context manager that records the code in it as the stage name (like 'decode') while recording is on """
+    if not _recorders :
+        return _off
+    return _timer(name, pixels)
+
+class request() :
+    """ context manager that tags the stages run by this thread in it with a request id """
+    def __init__(self, requestId):
+        self.requestId = requestId
+    def __enter__(self):
+        self.old = getattr(_local, 'request', None)
+        _local.request = self.requestId
+        return self
+    def __exit__(self, *exc):
+        _local.request = self.old
+        return False
+
+def addCallback(func, memory=False) :
+    """ calls func(event) for every stage call from now on, event is a dict with name, start
+        (time.perf_counter seconds), seconds, pixels, resultBytes, thread, request and depth (nesting),
+        and allocBytes while memory is being traced (memory=True here or for another recorder) """
+    global _recorders
+    if memory :
+        _traceMemory(True)
+    with _lock :
+        _recorders = _recorders + (func,)
+
+def removeCallback(func, memory=False) :
+    """ stops calling func, memory is as it was given to addCallback """
+    global _recorders
+    with _lock :
+        _recorders = tuple(rec for rec in _recorders if rec is not func)
+    if memory :
+        _traceMemory(False)
+
+def enabled() :
+    return len(_recorders) > 0
+
+class profile() :
+    """ context manager that keeps the events of all the stage calls made while it is open (in any thread) """
+    def __init__(self, requestId=None, memory=False):
+        """ requestId tags the stages run by this thread while the profile is open (see request)
+            memory measures the bytes each stage allocates (allocBytes, see above) """
+        self.requestId = requestId
+        self.memory = memory
+        self.events = []
+        self.start = None
+        self._request = None
+    def __call__(self, event):
+        self.events.append(event)
+    def __enter__(self):
+        self.start = time.perf_counter()
+        if self.requestId is not None :
+            self._request = request(self.requestId).__enter__()
+        addCallback(self, self.memory)
+        return self
+    def __exit__(self, *exc):
+        removeCallback(self, self.memory)
+        if self._request is not None :
+            self._request.__exit__()
+        return False
+    def summary(self, byRequest=False):
+        """ returns {stage: {calls, seconds, meanMs, maxMs, pixels, pxPerSec, resultBytes}} in order of total time,
+            or {request: {stage: ...}} with byRequest.  With memory there are also allocBytes (the total of the
+            calls) and maxAllocBytes.  The time and allocations of a stage include the stages it calls. """
+        groups = col.OrderedDict()
+        for event in self.events :
+            key = event['request'] if byRequest else None
+            stats = groups.setdefault(key, {}).setdefault(event['name'], {'calls': 0, 'seconds': 0.0, 'maxMs': 0.0,
+                                                                          'pixels': 0, 'resultBytes': 0})
+            stats['calls'] = stats['calls'] + 1
+            stats['seconds'] = stats['seconds'] + event['seconds']
+            stats['maxMs'] = max(stats['maxMs'], event['seconds'] * 1000.0)
+            stats['pixels'] = stats['pixels'] + event['pixels']
+            stats['resultBytes'] = stats['resultBytes'] + event['resultBytes']
+            if 'allocBytes' in event :
+                stats['allocBytes'] = stats.get('allocBytes', 0) + event['allocBytes']
+                stats['maxAllocBytes'] = max(stats.get('maxAllocBytes', 0), event['allocBytes'])
+        for key, stages in groups.items() :
+            for stats in stages.values() :
+                stats['meanMs'] = stats['seconds'] * 1000.0 / stats['calls']
+                stats['pxPerSec'] = stats['pixels'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+            groups[key] = col.OrderedDict(sorted(stages.items(), key=lambda item : -item[1]['seconds']))
+        if byRequest :
+            return groups
+        return groups.get(None, col.OrderedDict())
+    def toJSON(self):
+        """ returns the summary and the events as a json string """
+        events = [dict(event, start=event['start'] - self.start) for event in self.events]
+        return json.dumps({'summary': self.summary(), 'events': events}, indent=1)
+    def chromeTrace(self):
+        """ returns the events in the Chrome trace event format (chrome://tracing, ui.perfetto.dev) """
+        pid = os.getpid()
+        trace = [{'name': event['name'], 'cat': 'colorLib', 'ph': 'X', 'pid': pid, 'tid': event['thread'],
+                  'ts': (event['start'] - self.start) * 1e6, 'dur': event['seconds'] * 1e6,
+                  'args': dict((key, event[key]) for key in ('pixels', 'resultBytes', 'allocBytes', 'request', 'error')
+                               if key in event)}
+                 for event in self.events]
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+    def saveJSON(self, fname):
+        with open(fname, 'w') as fo :
+            fo.write(self.toJSON())
+    def saveChromeTrace(self, fname):
+        with open(fname, 'w') as fo :
+            json.dump(self.chromeTrace(), fo)
@@ -2,23 +2,23 @@ import cv2 as cv
 import numpy as np
 import colorLib as clib
 
-""" This is for making a mask from an image with an area encircled with a red line. """
+""" This is for making a mask from an image with an area encircled with a red line.
+    The area inside the line is found too, see clib.annotationMasks for images with several colored lines. """
 
 fname = 'eye1feather.bmp'
 maskname = 'eye1featherLine.bmp'
 img = cv.imread(fname)
-gray = cv.imread(fname, 0)
-red = cv.imread(fname)
 
-red = img[:,:] == [0,0,255] # wherever img[:,:,0] is 0 red[:,:,0] is 1, and similar for other seps
+lines, regions = clib.annotationMasks(img, {'red': [0, 0, 255]})  # pure red line, tol=10 would allow near reds
+line = lines['red'].decode()
 
 print ('img', np.shape(img))
-print ('red', np.shape(red))
-print ('gray', np.shape(gray))
+print ('red line pixels', lines['red'].area, 'stored in', lines['red'].nbytes, 'bytes')
+for region in regions['red'] :
+    print ('enclosed area', region.area, 'box', region.box, 'stored in', region.nbytes, 'bytes')
 
-gray[:,:] = 255 * (red[:,:,0] & red[:,:,1] & red[:,:,2])
+gray = (255 * line).astype(np.uint8)
 cv.imshow('eyelid', gray)
 cv.imwrite(maskname, gray)
 
 cv.waitKey(0)
-
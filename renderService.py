@@ -0,0 +1,279 @@
+import cv2 as cv
+import numpy as np
+import colorLib as clib
+import shadeCatalog as scat
+import profiler as prof
+import concurrent.futures as cf
+import urllib.parse as up
+import argparse as ap
+import asyncio as asyncio
+import hashlib as hl
+import json as json
+import traceback as traceback
+
+""" A long running local render service for the web tier.  Faces are uploaded once and kept
+    decomposed in memory, the shade catalog is loaded once, and rendered images are kept, all in
+    lruCaches with byte limits.  Render requests for the same face that arrive within a few
+    milliseconds of each other are done as one batch: the Kubelka-Munk colors of all their shades
+    are found in one renderKM call and the face shading is only read once for the batch.
+
+    Requests (HTTP/1.1 with keep alive, on a TCP port or a Unix socket):
+    POST /faces?yskin=0.5  body is a jpeg or png selfie, returns {"face": id, "rows": r, "cols": c}
+    POST /render  body is {"face": id, "shade": catalog name or "bgr": [b, g, r],
+                  "thickness": 8.0, "format": ".jpg"}, returns the image
+    GET /stats  returns the cache and batch counts
+    The face covered with foundation is rendered like colorDriver.py, with the skin reflectance
+    set to the average skin reflectance and the roll over divisor of each image. """
+
+_types = {'.jpg': 'image/jpeg', '.png': 'image/png', '.bmp': 'image/bmp'}
+
+class serviceError(Exception) :
+    """ an error that is sent back to the client with an HTTP status """
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+class faceEntry() :
+    """ what is kept for an uploaded face: the shading and the limited average skin reflectance """
+    def __init__(self, img, Yskin=0.5):
+        face = clib.decomposeFlat(img, Yskin=Yskin, dtype=np.float32, cache=False)
+        self.shading = face.shading
+        self.refAve = face.refAve
+        self.maxRgb = face.maxRgb
+        self.shadingMax = face.shadingMax
+        self.rows, self.cols = face.shading.shape
+
+class renderService() :
+    """ the state of the service and the handling of requests, without the network part """
+    def __init__(self, catalog=None, window=0.005, maxBatch=64, workers=2,
+                 faceBytes=2**30, imageBytes=2**28):
+        """
+        catalog is a shadeCatalog (or the name of a .npy file saved by shadeCatalog.py) for shade names
+        window is how long in seconds a render request waits for others for the same face
+        maxBatch is the most renders done in one batch
+        workers is the number of threads that render, numpy lets them run at the same time
+        faceBytes and imageBytes limit the memory held by the face and rendered image caches
+        """
+        if isinstance(catalog, str) :
+            catalog = scat.load(catalog)
+        self.catalog = catalog
+        self.window = window
+        self.maxBatch = maxBatch
+        self.faces = clib.lruCache(maxItems=256, maxBytes=faceBytes)
+        self.images = clib.lruCache(maxItems=4096, maxBytes=imageBytes)
+        self.pool = cf.ThreadPoolExecutor(workers)
+        self.batches = 0
+        self.rendered = 0
+        self._pending = {}  # face id -> (list of waiting renders, timer handle)
+        self._inflight = {}  # render key -> future of a render that is waiting or being done
+    def addFace(self, data, Yskin=0.5):
+        """ decodes and decomposes an uploaded image, returns its face id (the sha1 of the bytes) """
+        faceId = hl.sha1(data).hexdigest()
+        entry = self.faces.get(faceId)
+        if entry is None :
+            with prof.timed('decode') :
+                img = cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_COLOR)
+            if img is None :
+                raise serviceError(400, 'cannot decode image')
+            entry = faceEntry(img, Yskin)
+            self.faces.put(faceId, entry)
+        return faceId, entry
+    def shadeColor(self, req):
+        """ the [B G R] reflectance of the shade asked for in a render request """
+        if 'bgr' in req :
+            bgr = req['bgr']
+            if not isinstance(bgr, list) or len(bgr) != 3 or not all(_isNumber(val) for val in bgr) :
+                raise serviceError(400, 'bgr must be a list of 3 numbers')
+            bgr = [float(val) for val in bgr]
+        elif self.catalog is not None and 'shade' in req :
+            if not isinstance(req['shade'], str) :
+                raise serviceError(400, 'shade must be a catalog shade name')
+            try :
+                bgr = [float(val) for val in self.catalog.bgr[self.catalog.index(req['shade'])]]
+            except KeyError :
+                raise serviceError(404, 'no shade ' + req['shade'])
+        else :
+            raise serviceError(400, 'render needs bgr or a catalog shade')
+        if not (0 < min(bgr) and max(bgr) < 1) :
+            raise serviceError(400, 'shade reflectances must be between 0 and 1')
+        return tuple(bgr)
+    async def render(self, req):
+        """ returns the encoded image for a render request (a dict), done in a batch with
+            the other requests for the same face that arrive within window seconds """
+        faceId = req.get('face')
+        if not isinstance(faceId, str) :
+            raise serviceError(400, 'face must be the id returned by /faces')
+        if faceId not in self.faces :
+            raise serviceError(404, 'no face ' + faceId + ', post it to /faces first')
+        bgr = self.shadeColor(req)
+        thickness = req.get('thickness', 1.0)
+        if not _isNumber(thickness) or not 0 <= thickness < float('inf') :
+            raise serviceError(400, 'thickness must be a number of at least 0')
+        thickness = float(thickness)
+        fmt = req.get('format', '.jpg')
+        if not isinstance(fmt, str) or fmt not in _types :
+            raise serviceError(400, 'unknown format ' + str(fmt))
+        key = (faceId, bgr, thickness, fmt)
+        data = self.images.get(key)
+        if data is not None :
+            return data, fmt
+        if key in self._inflight :  # the same image was asked for a moment ago
+            return await asyncio.shield(self._inflight[key]), fmt
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._inflight[key] = fut
+        pending = self._pending.get(faceId)
+        if pending is None :
+            pending = ([], loop.call_later(self.window, self._flush, faceId))
+            self._pending[faceId] = pending
+        pending[0].append((key, fut))
+        if len(pending[0]) >= self.maxBatch :
+            self._flush(faceId)
+        return await fut, fmt
+    def _flush(self, faceId):
+        """ sends the waiting renders for a face to the render threads """
+        waiting, timer = self._pending.pop(faceId, (None, None))
+        if waiting is None :
+            return
+        timer.cancel()
+        entry = self.faces.get(faceId)
+        loop = asyncio.get_running_loop()
+        job = loop.run_in_executor(self.pool, self._renderBatch, entry, [key for key, fut in waiting])
+        def done(job) :
+            error = job.exception()
+            for idx, (key, fut) in enumerate(waiting) :
+                self._inflight.pop(key, None)
+                if fut.done() :
+                    continue
+                if error is not None :
+                    fut.set_exception(error)
+                else :
+                    fut.set_result(job.result()[idx])
+        job.add_done_callback(done)
+    def _renderBatch(self, entry, keys):
+        """ renders a batch of (face id, bgr, thickness, format) keys for one face, returns the encoded images """
+        if entry is None :
+            raise serviceError(404, 'face was dropped from the cache')
+        unique = list(dict.fromkeys(keys))  # in order, without repeats
+        shades = clib.iterFlatShades(entry.shading, entry.refAve, [key[1] for key in unique],
+                                     [key[2] for key in unique], 'auto', entry.shadingMax)
+        encoded = {}
+        for key, (shade, img) in zip(unique, shades) :
+            with prof.timed('encode', img.shape[0] * img.shape[1]) :
+                ok, buf = cv.imencode(key[3], img)
+            if not ok :
+                raise serviceError(500, 'cannot encode the image as ' + key[3])
+            encoded[key] = buf.tobytes()
+            self.images.put(key, encoded[key], len(encoded[key]))
+        self.batches = self.batches + 1
+        self.rendered = self.rendered + len(unique)
+        return [encoded[key] for key in keys]
+    def stats(self):
+        caches = dict((name, {'items': len(cache), 'bytes': cache.nbytes, 'hits': cache.hits, 'misses': cache.misses})
+                      for name, cache in (('faces', self.faces), ('images', self.images)))
+        return {'caches': caches, 'batches': self.batches, 'rendered': self.rendered,
+                'meanBatch': self.rendered / float(max(self.batches, 1))}
+    async def handle(self, method, path, body):
+        """ returns (status, content type, body bytes) for a request """
+        url = up.urlsplit(path)
+        query = dict(up.parse_qsl(url.query))
+        try :
+            if method == 'POST' and url.path == '/faces' :
+                try :
+                    Yskin = float(query.get('yskin', 0.5))
+                except ValueError :
+                    raise serviceError(400, 'yskin must be a number')
+                if not 0 < Yskin < float('inf') :
+                    raise serviceError(400, 'yskin must be more than 0')
+                faceId, entry = await asyncio.get_running_loop().run_in_executor(
+                    self.pool, self.addFace, body, Yskin)
+                return 200, 'application/json', _json({'face': faceId, 'rows': entry.rows, 'cols': entry.cols})
+            if method == 'POST' and url.path == '/render' :
+                try :
+                    req = json.loads(body.decode('utf-8'))
+                except ValueError :
+                    raise serviceError(400, 'render body must be json')
+                if not isinstance(req, dict) :
+                    raise serviceError(400, 'render body must be a json object')
+                data, fmt = await self.render(req)
+                return 200, _types[fmt], data
+            if method == 'GET' and url.path == '/stats' :
+                return 200, 'application/json', _json(self.stats())
+            raise serviceError(404, 'no ' + method + ' ' + url.path)
+        except serviceError as err :
+            return err.status, 'application/json', _json({'error': str(err)})
+
+def _json(val) :
+    return json.dumps(val).encode('utf-8')
+
+def _isNumber(val) :
+    """ True for a json number (not true or false) """
+    return isinstance(val, (int, float)) and not isinstance(val, bool)
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+async def readRequest(reader) :
+    """ reads one HTTP request, returns (method, path, headers, body) or None at the end of the connection """
+    line = await reader.readline()
+    if not line.strip() :
+        return None
+    method, path, version = line.decode('latin-1').split(None, 2)
+    headers = {}
+    while True :
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b'') :
+            break
+        name, val = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = val.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+async def serveConnection(service, reader, writer) :
+    """ answers the requests on one connection until the client closes it """
+    try :
+        while True :
+            request = await readRequest(reader)
+            if request is None :
+                break
+            method, path, headers, body = request
+            try :
+                status, ctype, data = await service.handle(method, path, body)
+            except Exception as err :  # keep the service up, the details go to the service log
+                traceback.print_exc()
+                status, ctype, data = 500, 'application/json', _json({'error': 'internal error'})
+            head = 'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n' % (
+                status, _reasons.get(status, 'Error'), ctype, len(data))
+            writer.write(head.encode('latin-1') + data)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close' :
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError) :
+        pass
+    finally :
+        writer.close()
+
+async def serve(service, host='127.0.0.1', port=8350, unix=None) :
+    """ runs the service on host:port, or on the Unix socket unix, until it is cancelled """
+    handler = lambda reader, writer : serveConnection(service, reader, writer)
+    if unix is not None :
+        server = await asyncio.start_unix_server(handler, unix)
+    else :
+        server = await asyncio.start_server(handler, host, port)
+    async with server :
+        await server.serve_forever()
+
+if __name__ == '__main__' :
+    parser = ap.ArgumentParser(description='local cosmetic render service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8350)
+    parser.add_argument('--unix', default=None, help='Unix socket path to listen on instead of a port')
+    parser.add_argument('--catalog', default=None, help='shade catalog .npy made by shadeCatalog.py')
+    parser.add_argument('--window', type=float, default=5.0, help='ms a render waits to be batched')
+    parser.add_argument('--workers', type=int, default=2, help='render threads')
+    args = parser.parse_args()
+    service = renderService(args.catalog, args.window / 1000.0, workers=args.workers)
+    print('serving on', args.unix if args.unix is not None else '%s:%d' % (args.host, args.port))
+    try :
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt :
+        pass
@@ -0,0 +1,74 @@
+import numpy as np
+import colorLib as clib
+import sys as sys
+
+""" A shade catalog holds the names, linear BGR reflectances and CIELAB colors of a set of
+    cosmetics in one numpy record array.  It is saved as a .npy file, which is loaded as a
+    read only memory map so all the processes using a catalog share one copy of it and
+    nothing has to be parsed or recalculated when it is loaded. """
+
+def catalogDtype(nameLen) :
+    """ record type for a catalog with names up to nameLen bytes (utf-8) long """
+    return np.dtype([('name', 'S%d' % max(nameLen, 1)), ('bgr', '<f4', (3,)), ('lab', '<f4', (3,))])
+
+class shadeCatalog() :
+    """ table is a record array with name, bgr and lab fields (see catalogDtype).
+        Row numbers are the shade IDs. """
+    def __init__(self, table):
+        self.table = table
+        self.names = table['name']  # utf-8 bytes, use name() for a string
+        self.bgr = table['bgr']  # number of shades x 3, linear BGR 0-1 normalization
+        self.lab = table['lab']  # number of shades x 3, CIELAB 0-100 normalization
+        self._rows = None
+    def __len__(self):
+        return len(self.table)
+    def name(self, row):
+        return self.names[row].decode('utf-8')
+    def index(self, name):
+        """ returns the row (ID) of the shade called name, raises KeyError if there is none """
+        if self._rows is None :  # made on first use so loading stays zero-copy
+            self._rows = dict((nm, row) for row, nm in enumerate(self.names))
+        return self._rows[name.encode('utf-8')]
+    def save(self, fname):
+        np.save(fname, np.asarray(self.table))
+
+def fromColors(names, bgr) :
+    """ makes a shadeCatalog from a list of cosmetic names and a matching list or
+        number of shades x 3 array of linear BGR reflectances, the CIELAB colors are calculated here """
+    names = [nm.encode('utf-8') for nm in names]
+    bgr = np.asarray(bgr, np.float64).reshape(-1, 3)
+    if len(names) != len(bgr) :
+        raise ValueError('%d names for %d colors' % (len(names), len(bgr)))
+    table = np.zeros(len(names), catalogDtype(max([len(nm) for nm in names] + [1])))
+    table['name'] = names
+    table['bgr'] = bgr
+    table['lab'] = clib.RGBtoLABImg(bgr)
+    return shadeCatalog(table)
+
+def readRgbTxt(fname) :
+    """ makes a shadeCatalog from an rgb.txt file written by patchCatalog.py or processPatches.py
+        (a directory line, then lines of  name  R r  G g  B b) """
+    names = []
+    bgr = []
+    with open(fname) as fi :
+        fi.readline()  # directory path
+        for line in fi :
+            fields = line.rsplit(None, 6)
+            if len(fields) < 7 :
+                continue
+            names.append(line[0:line.rfind('  R ')])
+            bgr.append([float(fields[6]), float(fields[4]), float(fields[2])])
+    return fromColors(names, bgr)
+
+def load(fname, mmap=True) :
+    """ loads a shadeCatalog saved with its save method.  With mmap the file is mapped read only
+        instead of read, so processes loading the same catalog share its memory """
+    return shadeCatalog(np.load(fname, mmap_mode='r' if mmap else None))
+
+if __name__ == '__main__' :
+    if len(sys.argv) != 3 :
+        print('usage: python shadeCatalog.py rgb.txt catalog.npy')
+        sys.exit(1)
+    cat = readRgbTxt(sys.argv[1])
+    cat.save(sys.argv[2])
+    print('shades saved', len(cat))
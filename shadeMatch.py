@@ -0,0 +1,99 @@
+import numpy as np
+import colorLib as clib
+try :
+    from scipy.spatial import cKDTree as kdTree
+except ImportError :  # without scipy the matcher compares against every shade
+    kdTree = None
+
+""" Finds the cosmetic shades closest to a color (for example the refAve skin reflectance
+    of a face) in a shade catalog.  The catalog CIELAB colors are put in a k-d tree once,
+    so each query takes microseconds instead of one difLAB call for every shade.
+    Distances are CIELAB (delta E 1976) distances unless the candidates are re-ranked
+    with CIEDE2000. """
+
+class shadeMatcher() :
+    def __init__(self, lab):
+        """ lab is a shadeCatalog (see shadeCatalog.py) or a number of shades x 3 array
+            of CIELAB colors.  Rows returned by queries are rows of lab """
+        if hasattr(lab, 'lab') :
+            lab = lab.lab
+        self.lab = np.ascontiguousarray(lab, np.float64)
+        self.tree = None if kdTree is None else kdTree(self.lab)
+        self.chroma = np.hypot(self.lab[:, 1], self.lab[:, 2]).max() if len(self.lab) > 0 else 0.0
+    def _queryLab(self, col, lab):
+        """ returns the queries as a number of queries x 3 CIELAB array and whether there was only one """
+        col = np.asarray(col, np.float64)
+        single = col.ndim == 1
+        col = col.reshape(-1, 3)
+        if not lab :
+            col = clib.RGBtoLABImg(col)
+        return col, single
+    def _nearest76(self, qlab, k):
+        """ k nearest shades by delta E 1976, returns number of queries x k distances and rows """
+        if self.tree is not None :
+            dist, rows = self.tree.query(qlab, k)
+            return dist.reshape(len(qlab), k), rows.reshape(len(qlab), k)
+        dist = np.sqrt(((qlab[:, np.newaxis, :] - self.lab[np.newaxis, :, :]) ** 2).sum(axis=2))
+        rows = np.argsort(dist, axis=1)[:, 0:k]
+        return np.take_along_axis(dist, rows, axis=1), rows
+    def nearest(self, col, k=1, lab=False, rerank=False, candidates=None):
+        """ finds the k shades closest to col
+            col is one linear BGR color (0-1 normalization) or a number of queries x 3 array of them,
+            or CIELAB colors if lab is set
+            rerank orders candidates (default 4*k, at least 16) found by delta E 1976 with CIEDE2000
+            and returns CIEDE2000 distances
+            returns (distances, rows), each k long for one query or number of queries x k """
+        qlab, single = self._queryLab(col, lab)
+        k = min(k, len(self.lab))
+        if not rerank :
+            dist, rows = self._nearest76(qlab, k)
+        else :
+            ncand = min(len(self.lab), max(16, 4 * k) if candidates is None else max(candidates, k))
+            dist, rows = self._nearest76(qlab, ncand)
+            dist = clib.difLAB2000(qlab[:, np.newaxis, :], self.lab[rows])
+            order = np.argsort(dist, axis=1)[:, 0:k]
+            dist = np.take_along_axis(dist, order, axis=1)
+            rows = np.take_along_axis(rows, order, axis=1)
+        if single :
+            return dist[0], rows[0]
+        return dist, rows
+    def _widen2000(self, qlab):
+        """ returns for each query how many times a CIEDE2000 radius the delta E 1976 distance
+            of a shade inside it can be.  CIEDE2000 stretches a* by 1 + G (at most 1.5, the same for
+            both colors), divides the lightness, chroma and hue differences by SL <= 1.75,
+            SC = 1 + 0.045 C' and SH <= 1 + 0.025 C' (C' the mean stretched chroma) and adds RT times
+            the chroma and hue terms, which takes away at most |RT| / 2 of them.  So
+            delta E 1976 <= max(SL, SC) / sqrt(1 - |RT| / 2) * CIEDE2000 """
+        chroma = 0.75 * (np.hypot(qlab[:, 1], qlab[:, 2]) + self.chroma)  # largest mean C'
+        scale = np.maximum(1.75, 1 + 0.045 * chroma)
+        c7 = chroma ** 7
+        rt = np.sin(np.radians(60)) * 2 * np.sqrt(c7 / (c7 + 25.0 ** 7))  # largest |RT|
+        return scale / np.sqrt(1 - rt / 2)
+    def within(self, col, radius, lab=False, rerank=False):
+        """ finds the shades within a delta E 1976 distance radius of col, closest first
+            col is as for nearest
+            rerank finds the shades within a CIEDE2000 distance radius instead, and returns
+            CIEDE2000 distances.  The delta E 1976 ball searched is made big enough to hold them
+            all (see _widen2000), which is several times radius for colorful queries and catalogs
+            returns (distances, rows) for one query or a list of them """
+        qlab, single = self._queryLab(col, lab)
+        radii = radius * self._widen2000(qlab) if rerank else np.full(len(qlab), float(radius))
+        if self.tree is not None :
+            found = self.tree.query_ball_point(qlab, radii)
+        else :
+            dist = np.sqrt(((qlab[:, np.newaxis, :] - self.lab[np.newaxis, :, :]) ** 2).sum(axis=2))
+            found = [np.flatnonzero(row <= rad) for row, rad in zip(dist, radii)]
+        result = []
+        for qcol, rows in zip(qlab, found) :
+            rows = np.asarray(rows, np.intp)
+            if rerank :
+                dist = clib.difLAB2000(qcol, self.lab[rows])
+                keep = dist <= radius
+                dist, rows = dist[keep], rows[keep]
+            else :
+                dist = np.sqrt(((self.lab[rows] - qcol) ** 2).sum(axis=1))
+            order = np.argsort(dist)
+            result.append((dist[order], rows[order]))
+        if single :
+            return result[0]
+        return result
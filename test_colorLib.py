@@ -0,0 +1,566 @@
+import numpy as np
+import cv2 as cv
+import colorLib as clib
+import unittest as unittest
+import collections as col
+
+""" Checks of the whole image colorLib functions against the scalar and loop versions they replace.
+    Run with python -m pytest or python -m unittest. """
+
+def baseGetPatchColor(patch) :
+    """ getPatchColor as it was before getPatchColors, the reference for it """
+    dark = 1000.0
+    darkest = [-1.0, -1.0, -1.0]
+    for row in patch:
+        for col in row :
+            bR = clib.toReflectance(col[0])
+            gR = clib.toReflectance(col[1])
+            rR = clib.toReflectance(col[2])
+            dd = 0.33 * rR + 0.66 * gR + 0.07 * bR
+            if dd < dark :
+                dark = dd
+                darkest = [bR, gR, rR]
+    return darkest
+
+def patches(count=6, rows=9, cols=11, seed=0) :
+    """ made up uint8 sRGB patches of a few different sizes """
+    rand = np.random.RandomState(seed)
+    return [rand.randint(0, 256, (rows + idx, cols - idx, 3)).astype(np.uint8) for idx in range(count)]
+
+def baseShowFace(shading, skin, thickness, csm) :
+    """ showFace as it was before renderKM, the reference for it """
+    opF = [1.0, 1.0, 1.0]
+    for idx in [0, 1, 2] :
+        opF[idx] = thickness * (1 - csm[idx]*csm[idx]) / csm[idx]
+        opF[idx] = np.exp(-opF[idx])   # F in notes
+    var = np.copy(skin)
+    G = np.copy(skin)
+    for idx in [0,1,2] :
+        var[:,:,idx] = var[:,:,idx] - csm[idx]  # delta in notes
+        G[:,:,idx] = var[:,:,idx] * csm[idx] + csm[idx] * csm[idx] - 1  # G in notes
+        G[:,:,idx] =(var[:,:,idx] * opF[idx] - G[:,:,idx] * csm[idx])/(var[:,:,idx] * opF[idx] * csm[idx] - G[:,:,idx])  # R in notes
+        G[:,:,idx] = G[:,:,idx] * shading  # skin color = reflectance * shading
+    return  G
+
+def baseShowFaceGen(shading, skin, thickness, csm) :
+    """ showFaceGen as it was before renderKM, the reference for it """
+    opF = np.copy(skin)
+    npthick = np.copy(thickness)
+    for idx in [0, 1, 2]:
+        opF[:, :, idx] = npthick * (1 - csm[:, :, idx] * csm[:, :, idx]) / csm[:, :, idx]
+        opF[:, :, idx] = np.exp(-opF[:, :, idx])  # F in notes
+    var = np.copy(skin)
+    G = np.copy(skin)
+    for idx in [0,1,2] :
+        var[:,:,idx] = var[:,:,idx] - csm[:,:,idx]  # delta in notes
+        G[:,:,idx] = var[:,:,idx] * csm[:,:,idx] + csm[:,:,idx] * csm[:,:,idx] - 1  # G in notes
+        G[:,:,idx] =(var[:,:,idx] * opF[:,:,idx] - G[:,:,idx] * csm[:,:,idx])/(var[:,:,idx] * opF[:,:,idx] * csm[:,:,idx] - G[:,:,idx])  # R in notes
+        G[:,:,idx] = G[:,:,idx] * shading  # skin color = reflectance * shading
+    return  G
+
+def face(rows=70, cols=90, seed=0) :
+    """ made up shading, skin, thickness map and textured cosmetic, rows is more than one band """
+    rand = np.random.RandomState(seed)
+    shading = rand.uniform(0.5, 1.5, (rows, cols))
+    skin = rand.uniform(0.05, 0.95, (rows, cols, 3))
+    thickness = rand.uniform(0.0, 4.0, (rows, cols))
+    thickness[0:10] = 0.0  # no cosmetic
+    texture = rand.uniform(0.05, 0.95, (rows, cols, 3))
+    return shading, skin, thickness, texture
+
+def baseFloodfill(img, pt, val) :
+    """ floodfill as it was before fillRegion (with the bounds check addAdj has now), the reference for it """
+    qq = col.deque()
+    img[pt[0], pt[1]] = val
+    clib.addAdj(img, qq, val, pt)
+    while len(qq)> 0 :
+        center = qq.popleft()
+        clib.addAdj(img, qq, val, center)
+
+def outline(rows=20, cols=24) :
+    """ a small eyelid like mask, 255 on a closed boundary with a step in one side, an island with
+        its own inside and a diagonal pair of boundary pixels that 8 connected fills go between """
+    img = np.zeros((rows, cols), np.uint8)
+    img[2, 3:20] = 255
+    img[15, 3:20] = 255
+    img[2:16, 3] = 255
+    img[2:9, 19] = 255
+    img[8:16, 20] = 255  # the side steps out by a column
+    img[8, 19:21] = 255
+    img[6:10, 8] = img[6, 8:12] = img[9, 8:12] = img[6:10, 11] = 255  # an island with its own inside
+    img[12, 12] = img[13, 13] = 255  # a diagonal pair, the fill goes between them
+    return img
+
+def eyelid(rows=40, cols=60) :
+    """ a made up eyelid, returns the line at its top and its outline (the line, the bottom and the sides) """
+    line = np.zeros((rows, cols), np.uint8)
+    xs = np.arange(5, 55)
+    top = (8 + 0.01 * (xs - 30) ** 2).astype(np.int32)
+    bottom = (30 - 0.004 * (xs - 30) ** 2).astype(np.int32)
+    cv.polylines(line, [np.stack([xs, top], 1).reshape(-1, 1, 2)], False, 255)
+    edge = line.copy()
+    cv.polylines(edge, [np.stack([xs, bottom], 1).reshape(-1, 1, 2)], False, 255)
+    edge[top[0]:bottom[0] + 1, xs[0]] = 255
+    edge[top[-1]:bottom[-1] + 1, xs[-1]] = 255
+    return line, edge
+
+def baseFeather(line, pts, pwr=0.3) :
+    """ featheredVal.getVal as it was before lineDistance (without thinning the line), the reference
+        for it, returns the values for pts normalized to go from 0 to 254 as renorm does """
+    linePts = [(row, col) for row, col in np.argwhere(line == 255)]
+    vals = []
+    for pt in pts :
+        minval = (linePts[0][0]-pt[0])**2 + (linePts[0][1]-pt[1])**2
+        for ptl in linePts :  # gets the minimum distance between pt and line
+            dist = (ptl[0] - pt[0])**2 + (ptl[1] - pt[1])**2
+            if dist < minval :
+                minval = dist
+        vals.append(minval ** pwr)
+    vals = np.array(vals)
+    return 254 * vals / vals.max()
+
+class conversionTest(unittest.TestCase) :
+    """ toReflectanceImg and fromReflectanceImg against toReflectance and fromReflectance """
+    def test_toReflectanceUint8(self):
+        img = np.arange(256, dtype=np.uint8).reshape(4, 64)
+        expect = np.array([[clib.toReflectance(val) for val in row] for row in img.astype(np.int64)])
+        np.testing.assert_array_equal(clib.toReflectanceImg(img), expect)
+        np.testing.assert_allclose(clib.toReflectanceImg(img, dtype=np.float32), expect, rtol=1e-6, atol=1e-7)
+    def test_toReflectanceUint16(self):
+        img = np.random.RandomState(1).randint(0, 256, (50, 40, 3)).astype(np.uint16)
+        expect = np.vectorize(clib.toReflectance)(img.astype(np.float64))
+        np.testing.assert_allclose(clib.toReflectanceImg(img, bandRows=7), expect, rtol=1e-12, atol=1e-15)
+    def test_toReflectanceFloat(self):
+        img = np.random.RandomState(2).uniform(0, 255, (50, 40, 3))
+        expect = np.vectorize(clib.toReflectance)(img)
+        np.testing.assert_allclose(clib.toReflectanceImg(img), expect, rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(clib.toReflectanceImg(img.astype(np.float32), dtype=np.float32), expect,
+                                   rtol=1e-5, atol=1e-7)
+    def test_toReflectanceOut(self):
+        img = np.random.RandomState(3).randint(0, 256, (50, 40, 3)).astype(np.uint8)
+        out = np.zeros(img.shape, np.float32)
+        result = clib.toReflectanceImg(img, out=out, bandRows=16, workers=2)
+        self.assertIs(result, out)
+        np.testing.assert_allclose(out, np.vectorize(clib.toReflectance)(img.astype(np.float64)), rtol=1e-6, atol=1e-7)
+    def test_fromReflectanceFloat(self):
+        ref = np.random.RandomState(4).uniform(0, 1, (50, 40, 3))
+        ref[0, 0:4, 0] = [0.0, 0.001, 0.0031308, 1.0]  # the linear part, the joint and the ends
+        expect = np.vectorize(clib.fromReflectance)(ref)
+        np.testing.assert_allclose(clib.fromReflectanceImg(ref, dtype=np.float64), expect, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(clib.fromReflectanceImg(ref.astype(np.float32), dtype=np.float32), expect,
+                                   rtol=1e-5, atol=1e-4)
+    def test_fromReflectanceUint8(self):
+        ref = np.random.RandomState(5).uniform(-0.1, 1.1, (50, 40, 3))
+        expect = np.clip(np.floor(np.vectorize(clib.fromReflectance)(np.clip(ref, 0, 1)) + 0.5), 0, 255)
+        np.testing.assert_array_equal(clib.fromReflectanceImg(ref), expect)
+        np.testing.assert_array_equal(clib.fromReflectanceImg(ref.astype(np.float32)), expect)
+        # every sRGB value goes back to itself
+        levels = np.arange(256, dtype=np.uint8)
+        np.testing.assert_array_equal(clib.fromReflectanceImg(clib.toReflectanceImg(levels)), levels)
+    def test_fromReflectanceUint16(self):
+        ref = np.random.RandomState(6).uniform(0, 1, (50, 40, 3))
+        expect = np.rint(np.vectorize(clib.fromReflectance)(ref) * (65535 / 255.0))
+        np.testing.assert_array_equal(clib.fromReflectanceImg(ref, dtype=np.uint16), expect)
+    def test_fromReflectanceOut(self):
+        ref = np.random.RandomState(7).uniform(0, 1, (50, 40, 3))
+        out = np.zeros(ref.shape, np.uint8)
+        result = clib.fromReflectanceImg(ref, out=out, bandRows=16, workers=2)
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(out, clib.fromReflectanceImg(ref))
+
+class patchTest(unittest.TestCase) :
+    """ getPatchColors against a loop of getPatchColor """
+    def test_darkest(self):
+        pats = patches()
+        expect = np.array([baseGetPatchColor(patch.astype(np.int64)) for patch in pats])
+        np.testing.assert_array_equal(clib.getPatchColors(pats), expect)
+        np.testing.assert_array_equal([clib.getPatchColor(patch) for patch in pats], expect)
+        stack = np.random.RandomState(1).randint(0, 256, (4, 10, 12, 3)).astype(np.uint8)  # equal sized patches
+        expect = np.array([baseGetPatchColor(patch.astype(np.int64)) for patch in stack])
+        np.testing.assert_array_equal(clib.getPatchColors(stack), expect)
+        np.testing.assert_allclose(clib.getPatchColors(stack, dtype=np.float32), expect, rtol=1e-6)
+    def test_percentile(self):
+        pats = patches(seed=3)
+        for percentile in (0, 1, 50, 100) :
+            colors = clib.getPatchColors(pats, percentile)
+            np.testing.assert_array_equal(colors, [clib.getPatchColor(patch, percentile) for patch in pats])
+            for patch, color in zip(pats, colors) :
+                # the luminance of the color picked is the one at the percentile
+                refl = np.vectorize(clib.toReflectance)(patch.reshape(-1, 3).astype(np.float64))
+                lum = np.sort(0.33 * refl[:, 2] + 0.66 * refl[:, 1] + 0.07 * refl[:, 0])
+                kth = int(round(percentile / 100.0 * (len(lum) - 1)))
+                self.assertAlmostEqual(0.33 * color[2] + 0.66 * color[1] + 0.07 * color[0], lum[kth], places=12)
+        np.testing.assert_array_equal(clib.getPatchColors(pats, 0), clib.getPatchColors(pats))
+
+class renderTest(unittest.TestCase) :
+    """ renderKM, showFace and showFaceGen against the loops they replace """
+    def test_showFace(self):
+        shading, skin, thickness, texture = face()
+        csm = [0.2, 0.45, 0.7]
+        for thick in (0.0, 0.5, 3.0) :
+            np.testing.assert_allclose(clib.showFace(shading, skin, thick, csm),
+                                       baseShowFace(shading, skin, thick, csm), rtol=1e-12, atol=1e-14)
+    def test_showFaceGen(self):
+        shading, skin, thickness, texture = face()
+        np.testing.assert_allclose(clib.showFaceGen(shading, skin, thickness, texture),
+                                   baseShowFaceGen(shading, skin, thickness, texture), rtol=1e-12, atol=1e-14)
+    def test_renderKM(self):
+        shading, skin, thickness, texture = face()
+        csm = [0.2, 0.45, 0.7]
+        uniform = np.empty(skin.shape)
+        uniform[:] = csm
+        expect = baseShowFaceGen(shading, skin, thickness, uniform)
+        np.testing.assert_allclose(clib.renderKM(shading, skin, thickness, csm, bandRows=8, workers=2),
+                                   expect, rtol=1e-12, atol=1e-14)
+        np.testing.assert_allclose(clib.renderKM(shading, skin, thickness, clib.kmCosmetic(csm)),
+                                   expect, rtol=1e-12, atol=1e-14)
+        out = np.zeros(skin.shape, np.float32)
+        result = clib.renderKM(shading, skin, thickness, texture, out=out)
+        self.assertIs(result, out)
+        np.testing.assert_allclose(out, baseShowFaceGen(shading, skin, thickness, texture), rtol=1e-4, atol=1e-5)
+    def test_scalarThicknessTexture(self):
+        # one thickness for the whole face with a textured cosmetic, F was once left unset on this path
+        shading, skin, thickness, texture = face()
+        for thick in (0.0, 2.0) :
+            expect = baseShowFaceGen(shading, skin, np.full(shading.shape, thick), texture)
+            np.testing.assert_allclose(clib.renderKM(shading, skin, thick, texture, bandRows=8),
+                                       expect, rtol=1e-12, atol=1e-14)
+            np.testing.assert_allclose(clib.renderLayers(shading, skin, [(texture, thick)], bandRows=8),
+                                       expect, rtol=1e-12, atol=1e-14)
+            srgb = clib.renderSRGB(shading, skin, thick, texture, bandRows=8)
+            self.assertLessEqual(np.abs(srgb.astype(np.int64) - clib.fromReflectanceImg(expect)).max(), 1)
+    def test_renderLayers(self):
+        # against showFaceGen applied layer by layer, with a local layer in a box of the face
+        shading, skin, thickness, texture = face()
+        local = np.zeros(shading.shape)
+        local[20:45, 30:70] = thickness[20:45, 30:70]
+        layers = [([0.2, 0.45, 0.7], thickness), (texture, local), ([0.8, 0.3, 0.1], 0.5)]
+        expect = skin
+        for csm, thick in layers :
+            uniform = np.empty(skin.shape)
+            uniform[:] = csm
+            expect = baseShowFaceGen(np.ones(shading.shape), expect, np.broadcast_to(thick, shading.shape), uniform)
+        expect = expect * shading[:, :, np.newaxis]
+        np.testing.assert_allclose(clib.renderLayers(shading, skin, layers, bandRows=8, workers=2),
+                                   expect, rtol=1e-12, atol=1e-14)
+    def test_progressiveRender(self):
+        shading, skin, thickness, texture = face(140, 180)
+        for arr in (shading, skin, thickness, texture) :
+            arr.setflags(write=False)
+        cache = clib.lruCache()
+        imgs = list(clib.progressiveRender(shading, skin, thickness, texture, srgb=False, previewPixels=2000,
+                                           step=1, cache=cache))
+        self.assertEqual([level for level, img in imgs], [2, 1, 0])
+        self.assertEqual(imgs[0][1].shape, (35, 45, 3))
+        np.testing.assert_allclose(imgs[-1][1], clib.renderKM(shading, skin, thickness, texture),
+                                   rtol=1e-12, atol=1e-14)
+        pyramid = clib.imagePyramid(shading, 3, cache)
+        self.assertIs(clib.imagePyramid(shading, 3, cache)[1], pyramid[1])
+        seen = []
+        last = clib.renderProgressive(shading, skin, thickness, texture, lambda level, img : seen.append(level),
+                                      previewPixels=2000, cache=cache)
+        self.assertEqual(seen, [2, 0])
+        self.assertEqual(last.dtype, np.uint8)
+    def test_preparedRender(self):
+        shading, skin, thickness, texture = face()
+        for csm in ([0.2, 0.45, 0.7], texture) :
+            prepared = clib.preparedRender(shading, skin, csm, thickness, dtype=np.float64)
+            for opacity in (0.0, 0.3, 1.0) :
+                np.testing.assert_allclose(prepared.render(opacity, workers=2),
+                                           clib.renderKM(shading, skin, thickness * opacity, csm), rtol=1e-12, atol=1e-14)
+            np.testing.assert_allclose(prepared.render(0.5, thickness=2.0), clib.renderKM(shading, skin, 1.0, csm),
+                                       rtol=1e-12, atol=1e-14)
+    def test_prepareRenderCache(self):
+        shading, skin, thickness, texture = face()
+        cache = clib.lruCache()
+        shading.setflags(write=False)
+        skin.setflags(write=False)
+        first = clib.prepareRender(shading, skin, [0.2, 0.45, 0.7], thickness, cache=cache)
+        self.assertIs(clib.prepareRender(shading, skin, (0.2, 0.45, 0.7), thickness, cache=cache), first)
+        self.assertIsNot(clib.prepareRender(shading, skin, [0.2, 0.45, 0.7], thickness * 2, cache=cache), first)
+    def test_renderSRGB(self):
+        shading, skin, thickness, texture = face()
+        lin = baseShowFaceGen(shading, skin, thickness, texture)
+        srgb = clib.renderSRGB(shading, skin, thickness, texture, bandRows=8, workers=2)
+        self.assertLessEqual(np.abs(srgb.astype(np.int64) - clib.fromReflectanceImg(lin)).max(), 1)
+        scale = np.maximum(lin.max(axis=(0, 1)), 1.0)
+        srgb = clib.renderSRGB(shading, skin, thickness, texture, scale='auto', bandRows=8)
+        self.assertLessEqual(np.abs(srgb.astype(np.int64) - clib.fromReflectanceImg(lin / scale)).max(), 1)
+    def test_flatShade(self):
+        # a face of one skin color against renderKM of it
+        shading = face()[0] * 1.6
+        csms = [[0.2, 0.45, 0.7], [0.8, 0.3, 0.1]]
+        skin = np.empty(shading.shape + (3,))
+        skin[:] = [0.4, 0.5, 0.7]
+        colors = clib.cosmeticColors(skin[0, 0], csms, [1.0, 4.0])
+        shades = list(clib.iterFlatShades(shading, skin[0, 0], csms, [1.0, 4.0], 'auto', dtype=np.float64,
+                                          bandRows=8, workers=2))
+        self.assertEqual([shade for shade, img in shades], [0, 1])
+        for shade, thick in ((0, 1.0), (1, 4.0)) :
+            lin = clib.renderKM(shading, skin, thick, csms[shade])
+            np.testing.assert_allclose(shading[:, :, np.newaxis] * colors[shade], lin, rtol=1e-12, atol=1e-14)
+            self.assertLessEqual(np.abs(clib.flatShade(shading, colors[shade]).astype(np.int64)
+                                        - clib.fromReflectanceImg(lin)).max(), 1)
+            expect = clib.fromReflectanceImg(lin / clib.rollOverScale(lin))
+            self.assertLessEqual(np.abs(shades[shade][1].astype(np.int64) - expect).max(), 1)
+        out = np.zeros(shading.shape + (3,), np.uint8)
+        self.assertIs(clib.flatShade(shading, colors[0], 2.0, out=out), out)
+
+class labTest(unittest.TestCase) :
+    """ RGBtoLABImg and difLABImg against RGBtoLAB and difLAB, difLAB2000 against the published
+        CIEDE2000 test data """
+    # Sharma, Wu and Dalal, "The CIEDE2000 color-difference formula", Color Res. Appl. 30 (2005), table 1
+    sharma = [((50.0000, 2.6772, -79.7751), (50.0000, 0.0000, -82.7485), 2.0425),
+              ((50.0000, 3.1571, -77.2803), (50.0000, 0.0000, -82.7485), 2.8615),
+              ((50.0000, 2.8361, -74.0200), (50.0000, 0.0000, -82.7485), 3.4412),
+              ((50.0000, -1.3802, -84.2814), (50.0000, 0.0000, -82.7485), 1.0000),
+              ((50.0000, -1.1848, -84.8006), (50.0000, 0.0000, -82.7485), 1.0000),
+              ((50.0000, -0.9009, -85.5211), (50.0000, 0.0000, -82.7485), 1.0000),
+              ((50.0000, 0.0000, 0.0000), (50.0000, -1.0000, 2.0000), 2.3669),
+              ((50.0000, -1.0000, 2.0000), (50.0000, 0.0000, 0.0000), 2.3669),
+              ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0009), 7.1792),
+              ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0010), 7.1792),
+              ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0011), 7.2195),
+              ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0012), 7.2195),
+              ((50.0000, -0.0010, 2.4900), (50.0000, 0.0009, -2.4900), 4.8045),
+              ((50.0000, -0.0010, 2.4900), (50.0000, 0.0010, -2.4900), 4.8045),
+              ((50.0000, -0.0010, 2.4900), (50.0000, 0.0011, -2.4900), 4.7461),
+              ((50.0000, 2.5000, 0.0000), (50.0000, 0.0000, -2.5000), 4.3065),
+              ((50.0000, 2.5000, 0.0000), (73.0000, 25.0000, -18.0000), 27.1492),
+              ((50.0000, 2.5000, 0.0000), (61.0000, -5.0000, 29.0000), 22.8977),
+              ((50.0000, 2.5000, 0.0000), (56.0000, -27.0000, -3.0000), 31.9030),
+              ((50.0000, 2.5000, 0.0000), (58.0000, 24.0000, 15.0000), 19.4535),
+              ((50.0000, 2.5000, 0.0000), (50.0000, 3.1736, 0.5854), 1.0000),
+              ((50.0000, 2.5000, 0.0000), (50.0000, 3.2972, 0.0000), 1.0000),
+              ((50.0000, 2.5000, 0.0000), (50.0000, 1.8634, 0.5757), 1.0000),
+              ((50.0000, 2.5000, 0.0000), (50.0000, 3.2592, 0.3350), 1.0000),
+              ((60.2574, -34.0099, 36.2677), (60.4626, -34.1751, 39.4387), 1.2644),
+              ((63.0109, -31.0961, -5.8663), (62.8187, -29.7946, -4.0864), 1.2630),
+              ((61.2901, 3.7196, -5.3901), (61.4292, 2.2480, -4.9620), 1.8731),
+              ((35.0831, -44.1164, 3.7933), (35.0232, -40.0716, 1.5901), 1.8645),
+              ((22.7233, 20.0904, -46.6940), (23.0331, 14.9730, -42.5619), 2.0373),
+              ((36.4612, 47.8580, 18.3852), (36.2715, 50.5065, 21.2231), 1.4146),
+              ((90.8027, -2.0831, 1.4410), (91.1528, -1.6435, 0.0447), 1.4441),
+              ((90.9257, -0.5406, -0.9208), (88.6381, -0.8985, -0.7239), 1.5381),
+              ((6.7747, -0.2908, -2.4247), (5.8714, -0.0985, -2.2286), 0.6377),
+              ((2.0776, 0.0795, -1.1350), (0.9033, -0.0636, -0.5514), 0.9082)]
+    def test_RGBtoLABImg(self):
+        img = np.random.RandomState(8).uniform(0, 1, (30, 20, 3))
+        img[0, 0:3] = [[0, 0, 0], [1, 1, 1], [0.001, 0.002, 0.0005]]  # black, white and the linear part of fLAB
+        expect = np.array([[clib.RGBtoLAB(bgr) for bgr in row] for row in img])
+        # fLAB takes t ** 0.33333333, fLABImg the exact cube root, which is up to 1e-8 different
+        np.testing.assert_allclose(clib.RGBtoLABImg(img, bandRows=7, workers=2), expect, rtol=1e-7, atol=1e-6)
+        np.testing.assert_allclose(clib.RGBtoLABImg(img, dtype=np.float32), expect, rtol=1e-5, atol=1e-3)
+        out = np.zeros(img.shape)
+        self.assertIs(clib.RGBtoLABImg(img, out=out), out)
+        np.testing.assert_allclose(clib.RGBtoLABImg(img.reshape(-1, 3)), expect.reshape(-1, 3), rtol=1e-7, atol=1e-6)
+    def test_difLABImg(self):
+        rand = np.random.RandomState(9)
+        img1 = rand.uniform(0, 1, (30, 20, 3))
+        img2 = rand.uniform(0, 1, (30, 20, 3))
+        expect = np.array([[clib.difLAB(bgr1, bgr2) for bgr1, bgr2 in zip(row1, row2)] for row1, row2 in zip(img1, img2)])
+        np.testing.assert_allclose(clib.difLABImg(img1, img2, bandRows=7, workers=2), expect, rtol=1e-7, atol=1e-6)
+        np.testing.assert_allclose(clib.difLABImg(img1, img2, dtype=np.float32), expect, rtol=1e-4, atol=1e-3)
+        np.testing.assert_array_equal(clib.difLABImg(img1, img1), 0)
+    def test_difLAB2000(self):
+        lab1 = np.array([pair[0] for pair in self.sharma])
+        lab2 = np.array([pair[1] for pair in self.sharma])
+        expect = np.array([pair[2] for pair in self.sharma])
+        np.testing.assert_allclose(clib.difLAB2000(lab1, lab2), expect, rtol=0, atol=5e-5)
+        np.testing.assert_allclose(clib.difLAB2000(lab2, lab1), expect, rtol=0, atol=5e-5)  # symmetric
+        every = clib.difLAB2000(lab1[:, np.newaxis, :], lab2[np.newaxis, :, :])  # broadcast, all pairs
+        np.testing.assert_allclose(np.diagonal(every), expect, rtol=0, atol=5e-5)
+
+class floodfillTest(unittest.TestCase) :
+    """ floodfill, fillRegion and floodfillFunc against the deque flood fill they replace """
+    def check(self, img, pt) :
+        expect = img.copy()
+        baseFloodfill(expect, pt, 100)
+        seed = np.zeros(img.shape, bool)
+        seed[pt[0], pt[1]] = True
+        region, box = clib.fillRegion(img, pt)
+        np.testing.assert_array_equal(region, (expect != img) | seed)
+        rows, cols = np.nonzero(region)
+        self.assertEqual(tuple(box), (rows.min(), cols.min(), rows.max() + 1, cols.max() + 1))
+        filled = img.copy()
+        clib.floodfill(filled, pt, 100)
+        np.testing.assert_array_equal(filled, expect)
+        func = clib.constVal()
+        func.setVal(100)
+        filled = img.copy()
+        clib.floodfillFunc(filled, pt, func)
+        np.testing.assert_array_equal(filled, expect)
+        class pointVal() :  # a func with only getVal, done a point at a time
+            def getVal(self, pt) :
+                return 100
+        filled = img.copy()
+        clib.floodfillFunc(filled, pt, pointVal())
+        np.testing.assert_array_equal(filled, expect)
+    def test_inside(self):
+        self.check(outline(), (5, 5))
+        self.check(outline(), (7, 9))  # inside the island
+        self.check(outline(), (2, 3))  # on the boundary, the start is filled anyway
+    def test_border(self):
+        img = outline()
+        self.check(img, (0, 0))  # outside the outline, along the image edges
+        self.check(img, (19, 23))
+        img[:, 10] = 255  # a line across the image, the fill stops at the edges
+        self.check(img, (0, 10))
+        self.check(img, (10, 0))
+        img = np.eye(20, 24, dtype=np.uint8) * 255  # a diagonal line does not stop an 8 connected fill
+        self.check(img, (0, 23))
+        self.assertTrue(clib.fillRegion(img, (0, 23))[0][19, 0])
+    def test_threshold(self):
+        # any value above 0 is boundary, 1 as much as 255
+        img = np.random.RandomState(10).randint(0, 2, (20, 24)).astype(np.uint8)
+        img[img > 0] = np.random.RandomState(11).choice([1, 2, 254, 255], np.count_nonzero(img))
+        img[10, 12] = 0
+        self.check(img, (10, 12))
+        img = np.zeros((20, 24), np.uint8)
+        img[5, :] = 1
+        self.check(img, (0, 0))
+        self.assertFalse(clib.fillRegion(img, (0, 0))[0][6:].any())
+    def test_outside(self):
+        with self.assertRaises(ValueError) :
+            clib.fillRegion(outline(), (20, 0))
+
+class featherTest(unittest.TestCase) :
+    """ featherThickness and featheredVal against floodfillFunc with renorm and the per pixel search """
+    def test_featherThickness(self):
+        line, edge = eyelid()
+        func = clib.featheredVal()
+        func.setLine(line)
+        img = edge.copy()
+        region, box = clib.floodfillFunc(img, (20, 30), func)
+        expect = np.zeros(img.shape, np.uint8)
+        func.renorm(expect)
+        thick = clib.featherThickness(region, line)
+        self.assertLessEqual(np.abs(thick.astype(np.int64) - expect).max(), 1)
+        self.assertFalse(thick[~region].any())
+        out = edge.copy()  # written into the floodfill image inside the region only
+        self.assertIs(clib.featherThickness(region, line, out=out), out)
+        np.testing.assert_array_equal(out[region], thick[region])
+        np.testing.assert_array_equal(out[~region], edge[~region])
+    def test_falloff(self):
+        line, edge = eyelid()
+        region, box = clib.fillRegion(edge, (20, 30))
+        pts = np.argwhere(region)
+        expect = baseFeather(line, pts)
+        vals = clib.featherFalloff(clib.lineDistance(line)[region])
+        np.testing.assert_allclose(254 * vals / vals.max(), expect, rtol=0, atol=254e-5)
+        func = clib.featheredVal()
+        func.setLine(line)
+        func.getVals(pts)
+        img = np.zeros(edge.shape)
+        func.renorm(img)
+        np.testing.assert_allclose(img[region], expect, rtol=0, atol=254e-5)
+        func.setLine(line)
+        for pt in pts[0:50] :  # a point at a time
+            func.getVal(pt)
+        raw = [(((np.argwhere(line == 255) - pt) ** 2).sum(axis=1).min()) ** 0.3 for pt in pts[0:50]]
+        np.testing.assert_allclose([val[1] for val in func.val], raw, rtol=1e-5)
+        dist = clib.lineDistance(line)[region]
+        np.testing.assert_allclose(clib.featherFalloff(dist, 'linear'), dist)
+        ends = clib.featherFalloff(np.array([0.0, dist.max()]), 'smoothstep')
+        np.testing.assert_allclose(ends, [0.0, 1.0])
+
+class lutTest(unittest.TestCase) :
+    """ kmLUT against renderKM and renderSRGB """
+    def test_render(self):
+        shading, skin, thickness, texture = face()
+        csm = [0.2, 0.45, 0.7]
+        thick8 = np.rint(thickness * (254 / 4.0)).astype(np.uint8)  # an 8 bit thickness map like renorm makes
+        lut = clib.kmLUT(csm, thicknessScale=4.0 / 254)
+        skin8 = clib.fromReflectanceImg(skin)
+        exact = clib.renderKM(shading, clib.toReflectanceImg(skin8), thick8 * (4.0 / 254), csm)
+        bound = lut.maxError * shading.max()
+        self.assertLessEqual(np.abs(lut.render(shading, skin8, thick8, bandRows=8, workers=2) - exact).max(), 1e-6)
+        linear = lut.render(shading, skin, thick8)  # skin rounded to sRGB values first
+        self.assertLessEqual(np.abs(linear - clib.renderKM(shading, skin, thick8 * (4.0 / 254), csm)).max(), bound)
+        self.assertLessEqual(lut.error(shading, skin, thick8), bound)
+        srgb = clib.renderSRGB(shading, clib.toReflectanceImg(skin8), thick8 * (4.0 / 254), csm, bandRows=8)
+        lutSRGB = clib.fromReflectanceImg(lut.render(shading, skin8, thick8))
+        self.assertLessEqual(np.abs(lutSRGB.astype(np.int64) - srgb).max(), 1)
+        one = lut.render(shading, skin8, 200)  # one thickness for the whole face
+        np.testing.assert_allclose(one, clib.renderKM(shading, clib.toReflectanceImg(skin8), 200 * (4.0 / 254), csm),
+                                   rtol=0, atol=1e-6)
+        with self.assertRaises(ValueError) :
+            lut.render(shading, skin8, thickness)
+    def test_cache(self):
+        cache = clib.lruCache()
+        lut = clib.getKMTable([0.2, 0.45, 0.7], cache=cache)
+        self.assertIs(clib.getKMTable((0.2, 0.45, 0.7), cache=cache), lut)
+        self.assertIs(clib.getKMTable(np.array([0.2, 0.45, 0.7]), cache=cache), lut)
+        self.assertIsNot(clib.getKMTable([0.2, 0.45, 0.7], thicknessScale=2.0/255, cache=cache), lut)
+        self.assertIsNot(clib.getKMTable([0.2, 0.45, 0.7], cache=False), lut)
+        np.testing.assert_array_equal(clib.getKMTable([0.2, 0.45, 0.7], cache=False).table, lut.table)
+
+if __name__ == '__main__' :
+    unittest.main()
+
+class maskTest(unittest.TestCase) :
+    """ maskCode round trips and the masks found by lineRegions and annotationMasks """
+    def masks(self) :
+        rand = np.random.RandomState(3)
+        dots = np.zeros((9, 13), np.uint8)  # odd width, so bit packed rows do not end on a byte
+        dots[1:8, 2:11] = rand.randint(0, 2, (7, 9))
+        dots[1, 2] = dots[7, 10] = 1  # the box is the whole middle part
+        full = np.ones((7, 5), np.uint8)
+        corner = np.zeros((6, 11), np.uint8)
+        corner[0, 0] = 255
+        return [np.zeros((5, 7), np.uint8), full, dots, corner, outline()]
+    def test_roundTrip(self):
+        for method in ('rle', 'bits') :
+            for mask in self.masks() :
+                code = clib.maskCode(mask, method=method)
+                np.testing.assert_array_equal(code.decode(), mask != 0)
+                self.assertEqual(code.area, np.count_nonzero(mask))
+                self.assertEqual(code.nbytes, code.data.nbytes)
+                if code.area == 0 :
+                    self.assertIsNone(code.point())
+                    continue
+                self.assertEqual(tuple(code.box), clib.maskBox(mask))
+                self.assertTrue(mask[code.point()])
+        full = clib.maskCode(np.ones((7, 5)))
+        np.testing.assert_array_equal(full.data, [0, 35])  # starts with a run of 0 zeros
+        np.testing.assert_array_equal(full.decode((9, 6)), np.pad(np.ones((7, 5), bool), ((0, 2), (0, 1))))
+        box = (2, 3, 5, 9)
+        part = self.masks()[2][box[0]:box[2], box[1]:box[3]]
+        code = clib.maskCode(part, box, method='bits')
+        np.testing.assert_array_equal(code.crop(), part != 0)
+        with self.assertRaises(ValueError) :
+            clib.maskCode(part, method='png')
+    def test_lineRegions(self):
+        img = outline()
+        regions = clib.lineRegions(img)
+        main = clib.fillRegion(img, (5, 5))[0] & (img == 0)
+        island = clib.fillRegion(img, (7, 9))[0] & (img == 0)
+        self.assertEqual(len(regions), 2)
+        np.testing.assert_array_equal(regions[0].decode(), main)
+        np.testing.assert_array_equal(regions[1].decode(), island)
+        self.assertEqual(len(clib.lineRegions(img, minArea=island.sum() + 1)), 1)
+        self.assertEqual(clib.lineRegions(np.zeros((6, 8), np.uint8)), [])
+        diagonal = np.zeros((8, 8), np.uint8)  # a diamond of diagonal steps still encloses its middle
+        cv.polylines(diagonal, [np.array([[4, 1], [7, 4], [4, 7], [1, 4]]).reshape(-1, 1, 2)], True, 255, lineType=8)
+        regions = clib.lineRegions(diagonal, method='bits')
+        self.assertEqual(len(regions), 1)
+        self.assertTrue(regions[0].decode()[4, 4])
+    def test_annotationMasks(self):
+        line, edge = eyelid()
+        img = np.full(line.shape + (3,), 200, np.uint8)
+        img[edge != 0] = [0, 0, 250]
+        img[line != 0] = [254, 2, 0]  # the top line drawn again in another color, it encloses nothing
+        lines, regions = clib.annotationMasks(img, {'eyelid': [0, 0, 255], 'feather': [255, 0, 0]},
+                                              {'eyelid': 5, 'feather': 2})
+        self.assertEqual(list(lines), ['eyelid', 'feather'])
+        np.testing.assert_array_equal(lines['feather'].decode(), line != 0)
+        np.testing.assert_array_equal(lines['eyelid'].decode(), (edge != 0) & (line == 0))
+        self.assertEqual(regions['feather'], [])
+        self.assertEqual(len(regions['eyelid']), 0)  # the eyelid outline is open where the feather line is
+        img[line != 0] = [0, 0, 255]
+        lines, regions = clib.annotationMasks(img, {'eyelid': [0, 0, 255]}, 5)
+        outside = edge.copy()  # a 4 connected fill, the 8 connected fillRegion leaks through the diagonal steps
+        cv.floodFill(outside, None, (0, 0), 128, flags=4)
+        inside = outside == 0
+        self.assertEqual(len(regions['eyelid']), 1)
+        np.testing.assert_array_equal(regions['eyelid'][0].decode(), inside)